@@ -0,0 +1,239 @@
+import multiprocessing as mp
+import operator
+from typing import Iterable, List, Sequence, Tuple
+
+from scratch.linear_algebra import ArrayVector
+from scratch.deep_learning import Tensor, Layer, Loss, Optimizer, ArrayTensor
+
+# Data-parallel training: every worker process holds a replica of the
+# model, and each mini-batch gets split into one shard per worker.
+#
+#  * The parameters live in one block of shared memory. The replicas'
+#    ArrayTensors are views into it, so when the optimizer updates the
+#    parameters (in the parent process) every replica sees the new values
+#    without anything getting copied.
+#  * Each worker runs forward and backward on its shard and writes its
+#    gradients into its own slot of a second block of shared memory.
+#  * The parent adds up the slots (in worker order, so the result doesn't
+#    depend on who finished first) and takes one ordinary optimizer step.
+#
+# Since the loss (and so the gradient) of a batch is the sum over its
+# examples, this computes the same update as training on the whole batch
+# in one process, up to floating point rounding.
+
+def as_doubles(raw) -> memoryview:
+    """
+    A writable memoryview of doubles for a multiprocessing.RawArray('d').
+    (Its own memoryview has format '<d', which an array('d') can't be
+    assigned into, so we recast it.)
+    """
+    return memoryview(raw).cast('B').cast('d')
+
+def share_tensors(tensors: Iterable[ArrayTensor], buffer: Sequence[float]) -> None:
+    """
+    Points each tensor at consecutive slices of buffer, in order,
+    so that from now on its values live there.
+    """
+    offset = 0
+    for tensor in tensors:
+        assert isinstance(tensor, ArrayTensor), "parameters must be ArrayTensors"
+        tensor.data = buffer
+        tensor.offset = offset
+        offset += tensor.size
+
+# Each worker process's replica, set up once by _init_worker.
+_model: Layer = None
+_loss: Loss = None
+_grads: memoryview = None
+_num_values = 0
+
+def _init_worker(model: Layer, loss: Loss, raw_params, raw_grads) -> None:
+    global _model, _loss, _grads, _num_values
+    _model, _loss = model, loss
+    share_tensors(_model.params(), as_doubles(raw_params))
+    _grads = as_doubles(raw_grads)
+    _num_values = len(raw_params)
+
+def _worker_step(args: Tuple[int, List[Tensor], List[Tensor]]) -> float:
+    """Forward and backward for one shard; returns the shard's loss"""
+    slot, xs, ys = args
+    predicted = _model.forward(xs)
+    loss, gradient = _loss.loss_and_gradient(predicted, ys)
+    _model.backward(gradient)
+
+    # Write our gradients into our slot of the shared gradients.
+    offset = slot * _num_values
+    for grad in _model.grads():
+        _grads[offset:offset + grad.size] = ArrayVector(grad.flat())
+        offset += grad.size
+
+    return loss
+
+class ReducedGradients(Layer):
+    """
+    What the optimizer gets to see: the (shared) parameters, along with
+    the gradients added up across workers. Because it's the same object on
+    every step, optimizers that keep per-parameter state (like Momentum)
+    work unchanged.
+    """
+    def __init__(self, params: List[ArrayTensor]) -> None:
+        self._params = params
+        self.total = ArrayVector(bytes(8 * sum(p.size for p in params)))
+        self._grads = [ArrayTensor.from_flat(self.total, p.shape) for p in params]
+        share_tensors(self._grads, self.total)
+
+    def params(self) -> Iterable[Tensor]:
+        return self._params
+
+    def grads(self) -> Iterable[Tensor]:
+        return self._grads
+
+def split(n: int, num_shards: int) -> List[Tuple[int, int]]:
+    """Splits range(n) into num_shards contiguous, nearly equal pieces"""
+    bounds = [n * k // num_shards for k in range(num_shards + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+assert split(10, 3) == [(0, 3), (3, 6), (6, 10)]
+assert split(4, 4) == [(0, 1), (1, 2), (2, 3), (3, 4)]
+
+class DataParallelTrainer:
+    """
+    Trains model on mini-batches split across num_workers processes.
+    The model's parameters must be ArrayTensors (as Linear's are), and they
+    get moved into shared memory, so model itself stays up to date.
+
+    Layers that use randomness (like Dropout) draw from each worker's own
+    random state, so only deterministic models reproduce single-process
+    training exactly.
+    """
+    def __init__(self,
+                 model: Layer,
+                 loss: Loss,
+                 optimizer: Optimizer,
+                 num_workers: int = None) -> None:
+        self.model = model
+        self.optimizer = optimizer
+        self.num_workers = num_workers or mp.cpu_count()
+
+        params = list(model.params())
+        self.num_values = sum(param.size for param in params)
+
+        raw_params = mp.RawArray('d', self.num_values)
+        raw_grads = mp.RawArray('d', self.num_workers * self.num_values)
+        self.grads = as_doubles(raw_grads)
+
+        # Copy the starting parameters into shared memory *before* creating
+        # the pool, so that the replicas get pickled (if they need to be)
+        # with ordinary arrays. Only then do we point model at the copy.
+        shared_params = as_doubles(raw_params)
+        offset = 0
+        for param in params:
+            shared_params[offset:offset + param.size] = ArrayVector(param.flat())
+            offset += param.size
+
+        self.pool = mp.Pool(self.num_workers,
+                            initializer=_init_worker,
+                            initargs=(model, loss, raw_params, raw_grads))
+
+        share_tensors(params, shared_params)
+        self.reduced = ReducedGradients(params)
+
+    def step(self, xs: Sequence[Tensor], ys: Sequence[Tensor]) -> float:
+        """One optimizer step on the batch (xs, ys); returns its total loss"""
+        shards = split(len(xs), min(self.num_workers, len(xs)))
+        losses = self.pool.map(_worker_step,
+                               [(slot, xs[lo:hi], ys[lo:hi])
+                                for slot, (lo, hi) in enumerate(shards)])
+
+        # Reduce: add up the workers' gradients, in order.
+        n = self.num_values
+        total = ArrayVector(self.grads[0:n])
+        for slot in range(1, len(shards)):
+            total = ArrayVector(map(operator.add,
+                                    total,
+                                    self.grads[slot * n:(slot + 1) * n]))
+        self.reduced.total[:] = total
+
+        self.optimizer.step(self.reduced)
+        return sum(losses)
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self) -> 'DataParallelTrainer':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+def main():
+    import random
+    import time
+    from scratch.deep_learning import (Sequential, Linear, Tanh, Momentum,
+                                       SoftmaxCrossEntropy, one_hot_encode)
+
+    # Some fake MNIST-shaped data: noisy copies of 10 random "digits".
+    random.seed(0)
+    centers = [[random.gauss(0, 0.3) for _ in range(784)] for _ in range(10)]
+    labels = [random.randrange(10) for _ in range(1024)]
+    xs = [[c + random.gauss(0, 1) for c in centers[label]] for label in labels]
+    ys = [one_hot_encode(label) for label in labels]
+
+    BATCH_SIZE = 64
+
+    def make_model() -> Layer:
+        random.seed(0)
+        return Sequential([Linear(784, 30), Tanh(), Linear(30, 10)])
+
+    def train(model: Layer, num_workers: int = 0, num_batches: int = None) -> float:
+        """num_workers = 0 means train in this process, without a pool"""
+        loss = SoftmaxCrossEntropy()
+        optimizer = Momentum(learning_rate=0.01, momentum=0.9)
+        starts = list(range(0, len(xs), BATCH_SIZE))[:num_batches]
+
+        start_time = time.time()
+        if num_workers == 0:
+            for start in starts:
+                batch_xs, batch_ys = xs[start:start + BATCH_SIZE], ys[start:start + BATCH_SIZE]
+                predicted = model.forward(batch_xs)
+                model.backward(loss.gradient(predicted, batch_ys))
+                optimizer.step(model)
+        else:
+            with DataParallelTrainer(model, loss, optimizer, num_workers) as trainer:
+                for start in starts:
+                    trainer.step(xs[start:start + BATCH_SIZE],
+                                 ys[start:start + BATCH_SIZE])
+        return time.time() - start_time
+
+    def param_values(model: Layer) -> List[float]:
+        return [x for param in model.params() for x in param.flat()]
+
+    # Same seed, same batches => same parameters. With one worker the
+    # arithmetic is identical; with more, the gradient sums are just
+    # grouped differently.
+    expected = make_model()
+    train(expected, num_workers=0, num_batches=4)
+
+    for num_workers in [1, 2, 3]:
+        actual = make_model()
+        train(actual, num_workers, num_batches=4)
+        if num_workers == 1:
+            assert param_values(actual) == param_values(expected)
+        else:
+            assert all(abs(a - e) < 1e-9 for a, e in zip(param_values(actual),
+                                                          param_values(expected)))
+    print("data-parallel training matches single-process training")
+
+    # Scaling: time one epoch for 1 to N workers. Efficiency is
+    # speedup / workers, so 100% would be perfect linear scaling.
+    print(f"{mp.cpu_count()} CPUs, batch size {BATCH_SIZE}")
+    baseline = train(make_model(), num_workers=0)
+    print(f"{'single process':>14} {baseline:7.2f}s")
+    for num_workers in range(1, max(mp.cpu_count(), 2) + 1):
+        elapsed = train(make_model(), num_workers)
+        speedup = baseline / elapsed
+        print(f"{num_workers:>6} workers {elapsed:7.2f}s  "
+              f"speedup {speedup:4.2f}  efficiency {speedup / num_workers:4.0%}")
+
+if __name__ == "__main__": main()
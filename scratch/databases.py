@@ -4,13 +4,543 @@ users = [[0, "Hero", 0],
          [3, "Chi", 3]]
 
 from typing import Tuple, Sequence, List, Any, Callable, Dict, Iterator
+from typing import Iterable, Optional, Set
 from collections import defaultdict
+from array import array
+import bisect
+import itertools
+import operator
+import sys
 
 # A few type aliases we'll use later
 Row = Dict[str, Any]                        # A database row
 WhereClause = Callable[[Row], bool]         # Predicate for a single row
 HavingClause = Callable[[List[Row]], bool]  # Predicate over multiple rows
 
+# A WhereClause can be any function of a row, but then the only way to
+# use it is to call it on every row. Predicates built out of col(...)
+# instead remember what they compare, e.g. col("user_id") == 42, which
+# lets a Table use an index to find the matching rows. They're still
+# callable on a row, so they work anywhere a WhereClause does.
+
+def describe(fn: Callable) -> str:
+    """A name for a function (or predicate) to show when printing"""
+    if isinstance(fn, Predicate):
+        return repr(fn)
+    return getattr(fn, '__name__', repr(fn))
+
+class Predicate:
+    def __call__(self, row: Row) -> bool:
+        raise NotImplementedError
+
+    def __and__(self, other: 'Predicate') -> 'Predicate':
+        return And(self, other)
+
+    def __or__(self, other: 'Predicate') -> 'Predicate':
+        return Or(self, other)
+
+    def __invert__(self) -> 'Predicate':
+        return Not(self)
+
+    def __bool__(self) -> bool:
+        # Otherwise `1 < col("x") < 5` or `p and q` would silently
+        # treat a predicate as True.
+        raise TypeError("use & | ~ to combine predicates, not and/or/not")
+
+COMPARISONS = {"==": operator.eq, "!=": operator.ne,
+               "<": operator.lt, "<=": operator.le,
+               ">": operator.gt, ">=": operator.ge}
+
+class Comparison(Predicate):
+    """row[column] <op> value. None is only == None, and never < or > anything."""
+    def __init__(self, column: str, op: str, value: Any) -> None:
+        self.column = column
+        self.op = op
+        self.value = value
+        self.compare = COMPARISONS[op]
+
+    def __call__(self, row: Row) -> bool:
+        return self.matches(row[self.column])
+
+    def matches(self, row_value: Any) -> bool:
+        if (row_value is None or self.value is None) and self.op not in ("==", "!="):
+            return False
+        return self.compare(row_value, self.value)
+
+    def __repr__(self) -> str:
+        return f"col({self.column!r}) {self.op} {self.value!r}"
+
+class And(Predicate):
+    def __init__(self, left: Predicate, right: Predicate) -> None:
+        self.left, self.right = left, right
+
+    def __call__(self, row: Row) -> bool:
+        return self.left(row) and self.right(row)
+
+    def __repr__(self) -> str:
+        return f"({describe(self.left)}) & ({describe(self.right)})"
+
+class Or(Predicate):
+    def __init__(self, left: Predicate, right: Predicate) -> None:
+        self.left, self.right = left, right
+
+    def __call__(self, row: Row) -> bool:
+        return self.left(row) or self.right(row)
+
+    def __repr__(self) -> str:
+        return f"({describe(self.left)}) | ({describe(self.right)})"
+
+class Not(Predicate):
+    def __init__(self, predicate: Predicate) -> None:
+        self.predicate = predicate
+
+    def __call__(self, row: Row) -> bool:
+        return not self.predicate(row)
+
+    def __repr__(self) -> str:
+        return f"~({describe(self.predicate)})"
+
+class Column:
+    """col("name") <op> value makes a Comparison predicate"""
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __eq__(self, value) -> Predicate:   # type: ignore
+        return Comparison(self.name, "==", value)
+
+    def __ne__(self, value) -> Predicate:   # type: ignore
+        return Comparison(self.name, "!=", value)
+
+    def __lt__(self, value) -> Predicate:
+        return Comparison(self.name, "<", value)
+
+    def __le__(self, value) -> Predicate:
+        return Comparison(self.name, "<=", value)
+
+    def __gt__(self, value) -> Predicate:
+        return Comparison(self.name, ">", value)
+
+    def __ge__(self, value) -> Predicate:
+        return Comparison(self.name, ">=", value)
+
+    __hash__ = None    # type: ignore
+
+def col(name: str) -> Column:
+    return Column(name)
+
+assert (col("x") == 1)({"x": 1}) and not (col("x") == 1)({"x": 2})
+assert (5 < col("x"))({"x": 6}), "reflected comparisons work too"
+assert ((col("x") > 1) & ~(col("y") == "a"))({"x": 2, "y": "b"})
+assert not (col("x") < 3)({"x": None})
+
+# Indexes map the values in one column to the positions (in table.rows)
+# of the rows that have them. A HashIndex can only find rows equal to a
+# value, but does it in O(1); a SortedIndex keeps (value, position)
+# pairs in sorted order, so it can also find ranges, in O(log n).
+
+class HashIndex:
+    operators = {"=="}
+
+    def __init__(self, column: str) -> None:
+        self.column = column
+        self.positions: Dict[Any, Set[int]] = defaultdict(set)
+
+    def add(self, value: Any, position: int) -> None:
+        self.positions[value].add(position)
+
+    def remove(self, value: Any, position: int) -> None:
+        positions = self.positions[value]
+        positions.remove(position)
+        if not positions:
+            del self.positions[value]
+
+    def lookup(self, op: str, value: Any) -> Iterable[int]:
+        assert op in self.operators
+        return self.positions.get(value, ())
+
+class SortedIndex:
+    operators = {"==", "<", "<=", ">", ">="}
+
+    def __init__(self, column: str) -> None:
+        self.column = column
+        self.entries: List[Tuple[Any, int]] = []    # (value, position), sorted
+        self.none_positions: Set[int] = set()       # None doesn't sort
+
+    def add(self, value: Any, position: int) -> None:
+        if value is None:
+            self.none_positions.add(position)
+        else:
+            bisect.insort(self.entries, (value, position))
+
+    def remove(self, value: Any, position: int) -> None:
+        if value is None:
+            self.none_positions.remove(position)
+        else:
+            i = bisect.bisect_left(self.entries, (value, position))
+            assert self.entries[i] == (value, position), "not in index"
+            del self.entries[i]
+
+    def lookup(self, op: str, value: Any) -> Iterable[int]:
+        assert op in self.operators
+        if value is None:
+            return self.none_positions if op == "==" else ()
+
+        # (value,) sorts before every (value, position), and
+        # (value, inf) after all of them.
+        first = bisect.bisect_left(self.entries, (value,))
+        after = bisect.bisect_left(self.entries, (value, float('inf')))
+        lo, hi = {"==": (first, after),
+                  "<": (0, first),
+                  "<=": (0, after),
+                  ">": (after, len(self.entries)),
+                  ">=": (first, len(self.entries))}[op]
+        return [position for _, position in self.entries[lo:hi]]
+
+INDEX_KINDS = {"hash": HashIndex, "sorted": SortedIndex}
+
+# group_by used to collect every row into its group's list before calling
+# the aggregate functions on those lists, so it needed memory for the
+# whole table. The built-in Aggregates below instead keep a small "state"
+# per group, and update it one row at a time. They can also merge two
+# partial states, so when there are too many groups to keep in memory,
+# group_by can write its partial results out to temporary files (split
+# into partitions by key) and then finish each partition separately.
+
+import pickle
+import tempfile
+
+class Aggregate:
+    """
+    An aggregate of the values in `column`. It's also callable on a list
+    of rows, like the aggregate functions group_by has always taken.
+    """
+    def __init__(self, column: str = None) -> None:
+        self.column = column
+
+    def initial(self) -> Any:
+        return None
+
+    def add(self, state: Any, value: Any) -> Any:
+        """The new state after seeing one more value (possibly None)"""
+        raise NotImplementedError
+
+    def merge(self, state1: Any, state2: Any) -> Any:
+        """The state for the values of both state1 and state2"""
+        raise NotImplementedError
+
+    def result(self, state: Any) -> Any:
+        return state
+
+    def result_type(self, column_type: type) -> type:
+        return column_type
+
+    def __call__(self, rows: List[Row]) -> Any:
+        state = self.initial()
+        for row in rows:
+            state = self.add(state, row[self.column] if self.column else None)
+        return self.result(state)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.column!r})"
+
+class Count(Aggregate):
+    """The number of rows, or (given a column) of non-None values in it"""
+    def initial(self) -> int:
+        return 0
+
+    def add(self, state: int, value: Any) -> int:
+        return state + 1 if self.column is None or value is not None else state
+
+    def merge(self, state1: int, state2: int) -> int:
+        return state1 + state2
+
+    def result_type(self, column_type: type) -> type:
+        return int
+
+    def __repr__(self) -> str:
+        return "Count()" if self.column is None else super().__repr__()
+
+class Sum(Aggregate):
+    # (The sum of no values is None, like in SQL.)
+    def add(self, state: Any, value: Any) -> Any:
+        if value is None:
+            return state
+        return value if state is None else state + value
+
+    merge = add
+
+class Min(Aggregate):
+    def add(self, state: Any, value: Any) -> Any:
+        if value is None:
+            return state
+        return value if state is None or value < state else state
+
+    merge = add
+
+class Max(Aggregate):
+    def add(self, state: Any, value: Any) -> Any:
+        if value is None:
+            return state
+        return value if state is None or value > state else state
+
+    merge = add
+
+class Avg(Aggregate):
+    """The state is (total, count)"""
+    def initial(self) -> Tuple[float, int]:
+        return (0, 0)
+
+    def add(self, state: Tuple[float, int], value: Any) -> Tuple[float, int]:
+        if value is None:
+            return state
+        return (state[0] + value, state[1] + 1)
+
+    def merge(self, state1: Tuple[float, int], state2: Tuple[float, int]) -> Tuple[float, int]:
+        return (state1[0] + state2[0], state1[1] + state2[1])
+
+    def result(self, state: Tuple[float, int]) -> Optional[float]:
+        total, count = state
+        return total / count if count else None
+
+    def result_type(self, column_type: type) -> type:
+        return float
+
+class CountDistinct(Aggregate):
+    """The state is the set of values seen, so this one isn't O(1) per group"""
+    def initial(self) -> Set[Any]:
+        return set()
+
+    def add(self, state: Set[Any], value: Any) -> Set[Any]:
+        if value is not None:
+            state.add(value)
+        return state
+
+    def merge(self, state1: Set[Any], state2: Set[Any]) -> Set[Any]:
+        state1 |= state2
+        return state1
+
+    def result(self, state: Set[Any]) -> int:
+        return len(state)
+
+    def result_type(self, column_type: type) -> type:
+        return int
+
+rows = [{"x": 1, "y": "a"}, {"x": 5, "y": "b"}, {"x": None, "y": "a"}]
+assert Count()(rows) == 3 and Count("x")(rows) == 2
+assert Sum("x")(rows) == 6 and Avg("x")(rows) == 3.0
+assert Min("x")(rows) == 1 and Max("x")(rows) == 5 and Max("x")([]) is None
+assert CountDistinct("y")(rows) == 2
+
+def aggregate_type(aggregate: Callable, column_types: Dict[str, type]) -> type:
+    """The type of an aggregate's results, for the result table"""
+    if isinstance(aggregate, Aggregate):
+        return aggregate.result_type(column_types.get(aggregate.column, object))
+    return aggregate.__annotations__['return']
+
+# How many groups group_by keeps in memory before spilling to disk.
+MAX_GROUPS = 1000000
+
+class HashAggregator:
+    """
+    Keeps the state of every aggregate for every group, in a dict. If
+    there get to be more than max_groups groups, it writes them all out
+    to num_partitions temporary files (by hash of the key) and starts
+    over. At the end, each file holds all the partial states for its keys,
+    so it can be finished (with merge) on its own.
+    """
+    def __init__(self,
+                 aggregates: List[Aggregate],
+                 max_groups: int = MAX_GROUPS,
+                 num_partitions: int = 16,
+                 depth: int = 0) -> None:
+        self.aggregates = aggregates
+        self.max_groups = max_groups
+        self.num_partitions = num_partitions
+        self.depth = depth
+        self.adders = [agg.add for agg in aggregates]
+        self.groups: Dict[tuple, List[Any]] = {}
+        self.partitions: Optional[List[Any]] = None     # files, once we spill
+        self.num_spills = 0
+
+    def _new_group(self, key: tuple) -> None:
+        # (If partitioning hasn't helped after several levels, the keys
+        # must all hash alike, so just keep going in memory.)
+        if len(self.groups) >= self.max_groups and self.depth < 8:
+            self.spill()
+
+    def add(self, key: tuple, values: Sequence[Any]) -> None:
+        states = self.groups.get(key)
+        if states is None:
+            self._new_group(key)
+            states = self.groups[key] = [agg.initial() for agg in self.aggregates]
+        for i, add in enumerate(self.adders):
+            states[i] = add(states[i], values[i])
+
+    def add_partial(self, key: tuple, partial_states: List[Any]) -> None:
+        states = self.groups.get(key)
+        if states is None:
+            self._new_group(key)
+            self.groups[key] = partial_states
+        else:
+            for i, agg in enumerate(self.aggregates):
+                states[i] = agg.merge(states[i], partial_states[i])
+
+    def spill(self) -> None:
+        if self.partitions is None:
+            self.partitions = [tempfile.TemporaryFile()
+                               for _ in range(self.num_partitions)]
+
+        batches: List[List[Tuple[tuple, List[Any]]]] = \
+            [[] for _ in range(self.num_partitions)]
+        for key, states in self.groups.items():
+            batches[hash((self.depth, key)) % self.num_partitions].append((key, states))
+        for f, batch in zip(self.partitions, batches):
+            pickle.dump(batch, f)
+
+        self.groups = {}
+        self.num_spills += 1
+
+    def results(self) -> Iterator[Tuple[tuple, List[Any]]]:
+        """(key, results) for every group"""
+        if self.partitions is None:
+            for key, states in self.groups.items():
+                yield key, [agg.result(state)
+                            for agg, state in zip(self.aggregates, states)]
+            return
+
+        self.spill()
+        for f in self.partitions:
+            partition = HashAggregator(self.aggregates, self.max_groups,
+                                       self.num_partitions, self.depth + 1)
+            f.seek(0)
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    break
+                for key, states in batch:
+                    partition.add_partial(key, states)
+            f.close()
+            yield from partition.results()
+
+def is_streamable(aggregates: Dict[str, Callable], having: Optional[Callable]) -> bool:
+    """Can we group without keeping every group's rows?"""
+    return (all(isinstance(agg, Aggregate) for agg in aggregates.values()) and
+            (having is None or isinstance(having, Predicate)))
+
+def group_results(keyed_rows: Iterable[Tuple[tuple, Row]],
+                  group_by_columns: List[str],
+                  aggregates: Dict[str, Callable],
+                  having: Optional[Callable],
+                  max_groups: int = MAX_GROUPS) -> Iterator[List[Any]]:
+    """
+    The values of each result row of a group_by, given (group key, row)
+    pairs. With only built-in Aggregates, and no having (or a
+    structured one, like col("num_users") > 1, which is checked against
+    each result row), this streams through the rows. Otherwise it has to
+    keep every group's rows, to pass to the aggregate functions (and to
+    having).
+    """
+    new_columns = group_by_columns + list(aggregates.keys())
+
+    if is_streamable(aggregates, having):
+        aggs = list(aggregates.values())
+        columns = [agg.column for agg in aggs]
+        aggregator = HashAggregator(aggs, max_groups)
+        for key, row in keyed_rows:
+            aggregator.add(key, [row[column] if column else None
+                                 for column in columns])
+        for key, results in aggregator.results():
+            new_row = list(key) + results
+            if having is None or having(dict(zip(new_columns, new_row))):
+                yield new_row
+        return
+
+    grouped_rows: Dict[tuple, List[Row]] = defaultdict(list)
+    for key, row in keyed_rows:
+        grouped_rows[key].append(row)
+
+    for key, group in grouped_rows.items():
+        if having is None or isinstance(having, Predicate) or having(group):
+            new_row = list(key)
+            for aggregate_fn in aggregates.values():
+                new_row.append(aggregate_fn(group))
+            if not isinstance(having, Predicate) or having(dict(zip(new_columns, new_row))):
+                yield new_row
+
+# Sorting. When only the first k rows of an ordering are wanted, a heap
+# of the best k so far finds them in O(n log k) time and O(k) memory,
+# instead of sorting all n rows. And when there are too many rows to sort
+# in memory, an external merge sort sorts them max_rows at a time, writes
+# each sorted "run" to a temporary file, and then merges the runs.
+
+import heapq
+
+# How many rows Sort will sort in memory before using temporary files.
+MAX_SORT_ROWS = 1000000
+
+def top_k(rows: Iterable[Row], k: int, order: Callable[[Row], Any]) -> List[Row]:
+    """
+    The first k rows in order, the same as sorted(rows, key=order)[:k]
+    (ties stay in their original order), using a heap of size k.
+    """
+    return heapq.nsmallest(k, rows, key=order)
+
+assert top_k([{"x": 3}, {"x": 1}, {"x": 2}, {"x": 1}], 2, lambda row: row["x"]) == \
+       [{"x": 1}, {"x": 1}]
+
+def read_run(f: Any) -> Iterator[Row]:
+    """The rows written to f by external_sort, a batch at a time"""
+    f.seek(0)
+    while True:
+        try:
+            batch = pickle.load(f)
+        except EOFError:
+            break
+        yield from batch
+    f.close()
+
+def external_sort(rows: Iterable[Row],
+                  order: Callable[[Row], Any],
+                  max_rows: int = MAX_SORT_ROWS,
+                  batch_size: int = 1000) -> Iterator[Row]:
+    """
+    The rows, sorted (stably) by order. If there are more than max_rows
+    of them, only max_rows are ever in memory at once (plus a batch from
+    each run while merging).
+    """
+    if max_rows < 1:
+        raise ValueError(f"max_rows must be at least 1, not {max_rows}")
+
+    rows = iter(rows)
+    chunk = list(itertools.islice(rows, max_rows))
+    if len(chunk) < max_rows:
+        yield from sorted(chunk, key=order)     # it all fits in memory
+        return
+
+    runs = []
+    while chunk:
+        chunk.sort(key=order)
+        f = tempfile.TemporaryFile()
+        for start in range(0, len(chunk), batch_size):
+            pickle.dump(chunk[start:start + batch_size], f)
+        runs.append(f)
+        chunk = list(itertools.islice(rows, max_rows))
+
+    # heapq.merge takes ties from earlier runs first, so it's stable too.
+    yield from heapq.merge(*[read_run(f) for f in runs], key=order)
+
+numbers = [{"x": x % 7, "i": i} for i, x in enumerate(range(100))]
+assert list(external_sort(numbers, lambda row: row["x"], max_rows=8)) == \
+       sorted(numbers, key=lambda row: row["x"])
+assert list(external_sort(numbers, lambda row: row["x"], max_rows=1)) == \
+       sorted(numbers, key=lambda row: row["x"])
+try:
+    list(external_sort(numbers, lambda row: row["x"], max_rows=0))
+    assert False, "max_rows=0 would drop every row"
+except ValueError:
+    pass
+
 class Table:
     def __init__(self, columns: List[str], types: List[type]) -> None:
         assert len(columns) == len(types), "# of columns must == # of types"
@@ -18,12 +548,13 @@ class Table:
         self.columns = columns         # Names of columns
         self.types = types             # Data types of columns
         self.rows: List[Row] = []      # (no data yet)
+        self.indexes: Dict[str, Any] = {}  # column -> HashIndex or SortedIndex
 
     def col2type(self, col: str) -> type:
         idx = self.columns.index(col)      # Find the index of the column,
         return self.types[idx]             # and return its type.
 
-    def insert(self, values: list) -> None:
+    def check_values(self, values: list) -> None:
         # Check for right # of values
         if len(values) != len(self.types):
             raise ValueError(f"You need to provide {len(self.types)} values")
@@ -33,9 +564,114 @@ class Table:
             if not isinstance(value, typ3) and value is not None:
                 raise TypeError(f"Expected type {typ3} but got {value}")
 
+    def insert(self, values: list) -> None:
+        self.check_values(values)
+
         # Add the corresponding dict as a "row"
         self.rows.append(dict(zip(self.columns, values)))
 
+        # And add it to the indexes
+        for column, index in self.indexes.items():
+            index.add(self.rows[-1][column], len(self.rows) - 1)
+
+    def check_batch(self, batch: List[list]) -> None:
+        """
+        Does check_values for a whole batch of rows, but a column at a
+        time: it only has to check each distinct type in a column once.
+        """
+        if set(map(len, batch)) - {len(self.types)}:
+            raise ValueError(f"You need to provide {len(self.types)} values")
+
+        for i, typ3 in enumerate(self.types):
+            for value_type in set(map(type, map(operator.itemgetter(i), batch))):
+                if value_type is not type(None) and not issubclass(value_type, typ3):
+                    value = next(values[i] for values in batch
+                                 if type(values[i]) is value_type)
+                    raise TypeError(f"Expected type {typ3} but got {value}")
+
+    def insert_many(self, batch: Iterable[list], validate: bool = True) -> None:
+        """
+        Inserts many rows' values at once. If they came out of tables that
+        already checked them (with the same column types), validate=False
+        skips checking them again.
+        """
+        batch = list(batch)
+        if validate:
+            self.check_batch(batch)    # (before inserting any of them)
+        columns = self.columns
+        self._append_rows([dict(zip(columns, values)) for values in batch])
+
+    def bulk_load(self, rows: Iterable[Row]) -> None:
+        """
+        Appends rows (dicts with this table's columns) without checking
+        them at all, so they'd better come from a table with the same
+        types. The table keeps the dicts themselves, so don't share them.
+        """
+        self._append_rows(rows)
+
+    def _append_rows(self, rows: Iterable[Row]) -> None:
+        start = len(self.rows)
+        self.rows.extend(rows)
+        for column, index in self.indexes.items():
+            for position in range(start, len(self.rows)):
+                index.add(self.rows[position][column], position)
+
+    def create_index(self, column: str, kind: str = "hash") -> None:
+        """
+        Indexes column, so that where/update/delete with a predicate like
+        col(column) == value (or, for a "sorted" index, col(column) < value
+        and so on) can find the matching rows without checking every row.
+        """
+        if column not in self.columns:
+            raise ValueError(f"invalid column: {column}")
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"unknown index kind: {kind}")
+
+        index = INDEX_KINDS[kind](column)
+        for position, row in enumerate(self.rows):
+            index.add(row[column], position)
+        self.indexes[column] = index
+
+    def _rebuild_indexes(self) -> None:
+        for column, index in list(self.indexes.items()):
+            self.create_index(column, "hash" if isinstance(index, HashIndex)
+                                      else "sorted")
+
+    def _index_lookup(self, predicate: WhereClause) -> Optional[List[int]]:
+        """
+        If the indexes can narrow down which rows might match predicate,
+        returns those rows' positions (in table order); otherwise None.
+        """
+        if isinstance(predicate, Comparison):
+            index = self.indexes.get(predicate.column)
+            if index is not None and predicate.op in index.operators:
+                return sorted(index.lookup(predicate.op, predicate.value))
+        elif isinstance(predicate, And):
+            # Either side narrows it down; use whichever does more.
+            candidates = [positions
+                          for positions in [self._index_lookup(predicate.left),
+                                            self._index_lookup(predicate.right)]
+                          if positions is not None]
+            if candidates:
+                return min(candidates, key=len)
+        elif isinstance(predicate, Or):
+            # Both sides have to be indexed, or we're checking every row anyway.
+            left = self._index_lookup(predicate.left)
+            right = self._index_lookup(predicate.right)
+            if left is not None and right is not None:
+                return sorted(set(left) | set(right))
+        return None
+
+    def _matching_positions(self, predicate: WhereClause) -> List[int]:
+        """The positions of the rows satisfying predicate, in table order"""
+        candidates = self._index_lookup(predicate)
+        if candidates is None:
+            candidates = range(len(self.rows))
+
+        # The index only narrows things down (e.g. for one side of an And),
+        # so we still check the whole predicate.
+        return [i for i in candidates if predicate(self.rows[i])]
+
     def __getitem__(self, idx: int) -> Row:
         return self.rows[idx]
 
@@ -51,10 +687,8 @@ class Table:
 
         return f"{self.columns}\n{rows}"
 
-    def update(self,
-               updates: Dict[str, Any],
-               predicate: WhereClause = lambda row: True):
-        # First make sure the updates have valid names and types
+    def check_updates(self, updates: Dict[str, Any]) -> None:
+        """Make sure the updates have valid names and types"""
         for column, new_value in updates.items():
             if column not in self.columns:
                 raise ValueError(f"invalid column: {column}")
@@ -63,15 +697,38 @@ class Table:
             if not isinstance(new_value, typ3) and new_value is not None:
                 raise TypeError(f"expected type {typ3}, but got {new_value}")
 
+    def update(self,
+               updates: Dict[str, Any],
+               predicate: WhereClause = lambda row: True):
+        # First make sure the updates have valid names and types
+        self.check_updates(updates)
+
         # Now update
-        for row in self.rows:
-            if predicate(row):
-                for column, new_value in updates.items():
-                    row[column] = new_value
+        self._update_positions(self._matching_positions(predicate), updates)
+
+    def _update_positions(self, positions: List[int], updates: Dict[str, Any]) -> None:
+        # (and move the updated rows within the indexes)
+        for position in positions:
+            row = self.rows[position]
+            for column, new_value in updates.items():
+                if column in self.indexes:
+                    self.indexes[column].remove(row[column], position)
+                    self.indexes[column].add(new_value, position)
+                row[column] = new_value
 
     def delete(self, predicate: WhereClause = lambda row: True) -> None:
         """Delete all rows matching predicate"""
-        self.rows = [row for row in self.rows if not predicate(row)]
+        self._delete_positions(self._matching_positions(predicate))
+
+    def _delete_positions(self, positions: List[int]) -> None:
+        deleted = set(positions)
+        if deleted:
+            self.rows = [row for i, row in enumerate(self.rows)
+                         if i not in deleted]
+
+            # Every row after a deleted one has moved, so it's simplest to
+            # rebuild the indexes, which costs about the same as the delete.
+            self._rebuild_indexes()
 
     def select(self,
                keep_columns: List[str] = None,
@@ -95,68 +752,84 @@ class Table:
         # Create a new table for results
         new_table = Table(new_columns, keep_types + add_types)
 
+        new_rows = []
         for row in self.rows:
             new_row = [row[column] for column in keep_columns]
             for column_name, calculation in additional_columns.items():
                 new_row.append(calculation(row))
-            new_table.insert(new_row)
+            new_rows.append(new_row)
+
+        # The kept values were checked when they went into this table,
+        # so only calculated ones need checking.
+        new_table.insert_many(new_rows, validate=bool(additional_columns))
 
         return new_table
 
     def where(self, predicate: WhereClause = lambda row: True) -> 'Table':
         """Return only the rows that satisfy the supplied predicate"""
         where_table = Table(self.columns, self.types)
-        for row in self.rows:
-            if predicate(row):
-                values = [row[column] for column in self.columns]
-                where_table.insert(values)
+        where_table.bulk_load([self.rows[position].copy()
+                               for position in self._matching_positions(predicate)])
         return where_table
 
     def limit(self, num_rows: int) -> 'Table':
         """Return only the first `num_rows` rows"""
         limit_table = Table(self.columns, self.types)
-        for i, row in enumerate(self.rows):
-            if i >= num_rows:
-                break
-            values = [row[column] for column in self.columns]
-            limit_table.insert(values)
+        limit_table.bulk_load([row.copy() for row in self.rows[:num_rows]])
         return limit_table
 
     def group_by(self,
                  group_by_columns: List[str],
                  aggregates: Dict[str, Callable],
-                 having: HavingClause = lambda group: True) -> 'Table':
-
-        grouped_rows = defaultdict(list)
-
-        # Populate groups
-        for row in self.rows:
-            key = tuple(row[column] for column in group_by_columns)
-            grouped_rows[key].append(row)
+                 having: Optional[HavingClause] = None,
+                 max_groups: int = MAX_GROUPS) -> 'Table':
+        """
+        The aggregates can be Aggregates (like Count() or Avg("x")), or
+        any function of a group's list of rows. having can be a function
+        of the list of rows too, or a Predicate on the result row.
+        If there are more than max_groups groups, the built-in Aggregates
+        spill to disk, and then the groups come out in no particular order.
+        """
+        keyed_rows = ((tuple(row[column] for column in group_by_columns), row)
+                      for row in self.rows)
 
         # Result table consists of group_by columns and aggregates
         new_columns = group_by_columns + list(aggregates.keys())
         group_by_types = [self.col2type(col) for col in group_by_columns]
-        aggregate_types = [agg.__annotations__['return']
+        column_types = dict(zip(self.columns, self.types))
+        aggregate_types = [aggregate_type(agg, column_types)
                            for agg in aggregates.values()]
         result_table = Table(new_columns, group_by_types + aggregate_types)
-
-        for key, rows in grouped_rows.items():
-            if having(rows):
-                new_row = list(key)
-                for aggregate_name, aggregate_fn in aggregates.items():
-                    new_row.append(aggregate_fn(rows))
-                result_table.insert(new_row)
+        result_table.insert_many(group_results(keyed_rows, group_by_columns,
+                                               aggregates, having, max_groups))
 
         return result_table
 
-    def order_by(self, order: Callable[[Row], Any]) -> 'Table':
+    def order_by(self, order: Callable[[Row], Any], limit: int = None) -> 'Table':
+        """
+        With a limit, order_by(order, limit=k) is order_by(order).limit(k),
+        but only keeps k rows (in a heap) instead of sorting them all.
+        """
+        if limit is not None:
+            new_table = Table(self.columns, self.types)
+            new_table.bulk_load([row.copy() for row in top_k(self.rows, limit, order)])
+            return new_table
+
         new_table = self.select()       # make a copy
         new_table.rows.sort(key=order)
         return new_table
 
-    def join(self, other_table: 'Table', left_join: bool = False) -> 'Table':
-
+    def join(self,
+             other_table: 'Table',
+             left_join: bool = False,
+             strategy: str = "auto") -> 'Table':
+        """
+        Joins on all the columns the two tables have in common. strategy
+        is "hash", "merge" (for tables that are both sorted by the join
+        columns), "nested_loop", or "auto" to pick one based on the tables.
+        Whichever it uses, the result has the same rows in the same order:
+        each left row's matches, in right-table order.
+        """
         join_on_columns = [c for c in self.columns           # columns in
                            if c in other_table.columns]      # both tables
 
@@ -170,24 +843,1717 @@ class Table:
 
         join_table = Table(new_columns, new_types)
 
-        for row in self.rows:
-            def is_join(other_row):
-                return all(other_row[c] == row[c] for c in join_on_columns)
-
-            other_rows = other_table.where(is_join).rows
+        matches = find_join_matches(self.rows, other_table.rows,
+                                    join_on_columns, strategy)
 
+        # Every value already passed the type checks when it was inserted
+        # into one of the two tables, so we can bulk_load the result rows.
+        new_rows = []
+        for row, other_rows in zip(self.rows, matches):
             # Each other row that matches this one produces a result row.
             for other_row in other_rows:
-                join_table.insert([row[c] for c in self.columns] +
-                                  [other_row[c] for c in additional_columns])
+                new_row = dict(row)
+                for c in additional_columns:
+                    new_row[c] = other_row[c]
+                new_rows.append(new_row)
 
             # If no rows match and it's a left join, output with Nones.
             if left_join and not other_rows:
-                join_table.insert([row[c] for c in self.columns] +
-                                  [None for c in additional_columns])
+                new_row = dict(row)
+                for c in additional_columns:
+                    new_row[c] = None
+                new_rows.append(new_row)
 
+        join_table.bulk_load(new_rows)
         return join_table
 
+    def query(self) -> 'Query':
+        """A lazily evaluated Query over this table (see Query, below)"""
+        return Query(Scan(self))
+
+# The join strategies. Each one returns, for every left row (in order),
+# the right rows that it joins with (in right-table order).
+
+Matches = List[Sequence[Row]]
+
+def join_key(columns: List[str]) -> Callable[[Row], Any]:
+    """A function that pulls a row's join columns out as a hashable key"""
+    if not columns:
+        return lambda row: ()                 # cross join: everything matches
+    return operator.itemgetter(*columns)      # (one column => just its value)
+
+def nested_loop_join(left_rows: List[Row],
+                     right_rows: List[Row],
+                     columns: List[str]) -> Matches:
+    """Compares every pair of rows. O(n * m), but works for any values."""
+    return [[right_row for right_row in right_rows
+             if all(right_row[c] == row[c] for c in columns)]
+            for row in left_rows]
+
+def hash_join(left_rows: List[Row],
+              right_rows: List[Row],
+              columns: List[str]) -> Matches:
+    """
+    Builds a hash table (a dict from join key to rows) on the smaller
+    table, then looks up each row of the larger one. O(n + m) (plus the
+    size of the output), but the join values have to be hashable.
+    """
+    key = join_key(columns)
+
+    if len(right_rows) <= len(left_rows):
+        # Build on the right, probe with each left row.
+        right_by_key: Dict[Any, List[Row]] = defaultdict(list)
+        for right_row in right_rows:
+            right_by_key[key(right_row)].append(right_row)
+
+        no_matches: Sequence[Row] = ()
+        return [right_by_key.get(key(row), no_matches) for row in left_rows]
+    else:
+        # Build on the left, and stream the right rows past it.
+        left_positions: Dict[Any, List[int]] = defaultdict(list)
+        for i, row in enumerate(left_rows):
+            left_positions[key(row)].append(i)
+
+        matches: Dict[int, List[Row]] = defaultdict(list)
+        for right_row in right_rows:
+            for i in left_positions.get(key(right_row), ()):
+                matches[i].append(right_row)
+
+        return [matches.get(i, ()) for i in range(len(left_rows))]
+
+def is_sorted_by(rows: List[Row], columns: List[str]) -> bool:
+    """Are the rows in (non-decreasing) order of their join columns?"""
+    key = join_key(columns)
+    keys = map(key, rows)
+    try:
+        return all(k1 <= k2 for k1, k2 in zip(keys, map(key, rows[1:])))
+    except TypeError:      # e.g. None < 1; such keys can't be merged
+        return False
+
+def merge_join(left_rows: List[Row],
+               right_rows: List[Row],
+               columns: List[str]) -> Matches:
+    """
+    Walks the two tables side by side, which only works if both are
+    sorted by the join columns. O(n + m), and no hash table needed.
+    """
+    assert is_sorted_by(left_rows, columns) and is_sorted_by(right_rows, columns), \
+        "merge join requires both tables to be sorted by the join columns"
+
+    key = join_key(columns)
+    right_keys = [key(right_row) for right_row in right_rows]
+
+    matches: Matches = []
+    start = end = 0         # right_rows[start:end] are the ones with key k
+    k = None
+    for row in left_rows:
+        if matches and key(row) == k:
+            # Same key as the previous left row, so same matches.
+            matches.append(matches[-1])
+            continue
+
+        k = key(row)
+        start = end
+        while start < len(right_keys) and right_keys[start] < k:
+            start += 1
+        end = start
+        while end < len(right_keys) and right_keys[end] == k:
+            end += 1
+        matches.append(right_rows[start:end])
+
+    return matches
+
+JOIN_STRATEGIES = {"nested_loop": nested_loop_join,
+                   "hash": hash_join,
+                   "merge": merge_join}
+
+def find_join_matches(left_rows: List[Row],
+                      right_rows: List[Row],
+                      columns: List[str],
+                      strategy: str = "auto") -> Matches:
+    if strategy != "auto":
+        if strategy not in JOIN_STRATEGIES:
+            raise ValueError(f"unknown join strategy: {strategy}")
+        return JOIN_STRATEGIES[strategy](left_rows, right_rows, columns)
+
+    # Tiny tables: not worth building anything.
+    if len(left_rows) * len(right_rows) <= 64:
+        return nested_loop_join(left_rows, right_rows, columns)
+
+    # Already sorted (say, by an id column): merge them.
+    if is_sorted_by(left_rows, columns) and is_sorted_by(right_rows, columns):
+        return merge_join(left_rows, right_rows, columns)
+
+    # Otherwise hash (on the smaller table), unless the values can't be hashed.
+    try:
+        return hash_join(left_rows, right_rows, columns)
+    except TypeError:
+        return nested_loop_join(left_rows, right_rows, columns)
+
+# A row store keeps every row as its own dict, which is convenient but
+# costs a dict (and its hash table) per row, and means that looking at one
+# column touches every row. A ColumnarTable instead keeps one sequence per
+# column: int and float columns are (compact, unboxed) arrays, and strings
+# are interned so repeated values share one object. Rows only get built
+# as dicts when someone asks for them.
+
+COLUMN_TYPECODES = {int: 'q', float: 'd'}
+
+class ColumnarTable(Table):
+    """
+    A Table stored column by column. It supports the same operations as
+    Table (and returns ColumnarTables), but rows you get from it (by
+    indexing, iterating, or .rows) are freshly built dicts, so changing
+    them doesn't change the table. Use update() for that.
+    """
+    def __init__(self, columns: List[str], types: List[type]) -> None:
+        assert len(columns) == len(types), "# of columns must == # of types"
+
+        self.columns = columns
+        self.types = types
+        self.data = {column: self._empty_column(typ3)
+                     for column, typ3 in zip(columns, types)}
+        self.num_rows = 0
+        self.indexes: Dict[str, Any] = {}
+
+    @staticmethod
+    def _empty_column(typ3: type) -> Sequence:
+        typecode = COLUMN_TYPECODES.get(typ3)
+        return array(typecode) if typecode else []
+
+    def _column_like(self, column: str, values: Iterable[Any]) -> Sequence:
+        """A new sequence of values, stored the way `column` is"""
+        if isinstance(self.data[column], array):
+            return array(self.data[column].typecode, values)
+        return list(values)
+
+    # None (or an int too big for 64 bits) doesn't fit in an array, so a
+    # column that gets one has to become a list.
+
+    def _set(self, column: str, position: int, value: Any) -> None:
+        try:
+            self.data[column][position] = value
+        except (TypeError, OverflowError):
+            self.data[column] = self.data[column].tolist()
+            self.data[column][position] = value
+
+    def _append(self, column: str, value: Any) -> None:
+        if isinstance(value, str):
+            value = sys.intern(value)
+        try:
+            self.data[column].append(value)
+        except (TypeError, OverflowError):
+            self.data[column] = self.data[column].tolist()
+            self.data[column].append(value)
+
+    def _extend(self, column: str, values: List[Any]) -> None:
+        values = [sys.intern(value) if isinstance(value, str) else value
+                  for value in values]
+        existing = self.data[column]
+        if isinstance(existing, array):
+            # (Build the array first, so a bad value doesn't leave the
+            # column half extended.)
+            try:
+                existing.extend(array(existing.typecode, values))
+                return
+            except (TypeError, OverflowError):
+                self.data[column] = existing = existing.tolist()
+        existing.extend(values)
+
+    def insert(self, values: list) -> None:
+        self.check_values(values)
+
+        for column, value in zip(self.columns, values):
+            self._append(column, value)
+            if column in self.indexes:
+                self.indexes[column].add(self.data[column][-1], self.num_rows)
+
+        self.num_rows += 1
+
+    def insert_many(self, batch: Iterable[list], validate: bool = True) -> None:
+        batch = list(batch)
+        if validate:
+            self.check_batch(batch)
+
+        start = self.num_rows
+        for i, column in enumerate(self.columns):
+            self._extend(column, list(map(operator.itemgetter(i), batch)))
+            if column in self.indexes:
+                for position in range(start, start + len(batch)):
+                    self.indexes[column].add(self.data[column][position], position)
+
+        self.num_rows += len(batch)
+
+    def bulk_load(self, rows: Iterable[Row]) -> None:
+        columns = self.columns
+        self.insert_many([[row[column] for column in columns] for row in rows],
+                         validate=False)
+
+    def _row(self, position: int) -> Row:
+        return {column: self.data[column][position] for column in self.columns}
+
+    @property
+    def rows(self) -> List[Row]:            # type: ignore
+        return list(self)
+
+    def __getitem__(self, idx: int) -> Row:
+        if idx < 0:
+            idx += self.num_rows
+        if not 0 <= idx < self.num_rows:
+            raise IndexError("table index out of range")
+        return self._row(idx)
+
+    def __iter__(self) -> Iterator[Row]:
+        columns = self.columns
+        if not columns:
+            return iter([{} for _ in range(self.num_rows)])
+        return (dict(zip(columns, values))
+                for values in zip(*[self.data[column] for column in columns]))
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def create_index(self, column: str, kind: str = "hash") -> None:
+        if column not in self.columns:
+            raise ValueError(f"invalid column: {column}")
+        if kind not in INDEX_KINDS:
+            raise ValueError(f"unknown index kind: {kind}")
+
+        index = INDEX_KINDS[kind](column)
+        for position, value in enumerate(self.data[column]):
+            index.add(value, position)
+        self.indexes[column] = index
+
+    def _evaluate(self,
+                  predicate: WhereClause,
+                  positions: Optional[List[int]]) -> List[int]:
+        """
+        Which of positions (or of all rows, if positions is None) satisfy
+        predicate? Structured predicates get evaluated a column at a time;
+        anything else gets called on each (materialized) row.
+        """
+        all_positions = range(self.num_rows)
+
+        if isinstance(predicate, Comparison):
+            values = self.data[predicate.column]
+            if isinstance(values, array) and predicate.value is not None:
+                # An array can't contain None, so the comparison is just
+                # the operator, and map runs it without any Python code.
+                test = map(predicate.compare, values, itertools.repeat(predicate.value))
+            else:
+                test = map(predicate.matches, values)
+
+            if positions is None:
+                return list(itertools.compress(all_positions, test))
+            else:
+                values_at = map(values.__getitem__, positions)
+                return [i for i, value in zip(positions, values_at)
+                        if predicate.matches(value)]
+
+        elif isinstance(predicate, And):
+            return self._evaluate(predicate.right,
+                                  self._evaluate(predicate.left, positions))
+        elif isinstance(predicate, Or):
+            either = set(self._evaluate(predicate.left, positions))
+            either.update(self._evaluate(predicate.right, positions))
+            return sorted(either)
+        elif isinstance(predicate, Not):
+            matching = set(self._evaluate(predicate.predicate, positions))
+            return [i for i in (all_positions if positions is None else positions)
+                    if i not in matching]
+        else:
+            if positions is None:
+                return [i for i, row in enumerate(self) if predicate(row)]
+            return [i for i in positions if predicate(self._row(i))]
+
+    def _matching_positions(self, predicate: WhereClause) -> List[int]:
+        return self._evaluate(predicate, self._index_lookup(predicate))
+
+    def _take(self, positions: Sequence[int],
+              columns: List[str] = None) -> 'ColumnarTable':
+        """A new table with just the rows at positions (and just columns)"""
+        if columns is None:
+            columns = self.columns
+
+        new_table = ColumnarTable(columns, [self.col2type(c) for c in columns])
+        for column in columns:
+            values = self.data[column]
+            if isinstance(positions, range) and positions.step == 1:
+                new_table.data[column] = values[positions.start:positions.stop]
+            else:
+                new_table.data[column] = self._column_like(
+                    column, map(values.__getitem__, positions))
+        new_table.num_rows = len(positions)
+        return new_table
+
+    def _update_positions(self, positions: List[int], updates: Dict[str, Any]) -> None:
+        for column, new_value in updates.items():
+            if isinstance(new_value, str):
+                new_value = sys.intern(new_value)
+            index = self.indexes.get(column)
+            for position in positions:
+                if index is not None:
+                    index.remove(self.data[column][position], position)
+                    index.add(new_value, position)
+                self._set(column, position, new_value)
+
+    def _delete_positions(self, positions: List[int]) -> None:
+        deleted = set(positions)
+        if deleted:
+            kept = [i for i in range(self.num_rows) if i not in deleted]
+            self.data = self._take(kept).data
+            self.num_rows = len(kept)
+            self._rebuild_indexes()
+
+    def select(self,
+               keep_columns: List[str] = None,
+               additional_columns: Dict[str, Callable] = None) -> 'Table':
+        if keep_columns is None:
+            keep_columns = self.columns
+        if additional_columns is None:
+            additional_columns = {}
+
+        # Kept columns get copied whole...
+        new_table = self._take(range(self.num_rows), keep_columns)
+
+        # ...but calculated ones need each row as a dict.
+        for column_name, calculation in additional_columns.items():
+            typ3 = calculation.__annotations__['return']
+            values = [calculation(row) for row in self]
+            for value in values:
+                if not isinstance(value, typ3) and value is not None:
+                    raise TypeError(f"Expected type {typ3} but got {value}")
+
+            new_table.columns = new_table.columns + [column_name]
+            new_table.types = new_table.types + [typ3]
+            new_table.data[column_name] = new_table._empty_column(typ3)
+            new_table._extend(column_name, values)
+
+        return new_table
+
+    def where(self, predicate: WhereClause = lambda row: True) -> 'Table':
+        return self._take(self._matching_positions(predicate))
+
+    def limit(self, num_rows: int) -> 'Table':
+        return self._take(range(min(num_rows, self.num_rows)))
+
+    def group_by(self,
+                 group_by_columns: List[str],
+                 aggregates: Dict[str, Callable],
+                 having: Optional[HavingClause] = None,
+                 max_groups: int = MAX_GROUPS) -> 'Table':
+        # The group keys come straight from the group_by columns.
+        if group_by_columns:
+            keys: Iterable[tuple] = zip(*[self.data[c] for c in group_by_columns])
+        else:
+            keys = itertools.repeat((), self.num_rows)
+
+        # Built-in Aggregates only need the columns they aggregate, so
+        # we hand them just those. (Other aggregates and having want lists
+        # of rows, so then we build each row once here, as we go.)
+        rows: Iterable[Row] = self
+        if is_streamable(aggregates, having):
+            needed = list({agg.column: None for agg in aggregates.values() if agg.column})
+            rows = (dict(zip(needed, values))
+                    for values in zip(*[self.data[c] for c in needed]))
+            if not needed:
+                rows = itertools.repeat({}, self.num_rows)
+
+        new_columns = group_by_columns + list(aggregates.keys())
+        group_by_types = [self.col2type(col) for col in group_by_columns]
+        column_types = dict(zip(self.columns, self.types))
+        aggregate_types = [aggregate_type(agg, column_types)
+                           for agg in aggregates.values()]
+        result_table = ColumnarTable(new_columns, group_by_types + aggregate_types)
+        result_table.insert_many(group_results(zip(keys, rows), group_by_columns,
+                                               aggregates, having, max_groups))
+
+        return result_table
+
+    def order_by(self, order: Callable[[Row], Any], limit: int = None) -> 'Table':
+        # sorted is stable, just like the row store's list.sort
+        keys = [order(row) for row in self]
+        if limit is not None:
+            return self._take(heapq.nsmallest(limit, range(self.num_rows),
+                                              key=keys.__getitem__))
+        return self._take(sorted(range(self.num_rows), key=keys.__getitem__))
+
+# Every Table method above builds a whole new Table, so a chain like
+# users.where(...).select(...).limit(10) copies (and type-checks) every
+# matching row twice, only to throw most of them away. table.query()
+# instead returns a Query, which just records the operations as a plan:
+# a tree of PlanNodes, with a Scan of the table at the bottom. Nothing
+# runs until you iterate over the query (or call .execute()), and then
+# only after optimize() has rewritten the plan:
+#
+#  * adjacent Filters (and adjacent Limits) get fused into one,
+#  * Filters get pushed down (below Sorts, Projects, and Joins) as far
+#    as they can go, ending up in the Scan where they can use an index,
+#  * Limits get pushed below Projects, so additional columns only get
+#    computed for rows that are actually returned,
+#  * and Scans only produce the columns that something above them needs.
+#
+# Each node produces its rows with a generator that pulls rows from its
+# child as it needs them, so a Limit stops the whole pipeline as soon as
+# it has enough rows.
+#
+# Only structured predicates (made with col) can be moved past Projects
+# and Joins, or used to prune columns; a lambda could look at any column.
+
+def predicate_columns(predicate: WhereClause) -> Optional[Set[str]]:
+    """The columns predicate looks at, or None if we can't tell"""
+    if isinstance(predicate, Comparison):
+        return {predicate.column}
+    elif isinstance(predicate, (And, Or)):
+        left = predicate_columns(predicate.left)
+        right = predicate_columns(predicate.right)
+        return None if left is None or right is None else left | right
+    elif isinstance(predicate, Not):
+        return predicate_columns(predicate.predicate)
+    # Other predicates can list the columns they use in a `columns` attribute.
+    return getattr(predicate, "columns", None)
+
+def conjuncts(predicate: WhereClause) -> List[WhereClause]:
+    """The parts of predicate that all have to be true"""
+    if isinstance(predicate, And):
+        return conjuncts(predicate.left) + conjuncts(predicate.right)
+    return [predicate]
+
+def all_of(predicates: List[WhereClause]) -> WhereClause:
+    """The And of predicates"""
+    result = predicates[0]
+    for predicate in predicates[1:]:
+        result = And(result, predicate)
+    return result
+
+class PlanNode:
+    columns: List[str]
+    types: List[type]
+    children: List['PlanNode'] = []
+
+    def rows(self) -> Iterator[Row]:
+        raise NotImplementedError
+
+    def with_children(self, children: List['PlanNode']) -> 'PlanNode':
+        """A copy of this node, with different children"""
+        raise NotImplementedError
+
+    def description(self) -> str:
+        raise NotImplementedError
+
+    def explain(self, depth: int = 0) -> str:
+        lines = ["  " * depth + self.description()]
+        lines.extend(child.explain(depth + 1) for child in self.children)
+        return "\n".join(lines)
+
+class Scan(PlanNode):
+    def __init__(self,
+                 table: Table,
+                 predicate: WhereClause = None,
+                 columns: List[str] = None) -> None:
+        self.table = table
+        self.predicate = predicate
+        self.columns = columns if columns is not None else table.columns
+        self.types = [table.col2type(column) for column in self.columns]
+
+    def rows(self) -> Iterator[Row]:
+        table, predicate = self.table, self.predicate
+        pruned = self.columns != table.columns
+
+        candidates = None if predicate is None else table._index_lookup(predicate)
+        if (isinstance(table, PersistentTable) and not table.loaded and
+                predicate is not None):
+            # Only read the pages that might have matching rows.
+            source: Iterator[Row] = table.scan(predicate)
+            predicate = None
+        elif candidates is not None:
+            source = (table[i] for i in candidates)
+        elif pruned and isinstance(table, ColumnarTable):
+            # Only build the columns we need. (They include the
+            # predicate's columns; see prune_columns.)
+            columns = self.columns
+            source = (dict(zip(columns, values))
+                      for values in zip(*[table.data[c] for c in columns]))
+            pruned = False
+        else:
+            source = iter(table)
+
+        if predicate is not None:
+            source = filter(predicate, source)
+        if pruned:
+            source = ({column: row[column] for column in self.columns}
+                      for row in source)
+        return source
+
+    def with_children(self, children: List[PlanNode]) -> PlanNode:
+        return self
+
+    def description(self) -> str:
+        description = f"Scan {len(self.table)} rows {self.columns}"
+        if self.predicate is not None:
+            description += f" where {describe(self.predicate)}"
+            if self.table._index_lookup(self.predicate) is not None:
+                description += " (using index)"
+        return description
+
+class Filter(PlanNode):
+    def __init__(self, child: PlanNode, predicate: WhereClause) -> None:
+        self.children = [child]
+        self.predicate = predicate
+        self.columns, self.types = child.columns, child.types
+
+    def rows(self) -> Iterator[Row]:
+        return filter(self.predicate, self.children[0].rows())
+
+    def with_children(self, children: List[PlanNode]) -> PlanNode:
+        return Filter(children[0], self.predicate)
+
+    def description(self) -> str:
+        return f"Filter {describe(self.predicate)}"
+
+class Project(PlanNode):
+    def __init__(self,
+                 child: PlanNode,
+                 keep_columns: List[str],
+                 additional_columns: Dict[str, Callable]) -> None:
+        self.children = [child]
+        self.keep_columns = keep_columns
+        self.additional_columns = additional_columns
+
+        child_types = dict(zip(child.columns, child.types))
+        for column in keep_columns:
+            if column not in child_types:
+                raise ValueError(f"invalid column: {column}")
+        self.columns = keep_columns + list(additional_columns.keys())
+        self.types = ([child_types[column] for column in keep_columns] +
+                      [calculation.__annotations__['return']
+                       for calculation in additional_columns.values()])
+
+    def rows(self) -> Iterator[Row]:
+        add_types = self.types[len(self.keep_columns):]
+        for row in self.children[0].rows():
+            new_row = {column: row[column] for column in self.keep_columns}
+            for (name, calculation), typ3 in zip(self.additional_columns.items(),
+                                                 add_types):
+                value = calculation(row)
+                if not isinstance(value, typ3) and value is not None:
+                    raise TypeError(f"Expected type {typ3} but got {value}")
+                new_row[name] = value
+            yield new_row
+
+    def with_children(self, children: List[PlanNode]) -> PlanNode:
+        return Project(children[0], self.keep_columns, self.additional_columns)
+
+    def description(self) -> str:
+        description = f"Project {self.keep_columns}"
+        if self.additional_columns:
+            calculations = ", ".join(f"{name}={describe(calculation)}"
+                                     for name, calculation
+                                     in self.additional_columns.items())
+            description += f" + {calculations}"
+        return description
+
+class Limit(PlanNode):
+    def __init__(self, child: PlanNode, num_rows: int) -> None:
+        self.children = [child]
+        self.num_rows = num_rows
+        self.columns, self.types = child.columns, child.types
+
+    def rows(self) -> Iterator[Row]:
+        # islice stops pulling from the child once it has num_rows rows.
+        return itertools.islice(self.children[0].rows(), self.num_rows)
+
+    def with_children(self, children: List[PlanNode]) -> PlanNode:
+        return Limit(children[0], self.num_rows)
+
+    def description(self) -> str:
+        return f"Limit {self.num_rows}"
+
+class Sort(PlanNode):
+    def __init__(self,
+                 child: PlanNode,
+                 order: Callable[[Row], Any],
+                 max_rows: int = MAX_SORT_ROWS) -> None:
+        if max_rows < 1:
+            raise ValueError(f"max_rows must be at least 1, not {max_rows}")
+        self.children = [child]
+        self.order = order
+        self.max_rows = max_rows
+        self.columns, self.types = child.columns, child.types
+
+    def rows(self) -> Iterator[Row]:
+        return external_sort(self.children[0].rows(), self.order, self.max_rows)
+
+    def with_children(self, children: List[PlanNode]) -> PlanNode:
+        return Sort(children[0], self.order, self.max_rows)
+
+    def description(self) -> str:
+        return f"Sort by {describe(self.order)}"
+
+class TopK(PlanNode):
+    """Sort followed by Limit, done with a heap"""
+    def __init__(self, child: PlanNode, order: Callable[[Row], Any], k: int) -> None:
+        self.children = [child]
+        self.order = order
+        self.k = k
+        self.columns, self.types = child.columns, child.types
+
+    def rows(self) -> Iterator[Row]:
+        return iter(top_k(self.children[0].rows(), self.k, self.order))
+
+    def with_children(self, children: List[PlanNode]) -> PlanNode:
+        return TopK(children[0], self.order, self.k)
+
+    def description(self) -> str:
+        return f"TopK {self.k} by {describe(self.order)}"
+
+class GroupBy(PlanNode):
+    def __init__(self,
+                 child: PlanNode,
+                 group_by_columns: List[str],
+                 aggregates: Dict[str, Callable],
+                 having: Optional[HavingClause] = None) -> None:
+        self.children = [child]
+        self.group_by_columns = group_by_columns
+        self.aggregates = aggregates
+        self.having = having
+
+        child_types = dict(zip(child.columns, child.types))
+        self.columns = group_by_columns + list(aggregates.keys())
+        self.types = ([child_types[column] for column in group_by_columns] +
+                      [aggregate_type(agg, child_types) for agg in aggregates.values()])
+
+    def rows(self) -> Iterator[Row]:
+        keyed_rows = ((tuple(row[column] for column in self.group_by_columns), row)
+                      for row in self.children[0].rows())
+        for new_row in group_results(keyed_rows, self.group_by_columns,
+                                     self.aggregates, self.having):
+            yield dict(zip(self.columns, new_row))
+
+    def with_children(self, children: List[PlanNode]) -> PlanNode:
+        return GroupBy(children[0], self.group_by_columns,
+                       self.aggregates, self.having)
+
+    def description(self) -> str:
+        aggregates = ", ".join(f"{name}={describe(agg)}"
+                               for name, agg in self.aggregates.items())
+        description = f"GroupBy {self.group_by_columns} {aggregates}"
+        if self.having is not None:
+            description += f" having {describe(self.having)}"
+        return description
+
+class Join(PlanNode):
+    def __init__(self, left: PlanNode, right: PlanNode, left_join: bool) -> None:
+        self.children = [left, right]
+        self.left_join = left_join
+
+        self.join_on_columns = [c for c in left.columns if c in right.columns]
+        self.additional_columns = [c for c in right.columns
+                                   if c not in self.join_on_columns]
+        right_types = dict(zip(right.columns, right.types))
+        self.columns = left.columns + self.additional_columns
+        self.types = left.types + [right_types[c] for c in self.additional_columns]
+
+    def rows(self) -> Iterator[Row]:
+        left_rows = list(self.children[0].rows())
+        right_rows = list(self.children[1].rows())
+        matches = find_join_matches(left_rows, right_rows, self.join_on_columns)
+
+        for row, other_rows in zip(left_rows, matches):
+            for other_row in other_rows:
+                new_row = dict(row)
+                for c in self.additional_columns:
+                    new_row[c] = other_row[c]
+                yield new_row
+            if self.left_join and not other_rows:
+                new_row = dict(row)
+                for c in self.additional_columns:
+                    new_row[c] = None
+                yield new_row
+
+    def with_children(self, children: List[PlanNode]) -> PlanNode:
+        return Join(children[0], children[1], self.left_join)
+
+    def description(self) -> str:
+        kind = "LeftJoin" if self.left_join else "Join"
+        return f"{kind} on {self.join_on_columns}"
+
+def rewrite(node: PlanNode) -> Optional[PlanNode]:
+    """Applies one optimization to node, if one applies; otherwise None"""
+    if isinstance(node, Filter):
+        child = node.children[0]
+        predicate = node.predicate
+        columns = predicate_columns(predicate)
+
+        # Filter(Filter) => one Filter that checks both.
+        if isinstance(child, Filter):
+            return Filter(child.children[0], And(child.predicate, predicate))
+
+        # Filter(Scan) => a Scan that filters (and maybe uses an index).
+        if isinstance(child, Scan):
+            if child.predicate is not None:
+                predicate = And(child.predicate, predicate)
+            return Scan(child.table, predicate, child.columns)
+
+        # Sorting doesn't change which rows there are, so filter first
+        # and sort fewer of them.
+        if isinstance(child, Sort):
+            return child.with_children([Filter(child.children[0], predicate)])
+
+        # A Project only renames / adds columns, so a filter that only looks
+        # at kept columns can go below it.
+        if (isinstance(child, Project) and columns is not None and
+                columns <= set(child.keep_columns)):
+            return child.with_children([Filter(child.children[0], predicate)])
+
+        # A filter on just the left table's columns can happen before the
+        # join; so can one on just the right table's, unless it's a left join.
+        # For an And, that goes for each of its parts separately.
+        if isinstance(child, Join):
+            left, right = child.children
+            left_parts, right_parts, rest = [], [], []
+            for part in conjuncts(predicate):
+                part_columns = predicate_columns(part)
+                if part_columns is not None and part_columns <= set(left.columns):
+                    left_parts.append(part)
+                elif (part_columns is not None and part_columns <= set(right.columns)
+                      and not child.left_join):
+                    right_parts.append(part)
+                else:
+                    rest.append(part)
+            if left_parts or right_parts:
+                if left_parts:
+                    left = Filter(left, all_of(left_parts))
+                if right_parts:
+                    right = Filter(right, all_of(right_parts))
+                joined = child.with_children([left, right])
+                return Filter(joined, all_of(rest)) if rest else joined
+
+    if isinstance(node, Limit):
+        child = node.children[0]
+
+        # Limit(Limit) => the smaller limit.
+        if isinstance(child, Limit):
+            return Limit(child.children[0], min(node.num_rows, child.num_rows))
+
+        # Limit(Sort) => just the first rows, without sorting all of them.
+        if isinstance(child, Sort):
+            return TopK(child.children[0], child.order, node.num_rows)
+        if isinstance(child, TopK):
+            return TopK(child.children[0], child.order, min(node.num_rows, child.k))
+
+        # Project doesn't change the number of rows, so take the first
+        # rows before computing any additional columns.
+        if isinstance(child, Project):
+            return child.with_children([Limit(child.children[0], node.num_rows)])
+
+    if isinstance(node, Project):
+        child = node.children[0]
+
+        # Project(Project) => one Project, if the outer one just picks
+        # (in order) some of the inner one's columns.
+        if isinstance(child, Project) and not node.additional_columns:
+            keep = [c for c in node.keep_columns if c in child.keep_columns]
+            additional = {c: child.additional_columns[c]
+                          for c in node.keep_columns
+                          if c in child.additional_columns}
+            if keep + list(additional) == node.keep_columns:
+                return Project(child.children[0], keep, additional)
+
+    return None
+
+def prune_columns(node: PlanNode, needed: Optional[Set[str]]) -> PlanNode:
+    """
+    Rebuilds the plan so that each Scan only produces the columns that
+    are `needed` above it (where None means all of them).
+    """
+    if isinstance(node, Scan):
+        if needed is None:
+            return node
+        if node.predicate is not None:
+            predicate_needs = predicate_columns(node.predicate)
+            if predicate_needs is None:
+                return node
+            needed = needed | predicate_needs
+        columns = [c for c in node.table.columns if c in needed]
+        return Scan(node.table, node.predicate, columns)
+
+    if isinstance(node, Project):
+        # Additional columns are computed from whole rows.
+        child_needs = None if node.additional_columns else set(node.keep_columns)
+    elif isinstance(node, Filter):
+        predicate_needs = predicate_columns(node.predicate)
+        child_needs = (None if needed is None or predicate_needs is None
+                       else needed | predicate_needs)
+    elif isinstance(node, Limit):
+        child_needs = needed
+    elif isinstance(node, GroupBy) and is_streamable(node.aggregates, node.having):
+        child_needs = set(node.group_by_columns) | {
+            agg.column for agg in node.aggregates.values() if agg.column}
+    else:
+        # Sort keys, other aggregates, and joins could use any column.
+        child_needs = None
+
+    # (Pruning only ever starts below a Project, which keeps producing
+    # exactly its own columns, so the plan's output doesn't change.)
+    return node.with_children([prune_columns(child, child_needs)
+                               for child in node.children])
+
+def optimize(node: PlanNode) -> PlanNode:
+    """Rewrites the plan (children first) until no more rules apply"""
+    def optimize_node(node: PlanNode) -> PlanNode:
+        node = node.with_children([optimize_node(child) for child in node.children])
+        rewritten = rewrite(node)
+        return node if rewritten is None else optimize_node(rewritten)
+
+    return prune_columns(optimize_node(node), None)
+
+class Query:
+    """
+    A lazily evaluated chain of Table operations. Build one with
+    table.query(), add operations the same way you would on a Table, and
+    then iterate over it, or execute() it to get a Table.
+    """
+    def __init__(self, plan: PlanNode) -> None:
+        self.plan = plan
+
+    def where(self, predicate: WhereClause = lambda row: True) -> 'Query':
+        return Query(Filter(self.plan, predicate))
+
+    def select(self,
+               keep_columns: List[str] = None,
+               additional_columns: Dict[str, Callable] = None) -> 'Query':
+        if keep_columns is None:
+            keep_columns = self.plan.columns
+        return Query(Project(self.plan, keep_columns, additional_columns or {}))
+
+    def limit(self, num_rows: int) -> 'Query':
+        return Query(Limit(self.plan, num_rows))
+
+    def order_by(self,
+                 order: Callable[[Row], Any],
+                 max_rows: int = MAX_SORT_ROWS) -> 'Query':
+        """Sorts in memory, unless there are more than max_rows rows"""
+        return Query(Sort(self.plan, order, max_rows))
+
+    def group_by(self,
+                 group_by_columns: List[str],
+                 aggregates: Dict[str, Callable],
+                 having: Optional[HavingClause] = None) -> 'Query':
+        return Query(GroupBy(self.plan, group_by_columns, aggregates, having))
+
+    def join(self, other: Any, left_join: bool = False) -> 'Query':
+        """other can be a Table or a Query"""
+        other_plan = other.plan if isinstance(other, Query) else Scan(other)
+        return Query(Join(self.plan, other_plan, left_join))
+
+    def optimized_plan(self) -> PlanNode:
+        return optimize(self.plan)
+
+    def explain(self) -> None:
+        """Prints the plan that will actually run"""
+        print(self.optimized_plan().explain())
+
+    def __iter__(self) -> Iterator[Row]:
+        return self.optimized_plan().rows()
+
+    def execute(self) -> Table:
+        return execute_plan(self.optimized_plan())
+
+def execute_plan(plan: PlanNode) -> Table:
+    """Runs plan (as is) and collects its rows into a Table"""
+    result = Table(plan.columns, plan.types)
+    # Scans pass along the tables' own rows, so copy them. (The values
+    # themselves were type-checked on the way into the tables.)
+    result.bulk_load([dict(row) for row in plan.rows()])
+    return result
+
+# A PersistentTable is a Table that lives in a directory on disk, as
+#
+#  * a snapshot: the whole table, in a binary format made of pages of
+#    rows, followed by a directory saying where each page is and the
+#    smallest and largest value of each column in it, and
+#  * a write-ahead log (WAL): every insert, update, and delete since the
+#    snapshot, each appended to the log *before* it's applied in memory.
+#
+# Every so often (and on close) we write a new snapshot and empty the
+# log. When we open a table, we read the snapshot, and then replay the
+# log on top of it, which recovers everything up to the last complete
+# log record even if the process crashed.
+#
+# Opening a table doesn't read any rows, just the page directory. A
+# where() with a structured predicate (like col("user_id") == 42) only
+# reads the pages whose min/max say they might contain a match; anything
+# else loads the whole table into memory.
+
+import binascii
+import os
+import struct
+
+# Values are written with a one-byte tag saying what kind of value follows.
+# Only None, bools, numbers, strs, bytes, and lists, tuples, and dicts of
+# those can be stored. (Pickling anything else would mean that opening a
+# table file could run arbitrary code.)
+(TAG_NONE, TAG_BOOL, TAG_INT, TAG_FLOAT, TAG_STR,
+ TAG_BIGINT, TAG_BYTES, TAG_LIST, TAG_TUPLE, TAG_DICT) = range(10)
+
+def encode_value(value: Any, out: bytearray) -> None:
+    if value is None:
+        out.append(TAG_NONE)
+    elif isinstance(value, bool):
+        out += struct.pack('<BB', TAG_BOOL, value)
+    elif isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        out += struct.pack('<Bq', TAG_INT, value)
+    elif isinstance(value, (str, int, bytes)):
+        if isinstance(value, bytes):
+            tag, encoded = TAG_BYTES, value
+        elif isinstance(value, str):
+            tag, encoded = TAG_STR, value.encode('utf-8')
+        else:                   # too big for 8 bytes, so store its digits
+            tag, encoded = TAG_BIGINT, str(value).encode('ascii')
+        out += struct.pack('<BI', tag, len(encoded))
+        out += encoded
+    elif isinstance(value, float):
+        out += struct.pack('<Bd', TAG_FLOAT, value)
+    elif isinstance(value, (list, tuple, dict)):
+        tag = {list: TAG_LIST, tuple: TAG_TUPLE, dict: TAG_DICT}[type(value)]
+        items = [item for pair in value.items() for item in pair] \
+                if isinstance(value, dict) else value
+        out += struct.pack('<BI', tag, len(items))
+        for item in items:
+            encode_value(item, out)
+    else:
+        raise TypeError(f"can't persist values of type {type(value).__name__}")
+
+def decode_value(buffer: bytes, position: int) -> Tuple[Any, int]:
+    """Returns the value starting at position, and where the next one starts"""
+    tag = buffer[position]
+    position += 1
+    if tag == TAG_NONE:
+        return None, position
+    elif tag == TAG_BOOL:
+        return bool(buffer[position]), position + 1
+    elif tag == TAG_INT:
+        return struct.unpack_from('<q', buffer, position)[0], position + 8
+    elif tag == TAG_FLOAT:
+        return struct.unpack_from('<d', buffer, position)[0], position + 8
+    elif tag in (TAG_STR, TAG_BIGINT, TAG_BYTES):
+        length, = struct.unpack_from('<I', buffer, position)
+        data = bytes(buffer[position + 4:position + 4 + length])
+        if tag == TAG_STR:
+            value = data.decode('utf-8')
+        elif tag == TAG_BIGINT:
+            value = int(data.decode('ascii'))
+        else:
+            value = data
+        return value, position + 4 + length
+    elif tag in (TAG_LIST, TAG_TUPLE, TAG_DICT):
+        length, = struct.unpack_from('<I', buffer, position)
+        position += 4
+        items = []
+        for _ in range(length):
+            item, position = decode_value(buffer, position)
+            items.append(item)
+        if tag == TAG_DICT:
+            return dict(zip(items[::2], items[1::2])), position
+        return (items if tag == TAG_LIST else tuple(items)), position
+    else:
+        raise ValueError(f"unknown value tag {tag} at position {position - 1}")
+
+def encode_values(values: Iterable[Any]) -> bytearray:
+    values = list(values)
+    out = bytearray(struct.pack('<I', len(values)))
+    for value in values:
+        encode_value(value, out)
+    return out
+
+def decode_values(buffer: bytes, position: int = 0) -> Tuple[List[Any], int]:
+    count, = struct.unpack_from('<I', buffer, position)
+    position += 4
+    values = []
+    for _ in range(count):
+        value, position = decode_value(buffer, position)
+        values.append(value)
+    return values, position
+
+for example in [[], [None, True, -3, 2 ** 70, -2 ** 70, 1.5, "héllo", b"\x00",
+                     (1, 2), [[], ("a", None)], {"x": [1], 2: (3,)}]]:
+    decoded = decode_values(bytes(encode_values(example)))[0]
+    assert decoded == example
+    assert [type(value) for value in decoded] == [type(value) for value in example]
+
+try:
+    encode_values([{1, 2}])
+    assert False, "sets can't be persisted"
+except TypeError:
+    pass
+
+# Column types are stored by name, and have to be ones encode_value handles.
+PERSISTABLE_TYPES = [bool, int, float, str, bytes, list, tuple, dict]
+
+def type_name(typ3: type) -> str:
+    if typ3 not in PERSISTABLE_TYPES:
+        raise ValueError(f"can't persist tables with column type {typ3}")
+    return typ3.__name__
+
+SNAPSHOT_MAGIC = b"SCRATCHT"
+SNAPSHOT_FILE = "snapshot.db"
+WAL_FILE = "wal.log"
+ROWS_PER_PAGE = 1024
+
+# Snapshot layout (all numbers little-endian):
+#
+#   magic, version (uint32), last_lsn (uint64)
+#   header length (uint32), then the encoded columns and type names
+#   pages:      crc32 (uint32), then each row's encoded values
+#   directory:  for each page, offset (uint64), length (uint32),
+#               num_rows (uint32), and the encoded min and max of each column
+#   footer:     directory offset (uint64), num_pages (uint32), magic
+#
+# where last_lsn is the "log sequence number" of the last WAL record the
+# snapshot includes, so that recovery knows which records to replay.
+
+class PageInfo:
+    def __init__(self, offset: int, length: int, num_rows: int,
+                 mins: List[Any], maxes: List[Any]) -> None:
+        self.offset = offset
+        self.length = length
+        self.num_rows = num_rows
+        self.mins = mins        # None where unknown (all None, or unorderable)
+        self.maxes = maxes
+
+def column_range(values: List[Any]) -> Tuple[Any, Any]:
+    present = [value for value in values if value is not None]
+    try:
+        return min(present), max(present)
+    except (ValueError, TypeError):         # empty, or can't be compared
+        return None, None
+
+def write_snapshot(filename: str,
+                   columns: List[str],
+                   types: List[type],
+                   rows: List[Row],
+                   last_lsn: int) -> None:
+    """Writes to a temporary file, then swaps it in all at once"""
+    with open(filename + ".tmp", "wb") as f:
+        header = encode_values(columns + [type_name(typ3) for typ3 in types])
+        f.write(SNAPSHOT_MAGIC + struct.pack('<IQI', 1, last_lsn, len(header)))
+        f.write(header)
+
+        pages = []
+        for start in range(0, len(rows), ROWS_PER_PAGE):
+            page_rows = rows[start:start + ROWS_PER_PAGE]
+            payload = bytearray()
+            for row in page_rows:
+                for column in columns:
+                    encode_value(row[column], payload)
+
+            ranges = [column_range([row[column] for row in page_rows])
+                      for column in columns]
+            pages.append(PageInfo(f.tell(), 4 + len(payload), len(page_rows),
+                                  [lo for lo, _ in ranges],
+                                  [hi for _, hi in ranges]))
+            f.write(struct.pack('<I', binascii.crc32(payload)))
+            f.write(payload)
+
+        directory_offset = f.tell()
+        for page in pages:
+            f.write(struct.pack('<QII', page.offset, page.length, page.num_rows))
+            f.write(encode_values(page.mins + page.maxes))
+        f.write(struct.pack('<QI', directory_offset, len(pages)) + SNAPSHOT_MAGIC)
+
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + ".tmp", filename)
+
+def read_snapshot_directory(f) -> Tuple[List[str], List[type], int, List[PageInfo]]:
+    """Reads just the header and page directory of an open snapshot file"""
+    f.seek(0)
+    magic, version, last_lsn, header_length = struct.unpack('<8sIQI', f.read(24))
+    if magic != SNAPSHOT_MAGIC or version != 1:
+        raise ValueError("not a table snapshot")
+    names, _ = decode_values(f.read(header_length))
+    num_columns = len(names) // 2
+    columns = names[:num_columns]
+    types = [typ3 for name in names[num_columns:]
+             for typ3 in PERSISTABLE_TYPES if typ3.__name__ == name]
+    if len(types) != num_columns:
+        raise ValueError("snapshot has an unknown column type")
+
+    f.seek(-20, os.SEEK_END)
+    directory_offset, num_pages, magic = struct.unpack('<QI8s', f.read(20))
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("snapshot is truncated")
+
+    f.seek(directory_offset)
+    directory = f.read()
+    pages = []
+    position = 0
+    for _ in range(num_pages):
+        offset, length, num_rows = struct.unpack_from('<QII', directory, position)
+        ranges, position = decode_values(directory, position + 16)
+        pages.append(PageInfo(offset, length, num_rows,
+                              ranges[:num_columns], ranges[num_columns:]))
+    return columns, types, last_lsn, pages
+
+def page_might_match(page: PageInfo, columns: List[str], predicate: WhereClause) -> bool:
+    """Could any row in page satisfy predicate? (True if we can't tell.)"""
+    if isinstance(predicate, Comparison) and predicate.value is not None:
+        i = columns.index(predicate.column)
+        lo, hi, value = page.mins[i], page.maxes[i], predicate.value
+        if lo is None:
+            return True         # we don't know the range
+        try:
+            return {"==": lo <= value <= hi,
+                    "<": lo < value,
+                    "<=": lo <= value,
+                    ">": hi > value,
+                    ">=": hi >= value,
+                    "!=": True}[predicate.op]
+        except TypeError:
+            return True
+    elif isinstance(predicate, And):
+        return (page_might_match(page, columns, predicate.left) and
+                page_might_match(page, columns, predicate.right))
+    elif isinstance(predicate, Or):
+        return (page_might_match(page, columns, predicate.left) or
+                page_might_match(page, columns, predicate.right))
+    return True
+
+# WAL records are: length (uint32), crc32 (uint32), then a payload of
+# lsn (uint64), an operation byte, and the operation's encoded arguments.
+# Updates and deletes are logged by the positions of the rows they
+# changed, since their predicates are arbitrary Python functions.
+
+OP_INSERT, OP_UPDATE, OP_DELETE = range(3)
+
+def encode_wal_record(lsn: int, op: int, args: bytearray) -> bytes:
+    payload = struct.pack('<QB', lsn, op) + args
+    return struct.pack('<II', len(payload), binascii.crc32(payload)) + payload
+
+def read_wal_records(filename: str) -> Tuple[List[Tuple[int, int, bytes]], int]:
+    """
+    Returns the (lsn, op, args) of every complete record, and the length of
+    the file up to the end of the last one. A crash can leave a partial
+    record at the end; that (and anything after it) is ignored.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    records = []
+    position = 0
+    while position + 8 <= len(data):
+        length, crc = struct.unpack_from('<II', data, position)
+        payload = data[position + 8:position + 8 + length]
+        if len(payload) < length or binascii.crc32(payload) != crc:
+            break
+        lsn, op = struct.unpack_from('<QB', payload)
+        records.append((lsn, op, payload[9:]))
+        position += 8 + length
+    return records, position
+
+class PersistentTable(Table):
+    """
+    A Table stored in `directory`. Pass columns and types to create a
+    new one; leave them out to open an existing one. Changes are logged
+    to disk as they happen; use it as a context manager (or call close())
+    to write a final snapshot.
+
+    With sync=True every log record is fsynced, so changes survive a power
+    failure, not just a crash; that's much slower.
+    """
+    def __init__(self,
+                 directory: str,
+                 columns: List[str] = None,
+                 types: List[type] = None,
+                 checkpoint_every: int = 10000,
+                 sync: bool = False) -> None:
+        self.directory = directory
+        self.snapshot_file = os.path.join(directory, SNAPSHOT_FILE)
+        self.wal_file = os.path.join(directory, WAL_FILE)
+        self.checkpoint_every = checkpoint_every
+        self.sync = sync
+
+        if not os.path.exists(self.snapshot_file):
+            if columns is None or types is None:
+                raise ValueError(f"no table in {directory}; "
+                                 "give columns and types to create one")
+            os.makedirs(directory, exist_ok=True)
+            write_snapshot(self.snapshot_file, columns, types, [], 0)
+
+        with open(self.snapshot_file, "rb") as f:
+            stored_columns, stored_types, self.last_lsn, self.pages = \
+                read_snapshot_directory(f)
+        if columns is not None and (columns, types) != (stored_columns, stored_types):
+            raise ValueError(f"{directory} has columns {stored_columns} "
+                             f"of types {stored_types}")
+
+        super().__init__(stored_columns, stored_types)
+        self._rows: Optional[List[Row]] = None     # not loaded yet
+
+        # Recovery: replay whatever the snapshot doesn't already include.
+        self.log_size = 0
+        if os.path.exists(self.wal_file):
+            records, valid_length = read_wal_records(self.wal_file)
+            with open(self.wal_file, "r+b") as f:
+                f.truncate(valid_length)            # drop any torn record
+            replay = [record for record in records if record[0] > self.last_lsn]
+            for lsn, op, args in replay:
+                self._replay(op, args)
+                self.last_lsn = lsn
+            self.log_size = len(replay)
+
+        self.wal = open(self.wal_file, "ab")
+        if self.log_size >= self.checkpoint_every:
+            self.checkpoint()
+
+    # The rows only get read from the snapshot when someone needs them.
+
+    @property
+    def rows(self) -> List[Row]:                 # type: ignore
+        if self._rows is None:
+            self._rows = [row for page in self.pages for row in self._read_page(page)]
+        return self._rows
+
+    @rows.setter
+    def rows(self, rows: List[Row]) -> None:
+        self._rows = rows
+
+    @property
+    def loaded(self) -> bool:
+        return self._rows is not None
+
+    def __len__(self) -> int:
+        if self._rows is None:
+            return sum(page.num_rows for page in self.pages)
+        return len(self._rows)
+
+    def _read_page(self, page: PageInfo) -> List[Row]:
+        with open(self.snapshot_file, "rb") as f:
+            f.seek(page.offset)
+            data = f.read(page.length)
+        crc, = struct.unpack_from('<I', data)
+        payload = data[4:]
+        if binascii.crc32(payload) != crc:
+            raise IOError(f"corrupt page at offset {page.offset} in {self.snapshot_file}")
+
+        rows = []
+        position = 0
+        for _ in range(page.num_rows):
+            row = {}
+            for column in self.columns:
+                row[column], position = decode_value(payload, position)
+            rows.append(row)
+        return rows
+
+    def scan(self, predicate: WhereClause) -> Iterator[Row]:
+        """
+        The rows satisfying predicate. If the table hasn't been loaded,
+        only reads the pages that could have matching rows.
+        """
+        if self.loaded:
+            return filter(predicate, self.rows)
+        pages = [page for page in self.pages
+                 if page_might_match(page, self.columns, predicate)]
+        return (row for page in pages for row in self._read_page(page)
+                if predicate(row))
+
+    def where(self, predicate: WhereClause = lambda row: True) -> 'Table':
+        if self.loaded or self.indexes:
+            return super().where(predicate)
+        where_table = Table(self.columns, self.types)
+        where_table.bulk_load(list(self.scan(predicate)))
+        return where_table
+
+    # Every change gets logged before it happens.
+
+    def _log(self, op: int, args: bytearray) -> None:
+        self._log_many(op, [args])
+
+    def _log_many(self, op: int, args_list: List[bytearray]) -> None:
+        """Logs several records of the same kind, with one flush (and fsync)"""
+        for args in args_list:
+            self.last_lsn += 1
+            self.wal.write(encode_wal_record(self.last_lsn, op, args))
+        self.wal.flush()
+        if self.sync:
+            os.fsync(self.wal.fileno())
+
+        self.log_size += len(args_list)
+
+    def _maybe_checkpoint(self) -> None:
+        if self.log_size >= self.checkpoint_every:
+            self.checkpoint()
+
+    def insert(self, values: list) -> None:
+        self.check_values(values)
+        self.rows                                   # (make sure we're loaded)
+        self._log(OP_INSERT, encode_values(values))
+        super().insert(values)
+        self._maybe_checkpoint()
+
+    def insert_many(self, batch: Iterable[list], validate: bool = True) -> None:
+        batch = list(batch)
+        if validate:
+            self.check_batch(batch)
+        self.rows                                   # (make sure we're loaded)
+        self._log_many(OP_INSERT, [encode_values(values) for values in batch])
+        super().insert_many(batch, validate=False)
+        self._maybe_checkpoint()
+
+    def bulk_load(self, rows: Iterable[Row]) -> None:
+        # (Through insert_many, so that the rows get logged.)
+        columns = self.columns
+        self.insert_many([[row[column] for column in columns] for row in rows],
+                         validate=False)
+
+    def _update_positions(self, positions: List[int], updates: Dict[str, Any]) -> None:
+        if positions:
+            self._log(OP_UPDATE, encode_values([list(updates.keys()),
+                                                list(updates.values()),
+                                                positions]))
+            super()._update_positions(positions, updates)
+            self._maybe_checkpoint()
+
+    def _delete_positions(self, positions: List[int]) -> None:
+        if positions:
+            self._log(OP_DELETE, encode_values(positions))
+            super()._delete_positions(positions)
+            self._maybe_checkpoint()
+
+    def _replay(self, op: int, args: bytes) -> None:
+        """Applies a logged change (without logging it again)"""
+        if op == OP_INSERT:
+            values, _ = decode_values(args)
+            Table.insert(self, values)
+        elif op == OP_UPDATE:
+            (columns, values, positions), _ = decode_values(args)
+            Table._update_positions(self, positions, dict(zip(columns, values)))
+        elif op == OP_DELETE:
+            positions, _ = decode_values(args)
+            Table._delete_positions(self, positions)
+        else:
+            raise ValueError(f"unknown log record type {op}")
+
+    def checkpoint(self) -> None:
+        """Writes a new snapshot with everything, then empties the log"""
+        if self.log_size == 0:
+            return
+        write_snapshot(self.snapshot_file, self.columns, self.types,
+                       self.rows, self.last_lsn)
+        with open(self.snapshot_file, "rb") as f:
+            _, _, _, self.pages = read_snapshot_directory(f)
+
+        # If we crash before the log is emptied, recovery will skip its
+        # records anyway, because the snapshot's last_lsn covers them.
+        self.wal.close()
+        self.wal = open(self.wal_file, "wb")
+        self.log_size = 0
+
+    def close(self) -> None:
+        self.checkpoint()
+        self.wal.close()
+
+    def __enter__(self) -> 'PersistentTable':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+def benchmark_persistence(num_rows: int = 100000) -> None:
+    """Times reopening a PersistentTable vs. re-inserting every row"""
+    import random
+    import shutil
+    import tempfile
+    import time
+
+    random.seed(0)
+    data = [[user_id, f"user{user_id}", random.randrange(100)]
+            for user_id in range(num_rows)]
+    columns, types = ['user_id', 'name', 'num_friends'], [int, str, int]
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "users")
+
+    def timed(description: str, fn: Callable[[], Any]) -> Any:
+        start = time.time()
+        result = fn()
+        print(f"{description:>28}: {time.time() - start:.3f}s")
+        return result
+
+    def reinsert() -> Table:
+        table = Table(columns, types)
+        for values in data:
+            table.insert(values)
+        return table
+
+    def write() -> None:
+        with PersistentTable(path, columns, types) as table:
+            for values in data:
+                table.insert(values)
+
+    print(f"{num_rows} rows")
+    timed("re-insert into a Table", reinsert)
+    timed("insert into PersistentTable", write)
+    table = timed("open", lambda: PersistentTable(path))
+    found = timed("open + where user_id == 42",
+                  lambda: PersistentTable(path).where(col("user_id") == 42))
+    assert found.rows == [{"user_id": 42, "name": "user42", "num_friends": data[42][2]}]
+    timed("open + load every row", lambda: PersistentTable(path).rows)
+
+    # Changes go to the log, and survive a crash (here, not closing).
+    table.update({"num_friends": 0}, col("user_id") < 10)
+    table.delete(col("user_id") >= 10)
+    table.wal.close()
+    recovered = timed("recover (replay the log)", lambda: PersistentTable(path))
+    assert recovered.rows == [{"user_id": user_id, "name": f"user{user_id}",
+                               "num_friends": 0} for user_id in range(10)]
+    recovered.close()
+
+    shutil.rmtree(directory)
+
+def benchmark_queries(num_rows: int = 200000) -> None:
+    """Times a where/select/limit chain run eagerly and as a Query"""
+    import random
+    import time
+
+    random.seed(0)
+    table = Table(['user_id', 'name', 'num_friends'], [int, str, int])
+    for user_id in range(num_rows):
+        table.insert([user_id, f"user{user_id}", random.randrange(100)])
+
+    def eager() -> Table:
+        return (table.where(lambda row: row["num_friends"] > 10)
+                     .select(keep_columns=["name"])
+                     .limit(10))
+
+    def lazy() -> Table:
+        return (table.query()
+                     .where(lambda row: row["num_friends"] > 10)
+                     .select(keep_columns=["name"])
+                     .limit(10)
+                     .execute())
+
+    for description, run in [("eager", eager), ("lazy", lazy)]:
+        start = time.time()
+        result = run()
+        print(f"{description:>6}: {1000 * (time.time() - start):8.2f}ms")
+    assert result.rows == eager().rows
+
+def benchmark_joins(num_users: int = 1000, interests_per_user: int = 10) -> None:
+    """Times each join strategy on a users x interests join"""
+    import random
+    import time
+
+    random.seed(0)
+    users = Table(['user_id', 'name'], [int, str])
+    for user_id in range(num_users):
+        users.insert([user_id, f"user{user_id}"])
+
+    interests = Table(['user_id', 'interest'], [int, str])
+    for _ in range(num_users * interests_per_user):
+        interests.insert([random.randrange(num_users),
+                          random.choice(["SQL", "NoSQL", "Python", "R"])])
+    sorted_interests = interests.order_by(lambda row: row["user_id"])
+
+    print(f"joining {len(users)} users with {len(interests)} interests")
+    for strategy in ["nested_loop", "hash", "auto"]:
+        start = time.time()
+        result = users.join(interests, strategy=strategy)
+        print(f"{strategy:>12}: {time.time() - start:.3f}s ({len(result)} rows)")
+
+    for strategy in ["hash", "merge", "auto"]:
+        start = time.time()
+        sorted_result = users.join(sorted_interests, strategy=strategy)
+        print(f"{strategy:>12} (sorted): {time.time() - start:.3f}s")
+    assert sorted_result.rows == users.join(sorted_interests, strategy="nested_loop").rows
+
+def benchmark_indexes(num_rows: int = 100000, num_lookups: int = 100) -> None:
+    """Times lookups with no index, a hash index, and a sorted index"""
+    import random
+    import time
+
+    random.seed(0)
+    table = Table(['user_id', 'score'], [int, float])
+    for user_id in range(num_rows):
+        table.insert([user_id, random.random()])
+    user_ids = [random.randrange(num_rows) for _ in range(num_lookups)]
+
+    def time_lookups(description: str) -> None:
+        start = time.time()
+        for user_id in user_ids:
+            assert len(table.where(col("user_id") == user_id)) == 1
+        elapsed = time.time() - start
+        print(f"{description:>12}: {1000 * elapsed / num_lookups:8.3f}ms per lookup")
+
+    print(f"looking up user_ids in {num_rows} rows")
+    time_lookups("no index")
+    table.create_index("user_id", kind="sorted")
+    time_lookups("sorted index")
+    table.create_index("user_id", kind="hash")
+    time_lookups("hash index")
+
+def benchmark_columnar(num_rows: int = 200000) -> None:
+    """Compares memory use and query times of Table and ColumnarTable"""
+    import random
+    import time
+    import tracemalloc
+
+    def build(table_class: type) -> Table:
+        random.seed(0)
+        table = table_class(['user_id', 'name', 'city', 'num_friends', 'score'],
+                            [int, str, str, int, float])
+        for user_id in range(num_rows):
+            table.insert([user_id,
+                          f"user{random.randrange(1000)}",
+                          random.choice(["Boston", "Chicago", "Denver", "Miami"]),
+                          random.randrange(100),
+                          random.random()])
+        return table
+
+    def num_users(rows: List[Row]) -> int:
+        return len(rows)
+
+    queries = [
+        ("where", lambda t: t.where(col("num_friends") > 90)),
+        ("where (lambda)", lambda t: t.where(lambda row: row["num_friends"] > 90)),
+        ("select", lambda t: t.select(keep_columns=["user_id", "score"])),
+        ("group_by", lambda t: t.group_by(["city"], {"num_users": num_users})),
+        ("order_by", lambda t: t.order_by(lambda row: row["score"])),
+    ]
+
+    print(f"{num_rows} rows x 5 columns")
+    results = {}
+    for table_class in [Table, ColumnarTable]:
+        tracemalloc.start()
+        start = time.time()
+        table = build(table_class)
+        build_time = time.time() - start
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        name = table_class.__name__
+        print(f"{name:>14}: {size / 2 ** 20:6.1f} MB, built in {build_time:.2f}s")
+        for description, query in queries:
+            start = time.time()
+            results[name, description] = query(table).rows
+            print(f"{name:>14} {description:>16}: {time.time() - start:.3f}s")
+
+    assert all(results["Table", description] == results["ColumnarTable", description]
+               for description, _ in queries)
+
+def benchmark_sorting(num_rows: int = 500000, k: int = 10) -> None:
+    """Full sort + limit vs top-k, and in-memory vs external sorting"""
+    import random
+    import time
+    import tracemalloc
+
+    random.seed(0)
+    table = ColumnarTable(['user_id', 'score'], [int, float])
+    table.insert_many([user_id, random.random()] for user_id in range(num_rows))
+    by_score = lambda row: row["score"]
+
+    print(f"{num_rows} rows, top {k}")
+    runs = [
+        ("order_by().limit()", lambda: table.order_by(by_score).limit(k).rows),
+        ("order_by(limit=)", lambda: table.order_by(by_score, limit=k).rows),
+        ("query (TopK)", lambda: table.query().order_by(by_score).limit(k).execute().rows),
+    ]
+    results = []
+    for description, run in runs:
+        start = time.time()
+        results.append(run())
+        print(f"{description:>20}: {time.time() - start:.3f}s")
+    assert results[0] == results[1] == results[2]
+
+    # A full sort, streamed, with and without a memory limit.
+    for max_rows in [MAX_SORT_ROWS, num_rows // 10]:
+        tracemalloc.start()
+        start = time.time()
+        previous = -1.0
+        for row in table.query().order_by(by_score, max_rows=max_rows):
+            assert row["score"] >= previous
+            previous = row["score"]
+        elapsed = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  sort, max_rows={max_rows:>7}: {elapsed:.2f}s, "
+              f"peak {peak / 2 ** 20:6.1f} MB")
+
+def benchmark_bulk_load(num_rows: int = 1000000) -> None:
+    """Loading rows one insert at a time vs with insert_many"""
+    import random
+    import time
+
+    random.seed(0)
+    batch = [[user_id, f"user{random.randrange(1000)}", random.random()]
+             for user_id in range(num_rows)]
+
+    print(f"loading {num_rows} rows")
+    for table_class in [Table, ColumnarTable]:
+        name = table_class.__name__
+        table = table_class(['user_id', 'name', 'score'], [int, str, float])
+        start = time.time()
+        for values in batch:
+            table.insert(values)
+        print(f"{name:>14} insert:      {time.time() - start:.2f}s")
+
+        bulk_table = table_class(['user_id', 'name', 'score'], [int, str, float])
+        start = time.time()
+        bulk_table.insert_many(batch)
+        print(f"{name:>14} insert_many: {time.time() - start:.2f}s")
+
+        start = time.time()
+        bulk_table.where(col("score") < 0.5).limit(num_rows // 4).select()
+        print(f"{name:>14} where/limit/select: {time.time() - start:.2f}s")
+
+        assert bulk_table.rows[-10:] == table.rows[-10:]
+
+def benchmark_aggregation(num_rows: int = 200000, num_groups: int = 50000) -> None:
+    """
+    Time and peak memory of a high-cardinality group_by on a ColumnarTable,
+    where grouping lists of rows means building every row.
+    """
+    import random
+    import time
+    import tracemalloc
+
+    random.seed(0)
+    table = ColumnarTable(['user_id', 'city', 'score'], [int, int, float])
+    for user_id in range(num_rows):
+        table.insert([user_id, random.randrange(num_groups), random.random()])
+
+    def num_users(rows: List[Row]) -> int:
+        return len(rows)
+
+    def average_score(rows: List[Row]) -> float:
+        return sum(row["score"] for row in rows) / len(rows)
+
+    runs = [
+        ("lists of rows", {"num_users": num_users, "avg_score": average_score}, MAX_GROUPS),
+        ("streaming", {"num_users": Count(), "avg_score": Avg("score")}, MAX_GROUPS),
+        ("streaming + spill", {"num_users": Count(), "avg_score": Avg("score")},
+         num_groups // 10),
+    ]
+
+    print(f"{num_rows} rows, {num_groups} groups")
+    results = []
+    for description, aggregates, max_groups in runs:
+        start = time.time()
+        result = table.group_by(["city"], aggregates, max_groups=max_groups)
+        elapsed = time.time() - start
+
+        # (Measured separately, since tracing slows everything down.)
+        tracemalloc.start()
+        table.group_by(["city"], aggregates, max_groups=max_groups)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(f"{description:>18}: {elapsed:.2f}s, peak {peak / 2 ** 20:6.1f} MB")
+        results.append(sorted((row["city"], row["num_users"], round(row["avg_score"], 9))
+                              for row in result))
+
+    assert results[0] == results[1] == results[2]
+
 def main():
     # Constructor requires column names and types
     users = Table(['user_id', 'name', 'num_friends'], [int, str, int])
@@ -213,6 +2579,35 @@ def main():
     
     assert users[1]['num_friends'] == 3             # Updated value
     
+    # Structured predicates give the same answers as lambdas, but
+    # with an index they don't have to look at every row.
+    users.create_index("user_id")                        # hash index
+    users.create_index("num_friends", kind="sorted")     # sorted index
+    
+    assert users.where(col("user_id") == 1).rows == \
+           users.where(lambda row: row["user_id"] == 1).rows
+    assert users._index_lookup(col("user_id") == 1) == [1]
+    assert users._index_lookup(col("num_friends") >= 3) == [1, 2, 3, 4, 6, 9]
+    assert users._index_lookup(col("name") == "Dunn") is None     # no index
+    
+    few_friends = (col("num_friends") < 3) & (col("name") != "Jen")
+    assert users.where(few_friends).rows == \
+           users.where(lambda row: row["num_friends"] < 3 and
+                                   row["name"] != "Jen").rows
+    assert [row["user_id"] for row in users.where(few_friends)] == [0, 5, 7, 8]
+    
+    # The indexes follow updates...
+    users.update({"num_friends": 1}, col("user_id") == 0)
+    assert users._index_lookup(col("num_friends") == 1) == [0, 10]
+    users.update({"num_friends": 0}, col("user_id") == 0)
+    
+    # ...and deletes (which shift the rows after the deleted ones).
+    users.insert([11, "Temp", 0])
+    users.delete((col("user_id") == 11) | (col("user_id") == 12))
+    assert len(users) == 11
+    assert users._index_lookup(col("num_friends") == 0) == [0]
+    assert users.where(col("user_id") == 10)[0]["name"] == "Jen"
+    
     # SELECT * FROM users;
     all_users = users.select()
     assert len(all_users) == 11
@@ -326,6 +2721,18 @@ def main():
     sql_user_names = {row["name"] for row in sql_users}
     assert sql_user_names == {"Hero", "Sue"}
     
+    # Every join strategy gives the same rows, in the same order.
+    for left_join in [False, True]:
+        expected = users.join(user_interests, left_join, strategy="nested_loop")
+        assert users.join(user_interests, left_join, strategy="hash").rows == expected.rows
+        assert user_interests.join(users, left_join, strategy="hash").rows == \
+               user_interests.join(users, left_join, strategy="nested_loop").rows
+    
+    # users and user_interests are both in user_id order, so they can merge.
+    assert is_sorted_by(users.rows, ["user_id"])
+    assert users.join(user_interests, strategy="merge").rows == \
+           users.join(user_interests, strategy="nested_loop").rows
+    
     def count_interests(rows: List[Row]) -> int:
         """counts how many rows have non-None interests"""
         return len([row for row in rows if row["interest"] is not None])
@@ -364,4 +2771,123 @@ def main():
         .select(["name"])
     )
     
-if __name__ == "__main__": main()
\ No newline at end of file
+    # A query runs the same operations lazily, after optimizing them.
+    friendly_query = (
+        users.query()
+        .where(lambda row: row["num_friends"] >= 2)
+        .select(keep_columns=["user_id", "name"])
+        .where(col("user_id") > 2)
+        .limit(3)
+    )
+    friendly_users = friendly_query.execute()
+    assert friendly_users.rows == (
+        users
+        .where(lambda row: row["num_friends"] >= 2)
+        .select(keep_columns=["user_id", "name"])
+        .where(col("user_id") > 2)
+        .limit(3)
+    ).rows
+    assert [row["name"] for row in friendly_users] == ["Chi", "Thor", "Clive"]
+    
+    # The second where moved into the scan, and the limit below the select:
+    #   Project ['user_id', 'name']
+    #     Limit 3
+    #       Scan 11 rows [...] where (<lambda>) & (col('user_id') > 2)
+    friendly_query.explain()
+    
+    # A ColumnarTable holds the same data column by column, and answers
+    # the same queries the same way.
+    columnar_users = ColumnarTable(users.columns, users.types)
+    for row in users:
+        columnar_users.insert([row[column] for column in users.columns])
+    
+    assert columnar_users.rows == users.rows
+    assert isinstance(columnar_users.data["user_id"], array)
+    assert columnar_users.where(col("num_friends") > 2).rows == \
+           users.where(col("num_friends") > 2).rows
+    assert columnar_users.group_by(["num_friends"], {"num_users": length}).rows == \
+           users.group_by(["num_friends"], {"num_users": length}).rows
+    assert columnar_users.join(user_interests, left_join=True).rows == \
+           users.join(user_interests, left_join=True).rows
+    
+    # The built-in aggregates give the same answers as the functions of
+    # lists of rows above, and also work with lazy queries and columns.
+    streaming_stats = (
+        users
+        .select(additional_columns={"name_length" : name_length})
+        .group_by(group_by_columns=["name_length"],
+                  aggregates={"min_user_id" : Min("user_id"),
+                              "num_users" : Count()})
+    )
+    assert streaming_stats.rows == stats_by_length.rows
+    assert streaming_stats.types == [int, int, int]
+    
+    streaming_friends = (
+        users
+        .select(additional_columns={'first_letter' : first_letter_of_name})
+        .group_by(group_by_columns=['first_letter'],
+                  aggregates={"avg_num_friends" : Avg("num_friends")},
+                  having=col("avg_num_friends") > 1)
+    )
+    assert streaming_friends.rows == avg_friends_by_letter.rows
+    
+    friend_stats = {"num_users": Count(), "total": Sum("num_friends"),
+                    "most": Max("num_friends"), "distinct": CountDistinct("name")}
+    expected_stats = users.group_by(["num_friends"], friend_stats).rows
+    assert columnar_users.group_by(["num_friends"], friend_stats).rows == expected_stats
+    assert users.query().group_by(["num_friends"], friend_stats).execute().rows == \
+           expected_stats
+    
+    # With room for only 2 groups in memory, the groups spill to disk,
+    # and come back in some other order.
+    spilled = users.group_by(["num_friends"], friend_stats, max_groups=2).rows
+    key = lambda row: row["num_friends"]
+    assert sorted(spilled, key=key) == sorted(expected_stats, key=key)
+    
+    # insert_many checks a whole batch before inserting any of it.
+    for table_class in [Table, ColumnarTable]:
+        bulk_users = table_class(users.columns, users.types)
+        bulk_users.create_index("user_id")
+        bulk_users.insert_many([row["user_id"], row["name"], row["num_friends"]]
+                               for row in users)
+        assert bulk_users.rows == users.rows
+        assert bulk_users.where(col("user_id") == 10)[0]["name"] == "Jen"
+    
+        try:
+            bulk_users.insert_many([[11, "Eve", 1], [12, "Mallory", "lots"]])
+            assert False, "should have rejected 'lots'"
+        except TypeError:
+            assert len(bulk_users) == 11
+    
+        bulk_users.insert_many([[11, "Eve", None]])
+        assert bulk_users[11] == {"user_id": 11, "name": "Eve", "num_friends": None}
+    
+    # order_by followed by limit only keeps the rows it needs.
+    by_friends = lambda row: (-row["num_friends"], row["name"])
+    assert users.order_by(by_friends, limit=3).rows == \
+           users.order_by(by_friends).limit(3).rows
+    assert columnar_users.order_by(by_friends, limit=3).rows == \
+           users.order_by(by_friends).limit(3).rows
+    top_query = users.query().order_by(by_friends).select(["name"]).limit(3)
+    assert isinstance(top_query.optimized_plan().children[0], TopK)
+    assert [row["name"] for row in top_query] == ["Chi", "Dunn", "Hicks"]
+    try:
+        users.query().order_by(by_friends, max_rows=0)
+        assert False, "max_rows=0 would drop every row"
+    except ValueError:
+        pass
+
+def benchmark():
+    """Run with `python -m scratch.databases --benchmark`"""
+    benchmark_sorting()
+    benchmark_bulk_load()
+    benchmark_aggregation()
+    benchmark_queries()
+    benchmark_joins()
+    benchmark_indexes()
+    benchmark_columnar()
+    benchmark_persistence()
+
+if __name__ == "__main__":
+    import sys
+    benchmark() if "--benchmark" in sys.argv[1:] else main()
\ No newline at end of file
@@ -1,8 +1,198 @@
 Tensor = list
 
 from typing import List
+from scratch.linear_algebra import backend_dispatch
+
+from typing import Callable, Iterable, Sequence, Tuple
+from array import array
+import functools
+import operator
+from scratch.linear_algebra import ArrayVector
+
+class ArrayTensor:
+    """
+    A Tensor whose values all live in one flat ArrayVector, in row-major
+    order, along with its shape. t[i] is a view of the i-th sub-tensor
+    (or just a float, if t is 1-dimensional) that shares the same storage,
+    so an ArrayTensor behaves like the nested lists above without needing
+    a separate list (and separate boxed floats) for every row.
+    """
+    def __init__(self, values: Tensor) -> None:
+        """Copies a (possibly nested) list, or another ArrayTensor"""
+        self.data = ArrayVector(_flat_values(values))
+        self.shape = tuple(shape(values))
+        self.offset = 0                # where our values start in self.data
+
+    @classmethod
+    def from_flat(cls,
+                  values: Iterable[float],
+                  shape: Sequence[int],
+                  offset: int = 0) -> 'ArrayTensor':
+        """
+        Wraps already-flattened values (in row-major order) as a tensor of
+        the given shape. If values is an ArrayVector (or a memoryview of
+        doubles, e.g. of shared memory) it is used as is, not copied.
+        """
+        tensor = cls.__new__(cls)
+        if isinstance(values, (ArrayVector, memoryview)):
+            tensor.data = values
+        else:
+            tensor.data = ArrayVector(values)
+        tensor.shape = tuple(shape)
+        tensor.offset = offset
+        assert offset + tensor.size <= len(tensor.data), "not enough values"
+        return tensor
+
+    @classmethod
+    def zeros(cls, *dims: int) -> 'ArrayTensor':
+        size = functools.reduce(operator.mul, dims, 1)
+        # bytes(...) of the right length is a buffer of 0.0s
+        return cls.from_flat(ArrayVector(bytes(8 * size)), dims)
+
+    @property
+    def size(self) -> int:
+        """The total number of values in the tensor"""
+        return functools.reduce(operator.mul, self.shape, 1)
+
+    @property
+    def strides(self) -> Tuple[int, ...]:
+        """How far apart (in self.data) neighbors along each dimension are"""
+        strides = [1]
+        for dim in reversed(self.shape[1:]):
+            strides.append(strides[-1] * dim)
+        return tuple(reversed(strides))
+
+    def flat(self) -> Sequence[float]:
+        """All the values in row-major order, as a view (not a copy)"""
+        if self.offset == 0 and self.size == len(self.data):
+            return self.data
+        return memoryview(self.data)[self.offset:self.offset + self.size]
+
+    def set_flat(self, values: Iterable[float]) -> None:
+        """Overwrites all the values (in row-major order), in place"""
+        # (Making an array from a list is faster than from an iterator.)
+        new_values = values if isinstance(values, array) else ArrayVector(list(values))
+        assert len(new_values) == self.size, "wrong number of values"
+        self.data[self.offset:self.offset + self.size] = new_values
+
+    def reshape(self, *dims: int) -> 'ArrayTensor':
+        """A view of the same values with a different shape (no copying)"""
+        if -1 in dims:
+            # Figure out the one missing dimension from the others.
+            known = -functools.reduce(operator.mul, dims, 1)
+            dims = tuple(self.size // known if dim == -1 else dim
+                         for dim in dims)
+        assert functools.reduce(operator.mul, dims, 1) == self.size, \
+            f"can't reshape {self.shape} into {dims}"
+        return ArrayTensor.from_flat(self.data, dims, self.offset)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def _sub_tensor(self, i: int) -> 'ArrayTensor':
+        inner_size = self.strides[0]
+        return ArrayTensor.from_flat(self.data,
+                                     self.shape[1:],
+                                     self.offset + i * inner_size)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            # Slices (along the first dimension) are views too.
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                raise ValueError("only contiguous slices are supported")
+            view = ArrayTensor.from_flat(self.data,
+                                         (max(stop - start, 0),) + self.shape[1:],
+                                         self.offset)
+            view.offset += start * view.strides[0]
+            return view
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("tensor index out of range")
+
+        if len(self.shape) == 1:
+            return self.data[self.offset + i]
+        else:
+            return self._sub_tensor(i)
+
+    def __setitem__(self, i, value) -> None:
+        """t[i] = ... and t[:] = ... both copy into our storage"""
+        if isinstance(i, int) and len(self.shape) == 1:
+            if i < 0:
+                i += len(self)
+            if not 0 <= i < len(self):
+                raise IndexError("tensor index out of range")
+            self.data[self.offset + i] = value
+        else:
+            target = self[i]
+            assert shape(value) == shape(target), "shapes must match"
+            target.set_flat(_flat_values(value))
+
+    def __iter__(self):
+        if len(self.shape) == 1:
+            return iter(self.flat())
+        else:
+            return (self._sub_tensor(i) for i in range(len(self)))
+
+    # In-place elementwise arithmetic with a scalar or a same-shaped tensor,
+    # e.g. `param -= update`. These overwrite our storage rather than
+    # creating a new tensor.
+    def _update(self, op: Callable[[float, float], float], other) -> 'ArrayTensor':
+        if isinstance(other, (int, float)):
+            self.set_flat(op(x, other) for x in self.flat())
+        else:
+            assert shape(other) == list(self.shape), "shapes must match"
+            self.set_flat(map(op, self.flat(), _flat_values(other)))
+        return self
+
+    def __iadd__(self, other) -> 'ArrayTensor':
+        return self._update(operator.add, other)
+
+    def __isub__(self, other) -> 'ArrayTensor':
+        return self._update(operator.sub, other)
+
+    def __imul__(self, other) -> 'ArrayTensor':
+        return self._update(operator.mul, other)
+
+    def __itruediv__(self, other) -> 'ArrayTensor':
+        return self._update(operator.truediv, other)
+
+    def fill(self, value: float) -> None:
+        """Sets every value to `value`, in place"""
+        self.set_flat(ArrayVector([value]) * self.size)
+
+    def tolist(self) -> Tensor:
+        if len(self.shape) == 1:
+            return list(self.flat())
+        else:
+            return [sub_tensor.tolist() for sub_tensor in self]
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, ArrayTensor):
+            other = other.tolist()
+        if isinstance(other, list):
+            return self.tolist() == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"ArrayTensor({self.tolist()})"
+
+def _flat_values(tensor: Tensor) -> Iterable[float]:
+    """The values of a nested list (or ArrayTensor) in row-major order"""
+    if isinstance(tensor, ArrayTensor):
+        return tensor.flat()
+    elif is_1d(tensor):
+        return tensor
+    else:
+        return (x for tensor_i in tensor for x in _flat_values(tensor_i))
 
 def shape(tensor: Tensor) -> List[int]:
+    # ArrayTensors (and the numpy backend's arrays) know their own shapes
+    if hasattr(tensor, "shape"):
+        return list(tensor.shape)
+
     sizes: List[int] = []
     while isinstance(tensor, list):
         sizes.append(len(tensor))
@@ -17,13 +207,35 @@ def is_1d(tensor: Tensor) -> bool:
     If tensor[0] is a list, it's a higher-order tensor.
     Otherwise, tensor is 1-dimensonal (that is, a vector).
     """
+    if hasattr(tensor, "shape"):
+        return len(tensor.shape) == 1
+
     return not isinstance(tensor[0], list)
 
 assert is_1d([1, 2, 3])
 assert not is_1d([[1, 2], [3, 4]])
 
+at = ArrayTensor([[1, 2, 3], [4, 5, 6]])
+assert shape(at) == [2, 3] and at.strides == (3, 1)
+assert at[1][2] == 6 and at[-1][0] == 4
+assert at == [[1, 2, 3], [4, 5, 6]]
+assert at.reshape(3, 2) == [[1, 2], [3, 4], [5, 6]]
+assert at.reshape(-1) == [1, 2, 3, 4, 5, 6]
+at.reshape(6)[0] = 10                # reshaping doesn't copy,
+assert at[0][0] == 10                # so writes to the view show up in at,
+at[1][:] = [7, 8, 9]                 # and neither does indexing
+assert at.data[3:].tolist() == [7, 8, 9]
+at[:] = [[0, 0, 0], [1, 1, 1]]
+at += [[1, 2, 3], [1, 2, 3]]
+at *= 2
+assert at == [[2, 4, 6], [4, 6, 8]]
+
+@backend_dispatch
 def tensor_sum(tensor: Tensor) -> float:
     """Sums up all the values in the tensor"""
+    if isinstance(tensor, ArrayTensor):
+        return sum(tensor.flat())
+
     if is_1d(tensor):
         return sum(tensor)  # just a list of floats, use Python sum
     else:
@@ -32,11 +244,16 @@ def tensor_sum(tensor: Tensor) -> float:
 
 assert tensor_sum([1, 2, 3]) == 6
 assert tensor_sum([[1, 2], [3, 4]]) == 10
+assert tensor_sum(ArrayTensor([[1, 2], [3, 4]])) == 10
 
 from typing import Callable
 
+@backend_dispatch
 def tensor_apply(f: Callable[[float], float], tensor: Tensor) -> Tensor:
     """Applies f elementwise"""
+    if isinstance(tensor, ArrayTensor):
+        return ArrayTensor.from_flat(map(f, tensor.flat()), tensor.shape)
+
     if is_1d(tensor):
         return [f(x) for x in tensor]
     else:
@@ -44,17 +261,32 @@ def tensor_apply(f: Callable[[float], float], tensor: Tensor) -> Tensor:
 
 assert tensor_apply(lambda x: x + 1, [1, 2, 3]) == [2, 3, 4]
 assert tensor_apply(lambda x: 2 * x, [[1, 2], [3, 4]]) == [[2, 4], [6, 8]]
+assert tensor_apply(lambda x: 2 * x, ArrayTensor([[1, 2], [3, 4]])) == [[2, 4],
+                                                                       [6, 8]]
 
+@backend_dispatch
 def zeros_like(tensor: Tensor) -> Tensor:
+    if isinstance(tensor, ArrayTensor):
+        return ArrayTensor.zeros(*tensor.shape)
+
     return tensor_apply(lambda _: 0.0, tensor)
 
 assert zeros_like([1, 2, 3]) == [0, 0, 0]
 assert zeros_like([[1, 2], [3, 4]]) == [[0, 0], [0, 0]]
+assert zeros_like(ArrayTensor([[1, 2], [3, 4]])) == [[0, 0], [0, 0]]
 
+@backend_dispatch
 def tensor_combine(f: Callable[[float, float], float],
                    t1: Tensor,
                    t2: Tensor) -> Tensor:
     """Applies f to corresponding elements of t1 and t2"""
+    if isinstance(t1, ArrayTensor):
+        # t2 can be an ArrayTensor or a (nested) list of the same shape
+        return ArrayTensor.from_flat(map(f, t1.flat(), _flat_values(t2)),
+                                     t1.shape)
+    if isinstance(t2, ArrayTensor):
+        t2 = t2.tolist()
+
     if is_1d(t1):
         return [f(x, y) for x, y in zip(t1, t2)]
     else:
@@ -64,6 +296,8 @@ def tensor_combine(f: Callable[[float, float], float],
 import operator
 assert tensor_combine(operator.add, [1, 2, 3], [4, 5, 6]) == [5, 7, 9]
 assert tensor_combine(operator.mul, [1, 2, 3], [4, 5, 6]) == [4, 10, 18]
+assert tensor_combine(operator.mul,
+                      ArrayTensor([1, 2, 3]), [4, 5, 6]) == [4, 10, 18]
 
 from typing import Iterable, Tuple
 
@@ -153,7 +387,8 @@ def random_tensor(*dims: int, init: str = 'normal') -> Tensor:
     else:
         raise ValueError(f"unknown init: {init}")
 
-from scratch.linear_algebra import dot
+from scratch.linear_algebra import dot, vector_sum, transpose
+from scratch.linear_algebra import matrix_times_matrix, matrix_times_transpose
 
 class Linear(Layer):
     def __init__(self, input_dim: int, output_dim: int, init: str = 'xavier') -> None:
@@ -165,35 +400,85 @@ class Linear(Layer):
         self.output_dim = output_dim
 
         # self.w[o] is the weights for the o-th neuron
-        self.w = random_tensor(output_dim, input_dim, init=init)
+        # (stored as ArrayTensors, so that each parameter is one flat buffer)
+        self.w = ArrayTensor(random_tensor(output_dim, input_dim, init=init))
 
         # self.b[o] is the bias term for the o-th neuron
-        self.b = random_tensor(output_dim, init=init)
+        self.b = ArrayTensor(random_tensor(output_dim, init=init))
 
     def forward(self, input: Tensor) -> Tensor:
+        """
+        input can be a single example (a vector of length input_dim)
+        or a batch of them (a matrix with one example per row).
+        """
         # Save the input to use in the backward pass.
         self.input = input
 
+        if not is_1d(input):
+            return self._forward_batch(input)
+
         # Return the vector of neuron outputs.
-        return [dot(input, self.w[o]) + self.b[o]
-                for o in range(self.output_dim)]
+        return ArrayTensor.from_flat((dot(input, w_o) + b_o
+                                      for w_o, b_o in zip(self.w, self.b)),
+                                     [self.output_dim])
+
+    def _forward_batch(self, input: Tensor) -> Tensor:
+        # Row n of the output is w times row n of the input, so all the
+        # outputs together are input times w-transpose, plus the biases.
+        outputs = matrix_times_transpose(input, self.w)
+        return ArrayTensor.from_flat((output_o + b_o
+                                      for output in outputs
+                                      for output_o, b_o in zip(output, self.b)),
+                                     [len(outputs), self.output_dim])
 
     def backward(self, gradient: Tensor) -> Tensor:
+        if not is_1d(gradient):
+            return self._backward_batch(gradient)
+
         # Each b[o] gets added to output[o], which means
         # the gradient of b is the same as the output gradient.
-        self.b_grad = gradient
+        self.b_grad = ArrayTensor(gradient)
 
         # Each w[o][i] multiplies input[i] and gets added to output[o].
         # So its gradient is input[i] * gradient[o].
-        self.w_grad = [[self.input[i] * gradient[o]
-                        for i in range(self.input_dim)]
-                       for o in range(self.output_dim)]
+        w_grad = ArrayVector()
+        for g_o in gradient:
+            w_grad.extend(map(functools.partial(operator.mul, g_o), self.input))
+        self.w_grad = ArrayTensor.from_flat(w_grad,
+                                            [self.output_dim, self.input_dim])
 
         # Each input[i] multiplies every w[o][i] and gets added to every
         # output[o]. So its gradient is the sum of w[o][i] * gradient[o]
-        # across all the outputs.
-        return [sum(self.w[o][i] * gradient[o] for o in range(self.output_dim))
-                for i in range(self.input_dim)]
+        # across all the outputs, which we accumulate one w[o] at a time.
+        input_grad = ArrayVector(bytes(8 * self.input_dim))
+        for w_o, g_o in zip(self.w, gradient):
+            input_grad = ArrayVector(map(operator.add,
+                                         input_grad,
+                                         map(functools.partial(operator.mul, g_o),
+                                             w_o)))
+        return ArrayTensor.from_flat(input_grad, [self.input_dim])
+
+    def _backward_batch(self, gradient: Tensor) -> Tensor:
+        """
+        gradient has one row per example. The parameter gradients are
+        the sums of the per-example gradients, which we can compute for
+        the whole batch with one matrix product each.
+        """
+        batch_size = len(gradient)
+
+        # b gets every example's gradient added up.
+        self.b_grad = ArrayTensor.from_flat(vector_sum(list(gradient)),
+                                            [self.output_dim])
+
+        # Summed over the batch, w[o][i] gets gradient[n][o] * input[n][i],
+        # which is the (o, i)-th entry of gradient-transpose times input.
+        w_grad = matrix_times_matrix(transpose(gradient), self.input)
+        self.w_grad = ArrayTensor(w_grad)
+
+        # And each example's input gradient is its gradient times w.
+        input_grad = matrix_times_matrix(gradient, self.w)
+        return ArrayTensor.from_flat((x for row in input_grad for x in row),
+                                     [batch_size, self.input_dim])
 
     def params(self) -> Iterable[Tensor]:
         return [self.w, self.b]
@@ -241,6 +526,11 @@ class Loss:
         """How does the loss change as the predictions change?"""
         raise NotImplementedError
 
+    def loss_and_gradient(self, predicted: Tensor,
+                          actual: Tensor) -> Tuple[float, Tensor]:
+        """Both at once, which some losses can compute more cheaply"""
+        return self.loss(predicted, actual), self.gradient(predicted, actual)
+
 class SSE(Loss):
     """Loss function that computes the sum of the squared errors."""
     def loss(self, predicted: Tensor, actual: Tensor) -> float:
@@ -264,6 +554,31 @@ sse_loss = SSE()
 assert sse_loss.loss([1, 2, 3], [10, 20, 30]) == 9 ** 2 + 18 ** 2 + 27 ** 2
 assert sse_loss.gradient([1, 2, 3], [10, 20, 30]) == [-18, -36, -54]
 
+# Layers and losses also accept a batch of inputs, one per row.
+# The outputs are the per-example outputs, and the parameter gradients
+# are the sums of the per-example gradients.
+random.seed(0)
+batch_net = Sequential([Linear(3, 2), Sigmoid(), Linear(2, 2)])
+batch_xs = [[1., 2., 3.], [0., -1., 1.], [2., 0., -2.]]
+batch_ys = [[1., 0.], [0., 1.], [1., 1.]]
+
+batch_grads = [[0.0] * param.size for param in batch_net.params()]
+for x, y in zip(batch_xs, batch_ys):
+    batch_net.backward(sse_loss.gradient(batch_net.forward(x), y))
+    batch_grads = [tensor_combine(operator.add, total, list(grad.flat()))
+                   for total, grad in zip(batch_grads, batch_net.grads())]
+
+batch_predicted = batch_net.forward(batch_xs)
+assert shape(batch_predicted) == [3, 2]
+assert all(batch_predicted[i] == batch_net.forward(x)
+           for i, x in enumerate(batch_xs))
+
+batch_net.forward(batch_xs)
+batch_net.backward(sse_loss.gradient(batch_predicted, batch_ys))
+assert all(abs(total - batch_grad) < 1e-12
+           for totals, grad in zip(batch_grads, batch_net.grads())
+           for total, batch_grad in zip(totals, grad.flat()))
+
 class Optimizer:
     """
     An optimizer updates the weights of a layer (in place) using information
@@ -272,17 +587,113 @@ class Optimizer:
     def step(self, layer: Layer) -> None:
         raise NotImplementedError
 
+# Optimizers update every parameter on every step, so rather than use
+# tensor_combine (which builds a whole new tensor, calling a Python lambda
+# for every value) they use these "kernels", which compute each row's new
+# values with a plain list comprehension and write them straight back into
+# the row. (An ArrayTensor's values are all one flat row.) With the numpy
+# backend, they update ArrayTensors through NumPy views of their buffers,
+# without any copying at all.
+
+import itertools
+import math
+from typing import Iterator
+
+def assign_values(tensor: Tensor, values: Iterable[float]) -> None:
+    """Overwrites tensor's values (in row-major order), in place"""
+    values = iter(values)
+    if isinstance(tensor, ArrayTensor):
+        tensor.set_flat(values)
+    elif is_1d(tensor):
+        tensor[:] = itertools.islice(values, len(tensor))
+    else:
+        for tensor_i in tensor:
+            assign_values(tensor_i, values)
+
+def _rows(tensor: Tensor, *others: Tensor) -> Iterator[tuple]:
+    """
+    The matching 1-d rows of tensor and others (which have its shape).
+    The rows of tensor are lists or views of ArrayTensor storage, so
+    assigning to row[:] updates tensor.
+    """
+    if isinstance(tensor, ArrayTensor):
+        yield (tensor.flat(),) + tuple(other.flat() if isinstance(other, ArrayTensor)
+                                       else list(_flat_values(other))
+                                       for other in others)
+    elif is_1d(tensor):
+        yield (tensor,) + tuple(other.flat() if isinstance(other, ArrayTensor) else other
+                                for other in others)
+    else:
+        for rows in zip(tensor, *others):
+            yield from _rows(*rows)
+
+def _assign_row(row: Sequence[float], values: List[float]) -> None:
+    row[:] = values if isinstance(row, list) else ArrayVector(values)
+
+@backend_dispatch
+def add_scaled(tensor: Tensor, c: float, other: Tensor) -> None:
+    """tensor += c * other, in place"""
+    for row, other_row in _rows(tensor, other):
+        _assign_row(row, [x + c * y for x, y in zip(row, other_row)])
+
+@backend_dispatch
+def add_squares(tensor: Tensor, other: Tensor) -> None:
+    """tensor += other ** 2, in place"""
+    for row, other_row in _rows(tensor, other):
+        _assign_row(row, [x + y * y for x, y in zip(row, other_row)])
+
+@backend_dispatch
+def decay_toward(tensor: Tensor,
+                 decay: float,
+                 other: Tensor,
+                 square: bool = False) -> None:
+    """
+    tensor = decay * tensor + (1 - decay) * other, in place
+    (or with other ** 2, if square is True)
+    """
+    rest = 1 - decay
+    for row, other_row in _rows(tensor, other):
+        if square:
+            _assign_row(row, [decay * x + rest * y * y for x, y in zip(row, other_row)])
+        else:
+            _assign_row(row, [decay * x + rest * y for x, y in zip(row, other_row)])
+
+@backend_dispatch
+def subtract_scaled_ratio(param: Tensor,
+                          lr: float,
+                          numerator: Tensor,
+                          square: Tensor,
+                          epsilon: float) -> None:
+    """param -= lr * numerator / (sqrt(square) + epsilon), in place"""
+    sqrt = math.sqrt
+    for row, numerator_row, square_row in _rows(param, numerator, square):
+        _assign_row(row, [p - lr * n / (sqrt(s) + epsilon)
+                          for p, n, s in zip(row, numerator_row, square_row)])
+
+t1 = [[1.0, 2.0], [3.0, 4.0]]
+add_scaled(t1, -0.5, [[2, 2], [2, 2]])
+assert t1 == [[0, 1], [2, 3]]
+add_squares(t1, [[1, 1], [1, 2]])
+assert t1 == [[1, 2], [3, 7]]
+t2 = ArrayTensor([1.0, 2.0])
+decay_toward(t2, 0.5, [3.0, 0.0])
+assert t2 == [2.0, 1.0]
+decay_toward(t2, 0.5, [2.0, 1.0], square=True)
+assert t2 == [3.0, 1.0]
+subtract_scaled_ratio(t2, 2, [1.0, 1.0], [4.0, 1.0], 0)
+assert t2 == [2.0, -1.0]
+t3 = ArrayTensor([[1.0, 2.0], [3.0, 4.0]])[1:]    # a view, so offset != 0
+add_scaled(t3, 2, [[1.0, 1.0]])
+assert t3 == [[5.0, 6.0]]
+
 class GradientDescent(Optimizer):
     def __init__(self, learning_rate: float = 0.1) -> None:
         self.lr = learning_rate
 
     def step(self, layer: Layer) -> None:
         for param, grad in zip(layer.params(), layer.grads()):
-            # Update param using a gradient step
-            param[:] = tensor_combine(
-                lambda param, grad: param - grad * self.lr,
-                param,
-                grad)
+            # Update param using a gradient step, param -= lr * grad
+            add_scaled(param, -self.lr, grad)
 
 tensor = [[1, 2], [3, 4]]
 
@@ -310,17 +721,164 @@ class Momentum(Optimizer):
         for update, param, grad in zip(self.updates,
                                        layer.params(),
                                        layer.grads()):
-            # Apply momentum
-            update[:] = tensor_combine(
-                lambda u, g: self.mo * u + (1 - self.mo) * g,
-                update,
-                grad)
+            # Apply momentum: update = mo * update + (1 - mo) * grad
+            decay_toward(update, self.mo, grad)
 
             # Then take a gradient step
-            param[:] = tensor_combine(
-                lambda p, u: p - self.lr * u,
-                param,
-                update)
+            add_scaled(param, -self.lr, update)
+
+class AdaGrad(Optimizer):
+    """
+    Scales each parameter's step by the (square root of the) sum of all
+    its squared gradients so far, so frequently-updated parameters
+    take smaller steps.
+    """
+    def __init__(self,
+                 learning_rate: float = 0.01,
+                 epsilon: float = 1e-8) -> None:
+        self.lr = learning_rate
+        self.epsilon = epsilon
+        self.sums_of_squares: List[Tensor] = []
+
+    def step(self, layer: Layer) -> None:
+        if not self.sums_of_squares:
+            self.sums_of_squares = [zeros_like(grad) for grad in layer.grads()]
+
+        for total, param, grad in zip(self.sums_of_squares,
+                                      layer.params(),
+                                      layer.grads()):
+            add_squares(total, grad)
+            subtract_scaled_ratio(param, self.lr, grad, total, self.epsilon)
+
+class RMSProp(Optimizer):
+    """
+    Like AdaGrad, but uses a decaying average of the squared
+    gradients, so that the steps don't shrink forever.
+    """
+    def __init__(self,
+                 learning_rate: float = 0.001,
+                 decay: float = 0.9,
+                 epsilon: float = 1e-8) -> None:
+        self.lr = learning_rate
+        self.decay = decay
+        self.epsilon = epsilon
+        self.mean_squares: List[Tensor] = []
+
+    def step(self, layer: Layer) -> None:
+        if not self.mean_squares:
+            self.mean_squares = [zeros_like(grad) for grad in layer.grads()]
+
+        for mean_square, param, grad in zip(self.mean_squares,
+                                            layer.params(),
+                                            layer.grads()):
+            decay_toward(mean_square, self.decay, grad, square=True)
+            subtract_scaled_ratio(param, self.lr, grad, mean_square, self.epsilon)
+
+class Adam(Optimizer):
+    """
+    Momentum plus RMSProp: keeps decaying averages of both the gradients
+    and the squared gradients (corrected for starting out at zero).
+    """
+    def __init__(self,
+                 learning_rate: float = 0.001,
+                 beta1: float = 0.9,
+                 beta2: float = 0.999,
+                 epsilon: float = 1e-8) -> None:
+        self.lr = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.num_steps = 0
+        self.means: List[Tensor] = []
+        self.mean_squares: List[Tensor] = []
+
+    def step(self, layer: Layer) -> None:
+        if not self.means:
+            self.means = [zeros_like(grad) for grad in layer.grads()]
+            self.mean_squares = [zeros_like(grad) for grad in layer.grads()]
+
+        self.num_steps += 1
+
+        # Dividing the averages by these undoes their bias towards zero.
+        # Folding the corrections into the learning rate and epsilon means
+        # we don't need another pass over the values.
+        mean_correction = 1 - self.beta1 ** self.num_steps
+        square_correction = math.sqrt(1 - self.beta2 ** self.num_steps)
+        lr = self.lr * square_correction / mean_correction
+
+        for mean, mean_square, param, grad in zip(self.means,
+                                                  self.mean_squares,
+                                                  layer.params(),
+                                                  layer.grads()):
+            decay_toward(mean, self.beta1, grad)
+            decay_toward(mean_square, self.beta2, grad, square=True)
+            subtract_scaled_ratio(param, lr, mean, mean_square,
+                                  self.epsilon * square_correction)
+
+def benchmark_optimizers(num_steps: int = 20) -> None:
+    """Compares optimizer steps/sec on a 784 -> 30 -> 10 network"""
+    import timeit
+
+    model = Sequential([Linear(784, 30), Tanh(), Linear(30, 10)])
+    model.backward(tensor_apply(lambda _: 0.01,
+                                model.forward(random_uniform(784))))
+
+    # The same parameters and gradients as nested lists.
+    class NestedLists(Layer):
+        def __init__(self, model: Layer) -> None:
+            self._params = [param.tolist() for param in model.params()]
+            self._grads = [grad.tolist() for grad in model.grads()]
+
+        def params(self) -> Iterable[Tensor]:
+            return self._params
+
+        def grads(self) -> Iterable[Tensor]:
+            return self._grads
+
+    # The way the optimizers used to work, building a new tensor with
+    # tensor_combine and copying it into the parameter.
+    def old_gradient_descent(layer: Layer, lr: float = 0.1) -> None:
+        for param, grad in zip(layer.params(), layer.grads()):
+            param[:] = tensor_combine(lambda p, g: p - g * lr, param, grad)
+
+    def old_momentum(updates: List[Tensor], layer: Layer,
+                     mo: float = 0.9, lr: float = 0.1) -> None:
+        for update, param, grad in zip(updates, layer.params(), layer.grads()):
+            update[:] = tensor_combine(lambda u, g: mo * u + (1 - mo) * g,
+                                       update, grad)
+            param[:] = tensor_combine(lambda p, u: p - lr * u, param, update)
+
+    def best_steps_per_second(step: Callable[[], None]) -> float:
+        return num_steps / min(timeit.repeat(step, number=num_steps, repeat=3))
+
+    for description, layer in [("nested lists", NestedLists(model)),
+                               ("ArrayTensors", model)]:
+        updates = [zeros_like(grad) for grad in layer.grads()]
+        runs = [("GradientDescent", lambda: old_gradient_descent(layer),
+                 functools.partial(GradientDescent().step, layer)),
+                ("Momentum", lambda: old_momentum(updates, layer),
+                 functools.partial(Momentum(0.1).step, layer))]
+        for name, old_step, new_step in runs:
+            print(f"{description:>12} {name:>16}: "
+                  f"tensor_combine {best_steps_per_second(old_step):7.1f} steps/sec, "
+                  f"in place {best_steps_per_second(new_step):7.1f} steps/sec")
+
+    for optimizer in [AdaGrad(), RMSProp(), Adam()]:
+        name = optimizer.__class__.__name__
+        steps = best_steps_per_second(functools.partial(optimizer.step, model))
+        print(f"{'ArrayTensors':>12} {name:>16}: in place {steps:7.1f} steps/sec")
+
+    # With NumPy installed, the same kernels can run on the numpy backend.
+    from scratch.linear_algebra import using_backend
+    try:
+        with using_backend("numpy"):
+            for optimizer in [GradientDescent(), Momentum(0.1), AdaGrad(),
+                              RMSProp(), Adam()]:
+                name = optimizer.__class__.__name__
+                steps = best_steps_per_second(functools.partial(optimizer.step, model))
+                print(f"{'numpy':>12} {name:>16}: in place {steps:7.1f} steps/sec")
+    except ImportError:
+        print("(install numpy to benchmark the numpy backend)")
 
 import math
 
@@ -369,33 +927,118 @@ def softmax(tensor: Tensor) -> Tensor:
         return [softmax(tensor_i) for tensor_i in tensor]
 
 
+def softmax_cross_entropy(predicted: Tensor,
+                          actual: Tensor) -> Tuple[float, Tensor, Tensor]:
+    """
+    The softmax cross-entropy loss, its gradient, and the softmax
+    probabilities, all from a single pass over each example (so only one
+    exp per value). predicted can be one example or a batch of them; the
+    loss is the total over the batch, and the gradient and probabilities
+    come back as ArrayTensors shaped like predicted.
+    """
+    if is_1d(predicted):
+        rows, actual_rows = [predicted], [actual]
+    else:
+        rows, actual_rows = predicted, actual
+
+    probabilities = ArrayVector()
+    total_loss = 0.0
+
+    for row, actual_row in zip(rows, actual_rows):
+        # Subtract largest value for numerical stability.
+        largest = max(row)
+        exps = list(map(math.exp, map(operator.sub, row, itertools.repeat(largest))))
+        sum_of_exps = sum(exps)
+        probabilities.extend(map(operator.truediv, exps,
+                                 itertools.repeat(sum_of_exps)))
+
+        # log p_i = x_i - log(sum_j exp(x_j)), which (unlike log(p_i))
+        # can't underflow to log(0). Only the actual classes contribute.
+        log_sum_of_exps = largest + math.log(sum_of_exps)
+        total_loss -= sum(act * (x - log_sum_of_exps)
+                          for x, act in zip(row, actual_row) if act)
+
+    # Isn't this a pleasant equation?
+    gradient = ArrayVector(map(operator.sub, probabilities, _flat_values(actual)))
+
+    dims = shape(predicted)
+    return (total_loss,
+            ArrayTensor.from_flat(gradient, dims),
+            ArrayTensor.from_flat(probabilities, dims))
+
 class SoftmaxCrossEntropy(Loss):
     """
     This is the negative-log-likelihood of the observed values, given the
     neural net model. So if we choose weights to minimize it, our model will
     be maximizing the likelihood of the observed data.
+
+    Training needs both the loss and the gradient of each prediction, so
+    loss_and_gradient() gets them from a single softmax_cross_entropy pass.
     """
     def loss(self, predicted: Tensor, actual: Tensor) -> float:
-        # Apply softmax to get probabilities
-        probabilities = softmax(predicted)
+        return softmax_cross_entropy(predicted, actual)[0]
+
+    def gradient(self, predicted: Tensor, actual: Tensor) -> Tensor:
+        return softmax_cross_entropy(predicted, actual)[1]
+
+    def loss_and_gradient(self, predicted: Tensor,
+                          actual: Tensor) -> Tuple[float, Tensor]:
+        loss, gradient, _ = softmax_cross_entropy(predicted, actual)
+        return loss, gradient
 
-        # This will be log p_i for the actual class i and 0 for the other
-        # classes. We add a tiny amount to p to avoid taking log(0).
+sce_loss, sce_gradient, sce_probabilities = softmax_cross_entropy([0., 0.], [1., 0.])
+assert abs(sce_loss - math.log(2)) < 1e-12
+assert sce_gradient == [-0.5, 0.5] and sce_probabilities == [0.5, 0.5]
+
+# A confidently wrong prediction gets its true loss, rather than log(0).
+assert softmax_cross_entropy([[1000., 0.]], [[0., 1.]])[0] == 1000
+
+def benchmark_softmax_cross_entropy(num_runs: int = 1000) -> None:
+    """Compares the fused loss + gradient to computing them separately"""
+    import timeit
+
+    def old_loss(predicted: Tensor, actual: Tensor) -> float:
+        probabilities = softmax(predicted)
         likelihoods = tensor_combine(lambda p, act: math.log(p + 1e-30) * act,
                                      probabilities,
                                      actual)
-
-        # And then we just sum up the negatives.
         return -tensor_sum(likelihoods)
 
-    def gradient(self, predicted: Tensor, actual: Tensor) -> Tensor:
+    def old_gradient(predicted: Tensor, actual: Tensor) -> Tensor:
         probabilities = softmax(predicted)
-
-        # Isn't this a pleasant equation?
         return tensor_combine(lambda p, actual: p - actual,
                               probabilities,
                               actual)
 
+    random.seed(0)
+    for batch_size in [1, 64]:
+        predicted = ArrayTensor(random_normal(batch_size, 10, variance=4))
+        actual = [one_hot_encode(random.randrange(10))
+                  for _ in range(batch_size)]
+        if batch_size == 1:
+            predicted, actual = predicted[0], actual[0]
+
+        # Same answers (up to rounding in the loss) either way.
+        loss = SoftmaxCrossEntropy()
+        assert abs(loss.loss(predicted, actual) - old_loss(predicted, actual)) < 1e-9
+        assert loss.gradient(predicted, actual) == old_gradient(predicted, actual)
+        assert loss.loss_and_gradient(predicted, actual) == (loss.loss(predicted, actual),
+                                                             loss.gradient(predicted, actual))
+
+        def old_pair() -> None:
+            old_loss(predicted, actual)
+            old_gradient(predicted, actual)
+
+        def fused() -> None:
+            loss.loss_and_gradient(predicted, actual)
+
+        old_time = timeit.timeit(old_pair, number=num_runs)
+        fused_time = timeit.timeit(fused, number=num_runs)
+        print(f"batch of {batch_size:>2}: loss + gradient "
+              f"{1e6 * old_time / num_runs:8.1f}us, "
+              f"fused {1e6 * fused_time / num_runs:8.1f}us "
+              f"({old_time / fused_time:.1f}x)")
+
 class Dropout(Layer):
     def __init__(self, p: float) -> None:
         self.p = p
@@ -434,27 +1077,247 @@ assert one_hot_encode(2, num_labels=5) == [0, 0, 1, 0, 0]
 
 from scratch.linear_algebra import squared_distance
 
-import json
+# Checkpoints are binary rather than JSON, so that loading one is just
+# reading (or memory-mapping) raw floats instead of parsing text.
+# The layout, with every number little-endian:
+#
+#   magic           8 bytes, b"SCRATCHW"
+#   version         uint32
+#   typecode        1 byte, b"d" (float64) or b"f" (float32), + 3 bytes padding
+#   num_tensors     uint32
+#   manifest        for each tensor, its ndim (uint32) and then its dims (uint64s)
+#   padding         zeros, up to a multiple of 8 bytes
+#   data            every tensor's values, in row-major order, one after another
+
+import mmap
+import os
+import struct
+import sys
+
+CHECKPOINT_MAGIC = b"SCRATCHW"
+CHECKPOINT_VERSION = 1
+
+def checkpoint_header(shapes: List[Sequence[int]], typecode: str = 'd') -> bytes:
+    assert typecode in ('d', 'f'), "checkpoints hold float64 ('d') or float32 ('f')"
+    header = [CHECKPOINT_MAGIC,
+              struct.pack('<IcxxxI', CHECKPOINT_VERSION, typecode.encode(), len(shapes))]
+    for dims in shapes:
+        header.append(struct.pack(f'<I{len(dims)}Q', len(dims), *dims))
+
+    header = b''.join(header)
+    return header + bytes(-len(header) % 8)
+
+def read_checkpoint_header(buffer) -> Tuple[str, List[Tuple[int, ...]], int]:
+    """Returns the typecode, the shapes, and where the data starts"""
+    if bytes(buffer[:8]) != CHECKPOINT_MAGIC:
+        raise ValueError("not a checkpoint file")
+    version, typecode, num_tensors = struct.unpack_from('<IcxxxI', buffer, 8)
+    if version != CHECKPOINT_VERSION:
+        raise ValueError(f"unsupported checkpoint version {version}")
+
+    shapes = []
+    position = 20
+    for _ in range(num_tensors):
+        ndim, = struct.unpack_from('<I', buffer, position)
+        shapes.append(struct.unpack_from(f'<{ndim}Q', buffer, position + 4))
+        position += 4 + 8 * ndim
+
+    return typecode.decode(), shapes, position + (-position % 8)
+
+class CheckpointWriter:
+    """
+    Writes a checkpoint a chunk at a time, so the values never all have to
+    be in memory at once. The shapes go in the header, so they have to be
+    known up front; after that, call write() as many times as you like
+    with the values (of all the tensors, in order).
+
+    The checkpoint goes to a temporary file that replaces filename only
+    when it's complete. Besides not leaving half-written checkpoints
+    around, that means models memory-mapped from the old file keep working
+    (truncating a file out from under a memory map crashes the process).
+    """
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, filename: str, shapes: List[Sequence[int]],
+                 typecode: str = 'd') -> None:
+        self.filename = filename
+        self.file = open(filename + '.tmp', 'wb')
+        self.file.write(checkpoint_header(shapes, typecode))
+        self.typecode = typecode
+        self.expected = sum(functools.reduce(operator.mul, dims, 1) for dims in shapes)
+        self.written = 0
+
+    def write(self, values: Iterable[float]) -> None:
+        values = iter(values)
+        while True:
+            chunk = array(self.typecode, itertools.islice(values, self.CHUNK_SIZE))
+            if not chunk:
+                break
+            if sys.byteorder == 'big':
+                chunk.byteswap()
+            chunk.tofile(self.file)
+            self.written += len(chunk)
+
+    def close(self) -> None:
+        self.file.close()
+        if self.written != self.expected:
+            os.remove(self.file.name)
+            raise AssertionError(f"wrote {self.written} values, "
+                                 f"but the shapes call for {self.expected}")
+        os.replace(self.file.name, self.filename)
+
+    def __enter__(self) -> 'CheckpointWriter':
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            # Something went wrong mid-write; don't leave a partial file.
+            self.file.close()
+            os.remove(self.file.name)
+
+def save_weights(model: Layer, filename: str, typecode: str = 'd') -> None:
+    params = list(model.params())
+    with CheckpointWriter(filename, [shape(param) for param in params],
+                          typecode) as writer:
+        for param in params:
+            writer.write(_flat_values(param))
+
+def read_checkpoint(filename: str, use_mmap: bool = True) -> List[ArrayTensor]:
+    """
+    Reads every tensor in a checkpoint. With use_mmap (and float64 values
+    on a little-endian machine) the tensors are views of a copy-on-write
+    memory map of the file: nothing gets read until it's used, and writes
+    to the tensors don't change the file.
+    """
+    with open(filename, 'rb') as f:
+        if use_mmap:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            buffer = f.read()
 
-def save_weights(model: Layer, filename: str) -> None:
-    weights = list(model.params())
-    with open(filename, 'w') as f:
-        json.dump(weights, f)
+    typecode, shapes, start = read_checkpoint_header(buffer)
+    values = memoryview(buffer)[start:]
 
-def load_weights(model: Layer, filename: str) -> None:
-    with open(filename) as f:
-        weights = json.load(f)
+    if typecode == 'd' and sys.byteorder == 'little' and use_mmap:
+        data = values.cast('d')
+    else:
+        # Convert to native float64s, which means making a copy.
+        converted = array(typecode)
+        converted.frombytes(values)
+        if sys.byteorder == 'big':
+            converted.byteswap()
+        data = ArrayVector(converted)
+
+    tensors = []
+    offset = 0
+    for dims in shapes:
+        tensors.append(ArrayTensor.from_flat(data, dims, offset))
+        offset += tensors[-1].size
+    assert offset == len(data), "checkpoint data doesn't match its shapes"
+
+    return tensors
+
+def load_weights(model: Layer, filename: str, use_mmap: bool = False) -> None:
+    """
+    Loads a checkpoint into model. By default the values get copied into
+    the model's parameters; with use_mmap, ArrayTensor parameters instead
+    become views of the memory-mapped file, which avoids reading the whole
+    thing up front.
+    """
+    weights = read_checkpoint(filename, use_mmap)
+    params = list(model.params())
 
     # Check for consistency
+    assert len(params) == len(weights)
     assert all(shape(param) == shape(weight)
-               for param, weight in zip(model.params(), weights))
+               for param, weight in zip(params, weights))
+
+    for param, weight in zip(params, weights):
+        if use_mmap and isinstance(param, ArrayTensor):
+            param.data, param.offset = weight.data, weight.offset
+        else:
+            # Copy the values in, so list params stay lists of floats:
+            assign_values(param, weight.flat())
 
-    # Then load using slice assignment:
-    for param, weight in zip(model.params(), weights):
-        param[:] = weight
+def benchmark_checkpoints(input_dim: int = 1000, output_dim: int = 1000) -> None:
+    """Compare saving and loading JSON text to the binary checkpoints"""
+    import json
+    import tempfile
+    import time
+
+    random.seed(0)
+    model = Linear(input_dim, output_dim)
+    directory = tempfile.mkdtemp()
+    json_file = os.path.join(directory, "weights.json")
+    binary_file = os.path.join(directory, "weights.bin")
+
+    def time_it(description: str, fn: Callable[[], None], filename: str) -> None:
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        size = os.path.getsize(filename) / 2 ** 20
+        print(f"{description:>20}: {elapsed:6.3f}s  ({size:.1f} MB)")
+
+    def save_json() -> None:
+        with open(json_file, 'w') as f:
+            json.dump([param.tolist() for param in model.params()], f)
+
+    def load_json() -> None:
+        with open(json_file) as f:
+            weights = json.load(f)
+        assert all(shape(param) == shape(weight)
+                   for param, weight in zip(model.params(), weights))
+        for param, weight in zip(model.params(), weights):
+            param[:] = weight
+
+    print(f"Linear({input_dim}, {output_dim}) checkpoints")
+    time_it("save json", save_json, json_file)
+    time_it("save binary", lambda: save_weights(model, binary_file), binary_file)
+    time_it("load json", load_json, json_file)
+    time_it("load binary", lambda: load_weights(model, binary_file), binary_file)
+    time_it("load binary (mmap)",
+            lambda: load_weights(model, binary_file, use_mmap=True), binary_file)
+
+    # The round trip is exact for float64, and the mmapped weights work
+    # (and can be trained) like any others.
+    fresh = Linear(input_dim, output_dim)
+    load_weights(fresh, binary_file, use_mmap=True)
+    assert fresh.w == model.w and fresh.b == model.b
+    fresh.b[0] += 1
+    assert read_checkpoint(binary_file)[1][0] == model.b[0], "file is unchanged"
+
+    # float32 checkpoints are half the size, and round to float32 precision.
+    save_weights(model, binary_file, typecode='f')
+    load_weights(fresh, binary_file)
+    assert all(abs(x - y) < 1e-6 for x, y in zip(fresh.w.flat(), model.w.flat()))
+
+    # Loading into a differently shaped model fails.
+    try:
+        load_weights(Linear(output_dim, input_dim + 1), binary_file)
+        assert False, "shape mismatch should fail"
+    except AssertionError as e:
+        assert str(e) != "shape mismatch should fail"
+
+    os.remove(json_file)
+    os.remove(binary_file)
+    os.rmdir(directory)
+
+def benchmark():
+    """Run with `python -m scratch.deep_learning --benchmark`"""
+
+    # Compare the in-place optimizers to the old tensor_combine ones
+    benchmark_optimizers()
+
+    # Compare JSON weights to binary checkpoints
+    benchmark_checkpoints()
+
+    # Compare the fused softmax cross-entropy to the separate calls
+    benchmark_softmax_cross_entropy()
 
 def main():
-    
+
     # XOR revisited
     
     # training data
@@ -490,8 +1353,35 @@ def main():
     
     for param in net.params():
         print(param)
-    
-    
+
+    # Checkpoints round-trip into list-backed params too
+    import tempfile
+
+    class ListLayer(Layer):
+        def __init__(self) -> None:
+            self.w = random_tensor(3, 4)
+            self.b = random_tensor(3)
+            self.w_grad = [[1.0] * 4 for _ in range(3)]
+            self.b_grad = [1.0] * 3
+
+        def params(self) -> Iterable[Tensor]:
+            return [self.w, self.b]
+
+        def grads(self) -> Iterable[Tensor]:
+            return [self.w_grad, self.b_grad]
+
+    saved, restored = ListLayer(), ListLayer()
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "list_layer.bin")
+        save_weights(saved, filename)
+        load_weights(restored, filename)
+    assert restored.w == saved.w and restored.b == saved.b
+    assert all(type(x) is float for row in restored.w for x in row)
+
+    GradientDescent(learning_rate=0.5).step(restored)
+    assert restored.w[0][0] == saved.w[0][0] - 0.5
+
+
     # FizzBuzz Revisited
     
     from scratch.neural_networks import binary_encode, fizz_buzz_encode, argmax
@@ -560,8 +1450,8 @@ def main():
     
             for x, y in zip(xs, ys):
                 predicted = net.forward(x)
-                epoch_loss += loss.loss(predicted, y)
-                gradient = loss.gradient(predicted, y)
+                example_loss, gradient = loss.loss_and_gradient(predicted, y)
+                epoch_loss += example_loss
                 net.backward(gradient)
     
                 optimizer.step(net)
@@ -644,30 +1534,45 @@ def main():
     
     import tqdm
     
+    # Each step handles a batch of images with a few matrix products,
+    # which is several times faster per epoch than one image at a time.
+    # The batch gradient is the sum of the per-image gradients, so we
+    # use less momentum than we would for single-image steps.
+    BATCH_SIZE = 64
+    
     def loop(model: Layer,
              images: List[Tensor],
              labels: List[Tensor],
              loss: Loss,
-             optimizer: Optimizer = None) -> None:
+             optimizer: Optimizer = None,
+             batch_size: int = BATCH_SIZE) -> None:
         correct = 0         # Track number of correct predictions.
         total_loss = 0.0    # Track total loss.
     
-        with tqdm.trange(len(images)) as t:
-            for i in t:
-                predicted = model.forward(images[i])             # Predict.
-                if argmax(predicted) == argmax(labels[i]):       # Check for
-                    correct += 1                                 # correctness.
-                total_loss += loss.loss(predicted, labels[i])    # Compute loss.
+        with tqdm.trange(0, len(images), batch_size) as t:
+            for start in t:
+                batch_images = images[start:start + batch_size]
+                batch_labels = labels[start:start + batch_size]
+    
+                predicted = model.forward(batch_images)          # Predict.
+                for p, label in zip(predicted, batch_labels):    # Check for
+                    if argmax(p) == argmax(label):               # correctness.
+                        correct += 1
     
                 # If we're training, backpropagate gradient and update weights.
                 if optimizer is not None:
-                    gradient = loss.gradient(predicted, labels[i])
+                    batch_loss, gradient = loss.loss_and_gradient(predicted,
+                                                                  batch_labels)
+                    total_loss += batch_loss
                     model.backward(gradient)
                     optimizer.step(model)
+                else:
+                    total_loss += loss.loss(predicted, batch_labels)
     
                 # And update our metrics in the progress bar.
-                avg_loss = total_loss / (i + 1)
-                acc = correct / (i + 1)
+                seen = start + len(batch_images)
+                avg_loss = total_loss / seen
+                acc = correct / seen
                 t.set_description(f"mnist loss: {avg_loss:.3f} acc: {acc:.3f}")
     
     
@@ -680,7 +1585,7 @@ def main():
     loss = SoftmaxCrossEntropy()
     
     # This optimizer seems to work
-    optimizer = Momentum(learning_rate=0.01, momentum=0.99)
+    optimizer = Momentum(learning_rate=0.01, momentum=0.9)
     
     # Train on the training data
     loop(model, train_images, train_labels, loss, optimizer)
@@ -710,10 +1615,10 @@ def main():
     
     # Training the deep model for MNIST
     
-    optimizer = Momentum(learning_rate=0.01, momentum=0.99)
+    optimizer = Momentum(learning_rate=0.01, momentum=0.9)
     loss = SoftmaxCrossEntropy()
     
-    # Enable dropout and train (takes > 20 minutes on my laptop!)
+    # Enable dropout and train (batches of 64 make this several times faster)
     dropout1.train = dropout2.train = True
     loop(model, train_images, train_labels, loss, optimizer)
     
@@ -721,4 +1626,12 @@ def main():
     dropout1.train = dropout2.train = False
     loop(model, test_images, test_labels, loss)
     
-if __name__ == "__main__": main()
\ No newline at end of file
+if __name__ == "__main__":
+    import sys
+    if "--benchmark" in sys.argv[1:]:
+        # Use the module as scratch.deep_learning rather than __main__, since
+        # that's the name the numpy backend registers its kernels under.
+        from scratch.deep_learning import benchmark
+        benchmark()
+    else:
+        main()
\ No newline at end of file
@@ -2,6 +2,134 @@ from typing import List
 
 Vector = List[float]
 
+from array import array
+from typing import Iterable
+import operator
+
+class ArrayVector(array):
+    """
+    A Vector stored as one compact buffer of C doubles instead of a list
+    of boxed Python floats (8 bytes per element rather than ~32). It's a
+    real array, so it can be indexed, iterated, and passed to every
+    function in this module, which return ArrayVectors when given them.
+    """
+    def __new__(cls, values: Iterable[float] = ()) -> 'ArrayVector':
+        return super().__new__(cls, 'd', values)
+
+    # array's own versions of these return plain arrays
+    def __copy__(self) -> 'ArrayVector':
+        return ArrayVector(self)
+
+    def __deepcopy__(self, memo) -> 'ArrayVector':
+        return ArrayVector(self)
+
+def _is_array(v) -> bool:
+    """Arrays and memoryviews (e.g. ArrayMatrix rows) are compact vectors"""
+    return isinstance(v, (array, memoryview))
+
+assert list(ArrayVector([1, 2, 3])) == [1.0, 2.0, 3.0]
+
+from typing import Callable, Dict, Iterator, Tuple
+from contextlib import contextmanager
+import functools
+
+# The functions decorated with @backend_dispatch (here and in
+# scratch.statistics and scratch.deep_learning) can run either as the
+# pure-Python code you see or as vectorized NumPy code that lives in
+# scratch.numpy_backend. "python" is the default.
+_backend = "python"
+_implementations: Dict[str, Callable] = {}
+
+def set_backend(name: str) -> None:
+    """Switch every dispatched function to the named backend"""
+    global _backend, _implementations
+
+    if name == "python":
+        _implementations = {}
+    elif name == "numpy":
+        # Only import (and require) NumPy if someone asks for it.
+        from scratch.numpy_backend import IMPLEMENTATIONS
+        _implementations = IMPLEMENTATIONS
+    else:
+        raise ValueError(f"unknown backend: {name}")
+
+    _backend = name
+
+def get_backend() -> str:
+    return _backend
+
+@contextmanager
+def using_backend(name: str) -> Iterator[None]:
+    """Temporarily switch backends: `with using_backend("numpy"): ...`"""
+    previous = _backend
+    set_backend(name)
+    try:
+        yield
+    finally:
+        set_backend(previous)
+
+def backend_dispatch(fn: Callable) -> Callable:
+    """
+    Decorator that looks up the active backend's version of fn
+    (by module and function name) and falls back to fn itself.
+    """
+    key = f"{fn.__module__.split('.')[-1]}.{fn.__name__}"
+
+    @functools.wraps(fn)
+    def dispatched(*args, **kwargs):
+        return _implementations.get(key, fn)(*args, **kwargs)
+
+    return dispatched
+
+class SparseVector:
+    """
+    A Vector of length n that only stores its nonzero entries, as a dict
+    from index to value. Indexing and iterating behave as if it were the
+    full dense vector, but dot (and so sum_of_squares, magnitude, and
+    friends) only has to look at the nonzero entries.
+    """
+    def __init__(self, n: int, entries: Dict[int, float] = None) -> None:
+        self.n = n
+
+        # Keep the entries sorted by index, so that sums over them happen
+        # in the same order (and give the same answer) as the dense ones.
+        self.entries = {i: x for i, x in sorted((entries or {}).items())
+                        if x != 0}
+
+        assert all(0 <= i < n for i in self.entries), "index out of range"
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i: int) -> float:
+        return self.entries.get(i, 0)
+
+    def __iter__(self) -> Iterator[float]:
+        """Iterates over all n values, zeros included"""
+        return (self.entries.get(i, 0) for i in range(self.n))
+
+    def items(self) -> Iterable[Tuple[int, float]]:
+        """The (index, value) pairs for the nonzero entries"""
+        return self.entries.items()
+
+    def dot(self, other: Vector) -> float:
+        if isinstance(other, SparseVector) and len(other.entries) < len(self.entries):
+            # Loop over whichever vector has fewer nonzero entries.
+            return other.dot(self)
+
+        if isinstance(other, SparseVector):
+            return sum(x * other.entries[i]
+                       for i, x in self.entries.items()
+                       if i in other.entries)
+
+        return sum(x * other[i] for i, x in self.entries.items())
+
+    def todense(self) -> Vector:
+        return list(self)
+
+    def __repr__(self) -> str:
+        return f"SparseVector({self.n}, {self.entries})"
+
 height_weight_age = [70,  # inches,
                      170, # pounds,
                      40 ] # years
@@ -11,22 +139,31 @@ grades = [95,   # exam1
           75,   # exam3
           62 ]  # exam4
 
+@backend_dispatch
 def add(v: Vector, w: Vector) -> Vector:
     """Adds corresponding elements"""
     assert len(v) == len(w), "vectors must be the same length"
 
+    if _is_array(v):
+        return ArrayVector(map(operator.add, v, w))
+
     return [v_i + w_i for v_i, w_i in zip(v, w)]
 
 assert add([1, 2, 3], [4, 5, 6]) == [5, 7, 9]
 
+@backend_dispatch
 def subtract(v: Vector, w: Vector) -> Vector:
     """Subtracts corresponding elements"""
     assert len(v) == len(w), "vectors must be the same length"
 
+    if _is_array(v):
+        return ArrayVector(map(operator.sub, v, w))
+
     return [v_i - w_i for v_i, w_i in zip(v, w)]
 
 assert subtract([5, 7, 9], [4, 5, 6]) == [1, 2, 3]
 
+@backend_dispatch
 def vector_sum(vectors: List[Vector]) -> Vector:
     """Sums all corresponding elements"""
     # Check that vectors is not empty
@@ -36,18 +173,30 @@ def vector_sum(vectors: List[Vector]) -> Vector:
     num_elements = len(vectors[0])
     assert all(len(v) == num_elements for v in vectors), "different sizes!"
 
+    if _is_array(vectors[0]):
+        # accumulate into one buffer, one vector at a time
+        result = ArrayVector(vectors[0])
+        for vector in vectors[1:]:
+            result = ArrayVector(map(operator.add, result, vector))
+        return result
+
     # the i-th element of the result is the sum of every vector[i]
     return [sum(vector[i] for vector in vectors)
             for i in range(num_elements)]
 
 assert vector_sum([[1, 2], [3, 4], [5, 6], [7, 8]]) == [16, 20]
 
+@backend_dispatch
 def scalar_multiply(c: float, v: Vector) -> Vector:
     """Multiplies every element by c"""
+    if _is_array(v):
+        return ArrayVector(c * v_i for v_i in v)
+
     return [c * v_i for v_i in v]
 
 assert scalar_multiply(2, [1, 2, 3]) == [2, 4, 6]
 
+@backend_dispatch
 def vector_mean(vectors: List[Vector]) -> Vector:
     """Computes the element-wise average"""
     n = len(vectors)
@@ -55,14 +204,23 @@ def vector_mean(vectors: List[Vector]) -> Vector:
 
 assert vector_mean([[1, 2], [3, 4], [5, 6]]) == [3, 4]
 
+@backend_dispatch
 def dot(v: Vector, w: Vector) -> float:
     """Computes v_1 * w_1 + ... + v_n * w_n"""
     assert len(v) == len(w), "vectors must be same length"
 
-    return sum(v_i * w_i for v_i, w_i in zip(v, w))
+    # With a SparseVector we only need to look at its nonzero entries.
+    if isinstance(w, SparseVector) and not isinstance(v, SparseVector):
+        v, w = w, v
+    if isinstance(v, SparseVector):
+        return v.dot(w)
+
+    # map(operator.mul, ...) avoids creating a tuple for every pair
+    return sum(map(operator.mul, v, w))
 
 assert dot([1, 2, 3], [4, 5, 6]) == 32  # 1 * 4 + 2 * 5 + 3 * 6
 
+@backend_dispatch
 def sum_of_squares(v: Vector) -> float:
     """Returns v_1 * v_1 + ... + v_n * v_n"""
     return dot(v, v)
@@ -71,21 +229,31 @@ assert sum_of_squares([1, 2, 3]) == 14  # 1 * 1 + 2 * 2 + 3 * 3
 
 import math
 
+@backend_dispatch
 def magnitude(v: Vector) -> float:
     """Returns the magnitude (or length) of v"""
     return math.sqrt(sum_of_squares(v))   # math.sqrt is square root function
 
 assert magnitude([3, 4]) == 5
 
+@backend_dispatch
 def squared_distance(v: Vector, w: Vector) -> float:
     """Computes (v_1 - w_1) ** 2 + ... + (v_n - w_n) ** 2"""
-    return sum_of_squares(subtract(v, w))
+    assert len(v) == len(w), "vectors must be same length"
+
+    # same as sum_of_squares(subtract(v, w)), but without
+    # building the intermediate vector of differences
+    return sum(d * d for d in map(operator.sub, v, w))
+
+assert squared_distance([1, 2, 3], [4, 6, 3]) == 25
+assert squared_distance(ArrayVector([1, 2, 3]), ArrayVector([4, 6, 3])) == 25
 
 def distance(v: Vector, w: Vector) -> float:
     """Computes the distance between v and w"""
     return math.sqrt(squared_distance(v, w))
 
 
+@backend_dispatch
 def distance(v: Vector, w: Vector) -> float:  # type: ignore
     return magnitude(subtract(v, w))
 
@@ -115,6 +283,9 @@ def get_row(A: Matrix, i: int) -> Vector:
 
 def get_column(A: Matrix, j: int) -> Vector:
     """Returns the j-th column of A (as a Vector)"""
+    if isinstance(A, ArrayMatrix):
+        return A.column(j)  # strided view, no copying
+
     return [A_i[j]          # jth element of row A_i
             for A_i in A]   # for each row A_i
 
@@ -141,6 +312,324 @@ assert identity_matrix(5) == [[1, 0, 0, 0, 0],
                               [0, 0, 0, 1, 0],
                               [0, 0, 0, 0, 1]]
 
+class ArrayMatrix:
+    """
+    A num_rows x num_cols Matrix stored row-major in a single ArrayVector,
+    so element (i, j) lives at data[i * num_cols + j]. A[i] is a zero-copy
+    view of the i-th row, which means A[i][j], shape(A), get_row(A, i),
+    and all the vector functions above work just like they do on lists.
+    """
+    def __init__(self,
+                 num_rows: int,
+                 num_cols: int,
+                 values: Iterable[float] = None) -> None:
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+
+        if values is None:
+            # bytes(...) of the right length is a buffer of 0.0s
+            self.data = ArrayVector(bytes(8 * num_rows * num_cols))
+        else:
+            self.data = ArrayVector(values)
+
+        assert len(self.data) == num_rows * num_cols, "wrong number of values"
+
+        # memoryview lets us slice rows and columns without copying
+        self._view = memoryview(self.data)
+
+    @classmethod
+    def from_rows(cls, rows: Matrix) -> 'ArrayMatrix':
+        num_rows, num_cols = shape(rows)
+        return cls(num_rows, num_cols, (x for row in rows for x in row))
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def __getitem__(self, i: int) -> memoryview:
+        """The i-th row, as a view into the underlying buffer"""
+        if not -self.num_rows <= i < self.num_rows:
+            raise IndexError("row index out of range")
+        if i < 0:
+            i += self.num_rows
+        start = i * self.num_cols
+        return self._view[start:start + self.num_cols]
+
+    def __iter__(self):
+        return (self[i] for i in range(self.num_rows))
+
+    def column(self, j: int) -> memoryview:
+        """The j-th column, as a view that strides over the rows"""
+        return self._view[j::self.num_cols]
+
+    def tolist(self) -> Matrix:
+        return [row.tolist() for row in self]
+
+    def __repr__(self) -> str:
+        return f"ArrayMatrix({self.num_rows}, {self.num_cols}, {self.tolist()})"
+
+def make_array_matrix(num_rows: int,
+                      num_cols: int,
+                      entry_fn: Callable[[int, int], float]) -> ArrayMatrix:
+    """
+    Like make_matrix, but fills a single contiguous buffer
+    instead of creating one list per row
+    """
+    return ArrayMatrix(num_rows, num_cols,
+                       (entry_fn(i, j)
+                        for i in range(num_rows)
+                        for j in range(num_cols)))
+
+M = ArrayMatrix.from_rows([[1, 2, 3], [4, 5, 6]])
+assert shape(M) == (2, 3)
+assert M[1][2] == 6 and M[-1][0] == 4
+assert list(get_row(M, 0)) == [1, 2, 3]
+assert list(get_column(M, 1)) == [2, 5]
+assert dot(M[0], M[1]) == 32
+assert make_array_matrix(2, 2, lambda i, j: i + j).tolist() == [[0, 1], [1, 2]]
+
+M[0][0] = 10                      # rows are views, so writes go through
+assert M.data[0] == 10
+
+class SparseMatrix:
+    """
+    A num_rows x num_cols Matrix in compressed sparse row (CSR) form.
+    The nonzero values of row i are values[row_starts[i]:row_starts[i + 1]]
+    and their columns are the same slice of col_indices. So storage is
+    proportional to the number of nonzero entries, not to num_rows * num_cols.
+    """
+    def __init__(self,
+                 num_rows: int,
+                 num_cols: int,
+                 values: Iterable[float],
+                 col_indices: Iterable[int],
+                 row_starts: Iterable[int]) -> None:
+        self.num_rows = num_rows
+        self.num_cols = num_cols
+        self.values = ArrayVector(values)
+        self.col_indices = array('q', col_indices)
+        self.row_starts = array('q', row_starts)
+
+        assert len(self.row_starts) == num_rows + 1, "need num_rows + 1 starts"
+        assert len(self.values) == len(self.col_indices) == self.row_starts[-1]
+
+    @classmethod
+    def from_entries(cls,
+                     num_rows: int,
+                     num_cols: int,
+                     entries: Iterable[Tuple[int, int, float]]) -> 'SparseMatrix':
+        """Builds a matrix from (i, j, value) triples; duplicates are summed"""
+        totals: Dict[Tuple[int, int], float] = {}
+        for i, j, value in entries:
+            assert 0 <= i < num_rows and 0 <= j < num_cols, "out of range"
+            totals[(i, j)] = totals.get((i, j), 0) + value
+
+        values = ArrayVector()
+        col_indices = array('q')
+        row_counts = [0] * num_rows
+
+        for (i, j), value in sorted(totals.items()):
+            if value != 0:
+                values.append(value)
+                col_indices.append(j)
+                row_counts[i] += 1
+
+        # row_starts is the running total of the row counts
+        row_starts = array('q', [0])
+        for count in row_counts:
+            row_starts.append(row_starts[-1] + count)
+
+        return cls(num_rows, num_cols, values, col_indices, row_starts)
+
+    @classmethod
+    def from_rows(cls, rows: Matrix) -> 'SparseMatrix':
+        num_rows, num_cols = shape(rows)
+        return cls.from_entries(num_rows, num_cols,
+                                ((i, j, x)
+                                 for i, row in enumerate(rows)
+                                 for j, x in enumerate(row)
+                                 if x != 0))
+
+    def __len__(self) -> int:
+        return self.num_rows
+
+    def row_items(self, i: int) -> Iterator[Tuple[int, float]]:
+        """The (column, value) pairs for the nonzero entries of row i"""
+        start, end = self.row_starts[i], self.row_starts[i + 1]
+        return zip(self.col_indices[start:end], self.values[start:end])
+
+    def __getitem__(self, i: int) -> SparseVector:
+        """The i-th row, as a SparseVector"""
+        if not 0 <= i < self.num_rows:
+            raise IndexError("row index out of range")
+        return SparseVector(self.num_cols, dict(self.row_items(i)))
+
+    def __iter__(self) -> Iterator[SparseVector]:
+        return (self[i] for i in range(self.num_rows))
+
+    def times_vector(self, v: Vector) -> Vector:
+        """Multiplies by v, only touching the nonzero entries"""
+        assert len(v) == self.num_cols, "must have (# of cols) == len(v)"
+
+        result = []
+        for i in range(self.num_rows):
+            start, end = self.row_starts[i], self.row_starts[i + 1]
+            result.append(sum(map(operator.mul,
+                                  self.values[start:end],
+                                  map(v.__getitem__, self.col_indices[start:end]))))
+        return result
+
+    def transpose(self) -> 'SparseMatrix':
+        return SparseMatrix.from_entries(self.num_cols, self.num_rows,
+                                         ((j, i, x)
+                                          for i in range(self.num_rows)
+                                          for j, x in self.row_items(i)))
+
+    def todense(self) -> Matrix:
+        return [row.todense() for row in self]
+
+    def __repr__(self) -> str:
+        return (f"SparseMatrix({self.num_rows}, {self.num_cols}, "
+                f"{len(self.values)} nonzero entries)")
+
+def transpose(A: Matrix) -> Matrix:
+    """Returns the matrix whose (i, j)-th entry is A's (j, i)-th entry"""
+    if isinstance(A, SparseMatrix):
+        return A.transpose()
+
+    if isinstance(A, ArrayMatrix):
+        return ArrayMatrix(A.num_cols, A.num_rows,
+                           (x for j in range(A.num_cols) for x in A.column(j)))
+
+    return [list(column) for column in zip(*A)]
+
+assert transpose([[1, 2, 3], [4, 5, 6]]) == [[1, 4], [2, 5], [3, 6]]
+
+def matrix_times_vector(m: Matrix, v: Vector) -> Vector:
+    """Returns the vector whose i-th element is dot(m[i], v)"""
+    if isinstance(m, SparseMatrix):
+        return m.times_vector(v)
+
+    nr, nc = shape(m)
+    assert nc == len(v), "must have (# of cols in m) == (# of elements in v)"
+
+    products = (sum(map(operator.mul, row, v)) for row in m)
+    return ArrayVector(products) if _is_array(v) else list(products)
+
+assert matrix_times_vector([[1, 2], [3, 4]], [1, 1]) == [3, 7]
+
+def _multiply_block(rows: Matrix,
+                    columns: Matrix,
+                    block_size: int) -> Matrix:
+    """
+    Multiplies some rows of m1 by the (already transposed) columns of m2.
+    Working through the columns one tile at a time means each tile gets
+    reused for every row before we move on to the next one.
+    """
+    result = [[0.0] * len(columns) for _ in rows]
+
+    for j0 in range(0, len(columns), block_size):
+        tile = columns[j0:j0 + block_size]
+        for row, result_row in zip(rows, result):
+            # map(operator.mul, ...) multiplies a whole row by a whole
+            # column without a Python-level step per element.
+            result_row[j0:j0 + block_size] = [sum(map(operator.mul, row, col))
+                                              for col in tile]
+
+    return result
+
+# Each worker process gets its own copy of the transposed m2,
+# once, when the pool starts up.
+_worker_columns: Matrix = []
+_worker_block_size = 64
+
+def _init_worker(columns: Matrix, block_size: int) -> None:
+    global _worker_columns, _worker_block_size
+    _worker_columns = columns
+    _worker_block_size = block_size
+
+def _multiply_block_in_worker(rows: Matrix) -> Matrix:
+    return _multiply_block(rows, _worker_columns, _worker_block_size)
+
+def matrix_times_transpose(m1: Matrix,
+                           m2: Matrix,
+                           block_size: int = 64,
+                           num_workers: int = 1) -> Matrix:
+    """
+    Multiplies m1 by the transpose of m2, so that the (i, j)-th entry is
+    dot(m1[i], m2[j]), one block_size x block_size tile at a time.
+    With num_workers > 1 the blocks of rows of m1 are split across
+    a pool of processes.
+    """
+    nr1, nc1 = shape(m1)
+    nr2, nc2 = shape(m2)
+    assert nc1 == nc2, "must have (# of columns in m1) == (# of columns in m2)"
+
+    columns = [list(row) for row in m2]
+    rows = [list(row) for row in m1]
+    row_blocks = [rows[i:i + block_size] for i in range(0, nr1, block_size)]
+
+    if num_workers > 1:
+        import multiprocessing
+        with multiprocessing.Pool(num_workers,
+                                  initializer=_init_worker,
+                                  initargs=(columns, block_size)) as pool:
+            blocks = pool.map(_multiply_block_in_worker, row_blocks)
+    else:
+        blocks = [_multiply_block(block, columns, block_size)
+                  for block in row_blocks]
+
+    result = [row for block in blocks for row in block]
+
+    if isinstance(m1, ArrayMatrix):
+        return ArrayMatrix.from_rows(result)
+    return result
+
+assert matrix_times_transpose([[1, 2], [3, 4]], [[1, 0], [1, 1]]) == [[1, 3],
+                                                                     [3, 7]]
+
+def matrix_times_matrix(m1: Matrix,
+                        m2: Matrix,
+                        block_size: int = 64,
+                        num_workers: int = 1) -> Matrix:
+    """
+    Multiplies m1 by m2 one block_size x block_size tile at a time.
+    With num_workers > 1 the blocks of rows of m1 are split across
+    a pool of processes.
+    """
+    nr1, nc1 = shape(m1)
+    nr2, nc2 = shape(m2)
+    assert nc1 == nr2, "must have (# of columns in m1) == (# of rows in m2)"
+
+    # Transposing once means the j-th column of m2 is a contiguous row,
+    # rather than one element from each of nr2 different rows.
+    columns = [list(column) for column in zip(*m2)]
+
+    return matrix_times_transpose(m1, columns, block_size, num_workers)
+
+assert matrix_times_matrix([[1, 2], [3, 4]], [[5, 6], [7, 8]]) == [[19, 22],
+                                                                  [43, 50]]
+assert matrix_times_matrix([[1, 2, 3], [4, 5, 6]],
+                           identity_matrix(3),
+                           block_size=2) == [[1, 2, 3], [4, 5, 6]]
+
+sv = SparseVector(5, {3: 2.0, 0: 1.0, 4: 0})
+assert len(sv) == 5 and sv[3] == 2.0 and sv[1] == 0
+assert list(sv) == [1.0, 0, 0, 2.0, 0]
+assert dot(sv, [1, 2, 3, 4, 5]) == dot([1, 2, 3, 4, 5], sv) == 9
+assert dot(sv, SparseVector(5, {3: 3.0, 2: 5.0})) == 6
+assert magnitude(SparseVector(1000, {10: 3, 999: 4})) == 5
+
+sm = SparseMatrix.from_rows([[0, 2, 0],
+                             [1, 0, 0]])
+assert shape(sm) == (2, 3)
+assert list(sm.row_starts) == [0, 1, 2]
+assert sm[0][1] == 2 and sm[1][2] == 0
+assert matrix_times_vector(sm, [1, 2, 3]) == [4, 1]
+assert matrix_times_vector(sm, SparseVector(3, {0: 5})) == [0, 5]
+assert transpose(sm).todense() == [[0, 1], [2, 0], [0, 0]]
+assert SparseMatrix.from_entries(2, 2, [(0, 0, 1), (0, 0, 2)]).todense() == \
+       [[3, 0], [0, 0]]
+
 data = [[70, 170, 40],
         [65, 120, 26],
         [77, 250, 19],
@@ -171,3 +660,64 @@ friends_of_five = [i
                    for i, is_friend in enumerate(friend_matrix[5])
                    if is_friend]
 
+def main():
+    # Compare memory and time per operation for lists vs ArrayVectors.
+    import sys
+    import timeit
+    import random
+
+    print(f"{'n':>8} {'kind':>6} {'bytes':>10} "
+          f"{'add':>9} {'dot':>9} {'sq_dist':>9} {'vec_sum':>9}  (secs/op)")
+
+    for n in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]:
+        xs = [random.random() for _ in range(n)]
+        ys = [random.random() for _ in range(n)]
+
+        # A list holds n pointers to n separate float objects.
+        list_bytes = sys.getsizeof(xs) + sum(sys.getsizeof(x) for x in xs)
+        array_bytes = sys.getsizeof(ArrayVector(xs))
+
+        number = max(1, 10 ** 6 // n)
+        for kind, v, w, num_bytes in [("list", xs, ys, list_bytes),
+                                      ("array", ArrayVector(xs),
+                                       ArrayVector(ys), array_bytes)]:
+            times = [timeit.timeit(lambda: fn(v, w), number=number) / number
+                     for fn in [add,
+                                dot,
+                                squared_distance,
+                                lambda v, w: vector_sum([v, w, v, w])]]
+
+            print(f"{n:>8} {kind:>6} {num_bytes:>10} " +
+                  " ".join(f"{t:9.2e}" for t in times))
+
+    # Compare the tiled matrix multiply against the entry-at-a-time one.
+    def naive_matrix_times_matrix(m1: Matrix, m2: Matrix) -> Matrix:
+        nc1 = shape(m1)[1]
+        return make_matrix(shape(m1)[0], shape(m2)[1],
+                           lambda i, j: sum(m1[i][k] * m2[k][j]
+                                            for k in range(nc1)))
+
+    import multiprocessing
+    num_cpus = multiprocessing.cpu_count()
+
+    print(f"{'n':>8} {'naive':>9} {'tiled':>9} {f'{num_cpus} procs':>9}  (secs)")
+
+    for n in [100, 200, 500, 1000, 2000]:
+        m1 = [[random.random() for _ in range(n)] for _ in range(n)]
+        m2 = [[random.random() for _ in range(n)] for _ in range(n)]
+
+        # The naive version takes far too long on the bigger matrices.
+        if n <= 500:
+            naive = timeit.timeit(lambda: naive_matrix_times_matrix(m1, m2),
+                                  number=1)
+        else:
+            naive = float('nan')
+
+        tiled = timeit.timeit(lambda: matrix_times_matrix(m1, m2), number=1)
+        parallel = timeit.timeit(
+            lambda: matrix_times_matrix(m1, m2, num_workers=num_cpus),
+            number=1)
+
+        print(f"{n:>8} {naive:9.3f} {tiled:9.3f} {parallel:9.3f}")
+
+if __name__ == "__main__": main()
@@ -45,7 +45,7 @@ wc = word_count(["data science", "big data", "science fiction"])
 assert len(wc) == 4
 assert set(wc) == {("data", 2), ("science", 2), ("big", 1), ("fiction", 1)}
 
-from typing import Callable, Iterable, Any, Tuple
+from typing import Callable, Iterable, Any, Optional, Tuple
 
 # A key-value pair is just a 2-tuple
 KV = Tuple[Any, Any]
@@ -59,8 +59,28 @@ Reducer = Callable[[Any, Iterable], KV]
 
 def map_reduce(inputs: Iterable,
                mapper: Mapper,
-               reducer: Reducer) -> List[KV]:
-    """Run MapReduce on the inputs using mapper and reducer"""
+               reducer: Reducer,
+               max_pairs: int = None) -> List[KV]:
+    """
+    Run MapReduce on the inputs using mapper and reducer
+    (spilling to disk past max_pairs intermediate pairs, if given)
+    """
+    if max_pairs is not None:
+        return list(external_map_reduce(inputs, mapper, reducer, max_pairs))
+
+    fold = fold_of(reducer)
+    if fold is not None:
+        # An associative reducer only needs a running result for each key,
+        # not a list of all its values.
+        folded = {}
+        for input in inputs:
+            for key, value in mapper(input):
+                folded[key] = fold(folded[key], value) if key in folded else value
+
+        return [output
+                for key, value in folded.items()
+                for output in reducer_outputs(reducer, key, [value])]
+
     collector = defaultdict(list)
 
     for input in inputs:
@@ -69,13 +89,48 @@ def map_reduce(inputs: Iterable,
 
     return [output
             for key, values in collector.items()
-            for output in reducer(key, values)]
+            for output in reducer_outputs(reducer, key, values)]
+
+def reducer_outputs(reducer: Reducer, key: Any, values: List) -> Iterable[KV]:
+    """
+    A reducer can either return one key-value pair (like the ones from
+    values_reducer) or yield any number of them (like wc_reducer).
+    """
+    outputs = reducer(key, values)
+    return [outputs] if isinstance(outputs, tuple) else outputs
+
+import operator
 
-def values_reducer(values_fn: Callable) -> Reducer:
-    """Return a reducer that just applies values_fn to its values"""
+def associative(fold: Callable[[Any, Any], Any]) -> Callable[[Reducer], Reducer]:
+    """
+    Declares that a reducer's result for values [v1, v2, ..., vn] is the
+    same as for the single value fold(...fold(fold(v1, v2), v3)..., vn),
+    so values can be combined as they come instead of kept in a list.
+    """
+    def declare(reducer: Reducer) -> Reducer:
+        reducer.fold = fold
+        return reducer
+    return declare
+
+def fold_of(reducer: Reducer) -> Optional[Callable[[Any, Any], Any]]:
+    """The fold declared for reducer, if any"""
+    return getattr(reducer, "fold", None)
+
+# values_fns we know how to compute one value at a time
+FOLDS = {sum: operator.add, max: max, min: min}
+
+def values_reducer(values_fn: Callable, fold: Callable = None) -> Reducer:
+    """
+    Return a reducer that just applies values_fn to its values
+    (which is associative if values_fn is sum, max, or min, or if
+    you provide the fold yourself)
+    """
     def reduce(key, values: Iterable) -> KV:
         return (key, values_fn(values))
 
+    fold = fold or FOLDS.get(values_fn)
+    if fold is not None:
+        associative(fold)(reduce)
     return reduce
 
 sum_reducer = values_reducer(sum)
@@ -87,6 +142,12 @@ assert sum_reducer("key", [1, 2, 3, 3]) == ("key", 9)
 assert min_reducer("key", [1, 2, 3, 3]) == ("key", 1)
 assert max_reducer("key", [1, 2, 3, 3]) == ("key", 3)
 assert count_distinct_reducer("key", [1, 2, 3, 3]) == ("key", 3)
+assert map_reduce([[1, 2], [3]], lambda xs: [("n", x) for x in xs],
+                  sum_reducer) == [("n", 6)]
+assert fold_of(max_reducer) is max and fold_of(count_distinct_reducer) is None
+
+# wc_reducer just adds up counts.
+associative(operator.add)(wc_reducer)
 
 from typing import NamedTuple
 
@@ -138,6 +199,785 @@ B = [[4, -1, 0],
      [10, 0, 0],
      [0, 0, 0]]
 
+# That mapper sends every entry of A to every column of C, and every entry
+# of B to every row of C, so it shuffles (nonzeros of A) * num_cols_b +
+# (nonzeros of B) * num_rows_a pairs, however sparse the matrices are.
+#
+# Instead, we can key each entry by (a block of) the dimension A and B
+# share: A[i][j] and B[j][y] both go to block j // block_size. Each block's
+# reducer then has a tile of A's columns and the matching tile of B's rows,
+# and multiplies them locally into partial sums for C. A second, very
+# cheap job adds up the partial sums for each element of C. Now each
+# entry gets shuffled once, plus one pair per nonzero partial sum.
+
+def block_mapper(block_size: int) -> Mapper:
+    def mapper(entry: Entry) -> Iterator[Tuple[int, Entry]]:
+        shared = entry.j if entry.name == "A" else entry.i
+        yield (shared // block_size, entry)
+
+    return mapper
+
+def block_multiply_reducer(block: int,
+                           entries: Iterable[Entry]) -> Iterator[KV]:
+    """Multiplies one tile of A by one tile of B, yielding nonzero partial sums"""
+    a_entries = []
+    b_rows = defaultdict(list)      # j -> [(y, B[j][y]), ...]
+    for entry in entries:
+        if entry.name == "A":
+            a_entries.append(entry)
+        else:
+            b_rows[entry.i].append((entry.j, entry.value))
+
+    partial_sums: Dict[Tuple[int, int], float] = defaultdict(float)
+    for i, j, value in ((e.i, e.j, e.value) for e in a_entries):
+        for y, b_value in b_rows.get(j, ()):
+            partial_sums[(i, y)] += value * b_value
+
+    for key, partial_sum in partial_sums.items():
+        if partial_sum != 0.0:
+            yield (key, partial_sum)
+
+def identity_mapper(kv: KV) -> Iterator[KV]:
+    yield kv
+
+def sparse_matrix_multiply(entries: Iterable[Entry],
+                           block_size: int = 100,
+                           run: Callable[..., List[KV]] = None) -> List[KV]:
+    """
+    The nonzero elements ((i, j), value) of the product of the matrices
+    A and B given by entries. run is the map_reduce to use for both jobs
+    (map_reduce by default; parallel_map_reduce works too).
+    """
+    run = run or map_reduce
+    partial_sums = run(entries, block_mapper(block_size), block_multiply_reducer)
+    return [(key, value)
+            for key, value in run(partial_sums, identity_mapper, sum_reducer)
+            if value != 0.0]
+
+# When there are too many intermediate pairs to keep in memory, we can
+# shuffle by sorting instead, the way Hadoop does: buffer the mapper's
+# output up to max_pairs, sort the buffer by key, and write it to disk
+# (compressed) as a "run". At the end, a k-way merge of the runs yields
+# all the pairs in key order, so each key's values come out together and
+# can be streamed to the reducer. Keys have to be comparable with each other.
+
+import gzip
+import heapq
+import itertools
+import pickle
+import tempfile
+from operator import itemgetter
+from typing import BinaryIO, Dict
+
+MAX_PAIRS = 1000000
+
+def write_run(pairs: List[KV], batch_size: int = 1000) -> BinaryIO:
+    """Sorts pairs by key and writes them to a compressed temporary file"""
+    pairs.sort(key=itemgetter(0))      # stable, so values stay in order
+    f = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=1) as run:
+        for start in range(0, len(pairs), batch_size):
+            pickle.dump(pairs[start:start + batch_size], run, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+def read_run(f: BinaryIO) -> Iterator[KV]:
+    """The pairs written to f by write_run, a batch at a time"""
+    with f, gzip.GzipFile(fileobj=f, mode="rb") as run:
+        while True:
+            try:
+                batch = pickle.load(run)
+            except EOFError:
+                return
+            yield from batch
+
+def external_map_reduce(inputs: Iterable,
+                        mapper: Mapper,
+                        reducer: Reducer,
+                        max_pairs: int = MAX_PAIRS) -> Iterator[KV]:
+    """
+    Like map_reduce, but keeps at most max_pairs intermediate pairs in
+    memory (or, for an associative reducer, max_pairs folded keys), and
+    yields the outputs in key order as it goes. Each reducer gets its
+    values as an iterator, in input order, so it had better only make
+    one pass over them.
+    """
+    fold = fold_of(reducer)
+    runs: List[BinaryIO] = []
+    pairs: List[KV] = []
+    folded: Dict[Any, Any] = {}
+
+    for input in inputs:
+        for key, value in mapper(input):
+            if fold is not None:
+                folded[key] = fold(folded[key], value) if key in folded else value
+                if len(folded) >= max_pairs:
+                    runs.append(write_run(list(folded.items())))
+                    folded = {}
+            else:
+                pairs.append((key, value))
+                if len(pairs) >= max_pairs:
+                    runs.append(write_run(pairs))
+                    pairs = []
+
+    pairs = pairs or list(folded.items())
+    pairs.sort(key=itemgetter(0))
+    del folded
+
+    # heapq.merge takes equal keys from earlier runs first,
+    # so each key's values still come out in input order.
+    merged = heapq.merge(*[read_run(run) for run in runs], pairs, key=itemgetter(0))
+    for key, group in itertools.groupby(merged, key=itemgetter(0)):
+        # (With a fold, these are partial results, which the reducer
+        # treats just the same as the original values.)
+        values = map(itemgetter(1), group)
+        yield from reducer_outputs(reducer, key, values)
+
+# Running MapReduce on several processes. The inputs get split into
+# chunks, and a pool of worker processes runs the mapper on each chunk.
+# Each map task divides the keys it sees among num_partitions partitions
+# (by hash, so that every key lands in the same partition no matter which
+# task emitted it) and writes each partition to its own temporary file.
+# Then one reduce task per partition reads that partition's files from
+# every map task, groups the values by key, and runs the reducer.
+#
+# The values for each key still arrive in input order, so every reducer
+# sees exactly what it would have seen from map_reduce; only the order
+# of the output changes (it comes partition by partition).
+
+import collections
+import multiprocessing as mp
+import os
+import zlib
+from multiprocessing.pool import AsyncResult
+
+def stable_hash(key: Any) -> int:
+    """
+    Like hash(), but the same in every process. (Python salts the hashes
+    of strs differently in each interpreter, unless PYTHONHASHSEED is set,
+    and the map tasks all have to agree on where each key goes.) Keys can
+    be strs, bytes, numbers, None, or tuples and frozensets of those.
+    """
+    if isinstance(key, str):
+        return zlib.crc32(key.encode("utf-8", "surrogatepass"))
+    if isinstance(key, bytes):
+        return zlib.crc32(key)
+    if isinstance(key, tuple):
+        h = 0x345678
+        for item in key:
+            h = (h * 1000003 ^ stable_hash(item)) & 0xFFFFFFFFFFFF
+        return h
+    if isinstance(key, frozenset):
+        h = 0x1F3A              # xor, since sets iterate in any order
+        for item in key:
+            h ^= stable_hash(item)
+        return h
+    if key is None:
+        return 0
+    if isinstance(key, (int, float)):
+        return hash(key)        # numbers hash the same in every process
+    raise TypeError(f"can't partition on keys of type {type(key).__name__}")
+
+assert stable_hash("data") == zlib.crc32(b"data")
+assert stable_hash((1, "a")) == stable_hash((1, "a")) != stable_hash(("a", 1))
+assert stable_hash(frozenset(["a", "b"])) == stable_hash(frozenset(["b", "a"]))
+assert stable_hash(1) == stable_hash(1.0) == stable_hash(True)
+
+try:
+    stable_hash(object())   # its hash() is its address, different in every process
+    assert False, "keys without a stable hash should be rejected"
+except TypeError:
+    pass
+
+def chunks(inputs: Iterable, chunk_size: int) -> Iterator[list]:
+    """Splits inputs (lazily) into lists of chunk_size inputs"""
+    it = iter(inputs)
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+assert list(chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+# Each worker process's job, set up once by _init_worker.
+_mapper: Mapper = None
+_reducer: Reducer = None
+_combiner: Optional[Reducer] = None
+_fold: Optional[Callable[[Any, Any], Any]] = None
+_num_partitions = 0
+_directory = ""
+
+def _init_worker(mapper: Mapper, reducer: Reducer, combiner: Optional[Reducer],
+                 num_partitions: int, directory: str) -> None:
+    global _mapper, _reducer, _combiner, _fold, _num_partitions, _directory
+    _mapper, _reducer, _combiner = mapper, reducer, combiner
+    _fold = fold_of(reducer) if combiner is None else None
+    _num_partitions, _directory = num_partitions, directory
+
+def partition_file(directory: str, task_id: int, partition: int) -> str:
+    return os.path.join(directory, f"map-{task_id}-{partition}")
+
+class MapStats(NamedTuple):
+    task_id: int
+    partitions: List[int]   # which partitions got any keys
+    num_pairs: int          # emitted by the mapper
+    num_values: int         # written out for the reducers
+    num_bytes: int
+
+def _map_task(args: Tuple[int, list]) -> MapStats:
+    task_id, chunk = args
+    return map_inputs(task_id, chunk)
+
+def map_inputs(task_id: int, inputs: Iterable) -> MapStats:
+    """
+    Runs the mapper on inputs, combines what it can, and writes out
+    its partitions: for each key, the folded value (if the reducer has
+    a fold) or else the list of (combined) values.
+    """
+    num_pairs = 0
+    if _fold is not None:
+        fold = _fold
+        collector = {}
+        for input in inputs:
+            for key, value in _mapper(input):
+                collector[key] = fold(collector[key], value) if key in collector else value
+                num_pairs += 1
+        num_values = len(collector)
+    else:
+        collector = defaultdict(list)
+        for input in inputs:
+            for key, value in _mapper(input):
+                collector[key].append(value)
+                num_pairs += 1
+        if _combiner is not None:
+            combined = defaultdict(list)
+            for key, values in collector.items():
+                for output_key, output in reducer_outputs(_combiner, key, values):
+                    combined[output_key].append(output)
+            collector = combined
+        num_values = sum(len(values) for values in collector.values())
+
+    # Hash each distinct key once, rather than every pair.
+    partitions: List[Dict[Any, Any]] = [{} for _ in range(_num_partitions)]
+    for key, values in collector.items():
+        partitions[stable_hash(key) % _num_partitions][key] = values
+
+    nonempty = [p for p, groups in enumerate(partitions) if groups]
+    num_bytes = 0
+    for p in nonempty:
+        with open(partition_file(_directory, task_id, p), "wb") as f:
+            pickle.dump(partitions[p], f, pickle.HIGHEST_PROTOCOL)
+            num_bytes += f.tell()
+    return MapStats(task_id, nonempty, num_pairs, num_values, num_bytes)
+
+def _reduce_task(args: Tuple[int, List[int]]) -> List[KV]:
+    partition, task_ids = args
+    outputs = list(reduce_partition(partition, task_ids))
+    for task_id in task_ids:
+        os.remove(partition_file(_directory, task_id, partition))
+    return outputs
+
+def reduce_partition(partition: int, task_ids: List[int]) -> Iterator[KV]:
+    """Groups the values for one partition (in task order) and reduces them"""
+    fold = _fold
+    collector = {} if fold is not None else defaultdict(list)
+    for task_id in task_ids:
+        filename = partition_file(_directory, task_id, partition)
+        with open(filename, "rb") as f:
+            if fold is not None:
+                for key, value in pickle.load(f).items():
+                    collector[key] = fold(collector[key], value) if key in collector else value
+            else:
+                for key, values in pickle.load(f).items():
+                    collector[key].extend(values)
+
+    if fold is not None:
+        for key, value in collector.items():
+            yield from reducer_outputs(_reducer, key, [value])
+    else:
+        for key, values in collector.items():
+            yield from reducer_outputs(_reducer, key, values)
+
+def parallel_map_reduce(inputs: Iterable,
+                        mapper: Mapper,
+                        reducer: Reducer,
+                        num_workers: int = None,
+                        num_partitions: int = None,
+                        chunk_size: int = 1000,
+                        combiner: Reducer = None,
+                        stats: Dict[str, int] = None) -> List[KV]:
+    """
+    Like map_reduce, but runs the map and reduce tasks on num_workers
+    processes (by default, one per CPU), with num_partitions reduce tasks
+    (by default, 4 per worker). Inputs are read lazily, a few chunks ahead
+    of the workers, so they don't all have to fit in memory at once.
+
+    If given, combiner runs on each map task's values for each key before
+    they're shuffled, so it has to emit (key, value) pairs that reducer
+    can take in place of the originals. If not, and reducer is associative,
+    its fold combines values as they're emitted.
+
+    mapper, reducer, and combiner get to the workers through the pool's
+    initializer, so with the "fork" start method (the default on Linux)
+    they can be lambdas or closures; otherwise they need to be picklable.
+
+    If you pass a stats dict, it gets the number of pairs the mappers
+    emitted, and the number of values and bytes that got shuffled.
+    """
+    num_workers = num_workers or mp.cpu_count()
+    num_partitions = num_partitions or 4 * num_workers
+    totals = {"pairs": 0, "shuffled_values": 0, "shuffled_bytes": 0}
+
+    with tempfile.TemporaryDirectory(prefix="mapreduce-") as directory:
+        pool = mp.Pool(num_workers, initializer=_init_worker,
+                       initargs=(mapper, reducer, combiner, num_partitions, directory))
+        try:
+            # Map, keeping at most 2 chunks per worker in flight.
+            # (Pool.imap would read all of the inputs up front.)
+            tasks_by_partition: List[List[int]] = [[] for _ in range(num_partitions)]
+
+            def finish(result: AsyncResult) -> None:
+                map_stats = result.get()
+                for p in map_stats.partitions:
+                    tasks_by_partition[p].append(map_stats.task_id)
+                totals["pairs"] += map_stats.num_pairs
+                totals["shuffled_values"] += map_stats.num_values
+                totals["shuffled_bytes"] += map_stats.num_bytes
+
+            pending: collections.deque = collections.deque()
+            for task_id, chunk in enumerate(chunks(inputs, chunk_size)):
+                if len(pending) >= 2 * num_workers:
+                    finish(pending.popleft())
+                pending.append(pool.apply_async(_map_task, ((task_id, chunk),)))
+            while pending:
+                finish(pending.popleft())
+
+            # Reduce, one task per partition.
+            outputs = pool.map(_reduce_task,
+                               [(p, task_ids)
+                                for p, task_ids in enumerate(tasks_by_partition)
+                                if task_ids],
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    if stats is not None:
+        stats.update(totals)
+    return [output for partition_outputs in outputs for output in partition_outputs]
+
+# For inputs that live in big files, we don't want to read everything
+# through one process (as parallel_map_reduce does) or hold the outputs
+# in a list. Instead, run_job splits each newline-delimited file into byte
+# ranges, and each map task reads its own split straight from disk. When
+# a map task finishes, it writes a checkpoint, so if the job dies, running
+# it again only redoes the splits that hadn't finished. The reducers write
+# their outputs as JSON lines, into one "shard" file per partition.
+
+import json
+import shutil
+
+class Split(NamedTuple):
+    """The lines that *start* in bytes [start, end) of the file at path"""
+    path: str
+    start: int
+    end: int
+
+def byte_range_splits(paths: List[str], split_size: int) -> List[Split]:
+    return [Split(path, start, min(start + split_size, size))
+            for path in paths
+            for size in [os.path.getsize(path)]
+            for start in range(0, size, split_size)]
+
+def read_split(split: Split) -> Iterator[str]:
+    """The lines (without their newlines) that start in split"""
+    with open(split.path, "rb") as f:
+        position = split.start
+        if position > 0:
+            # Skip the line in progress at start (the previous split
+            # reads it). If start begins a line, this just reads the
+            # previous line's newline.
+            f.seek(position - 1)
+            position += len(f.readline()) - 1
+        while position < split.end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.rstrip(b"\r\n").decode("utf-8")
+
+def read_records(split: Split, format: str) -> Iterator[Any]:
+    """Lines of text, or (for format "json") one JSON value per nonblank line"""
+    if format == "text":
+        return read_split(split)
+    elif format == "json":
+        return (json.loads(line) for line in read_split(split) if line.strip())
+    raise ValueError(f"unknown format: {format}")
+
+def write_atomically(path: str, text: str) -> None:
+    """Writes text to path, so that path is either complete or missing"""
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+def checkpoint_file(directory: str, task_id: int) -> str:
+    return os.path.join(directory, f"split-{task_id}.done")
+
+def shard_file(directory: str, partition: int) -> str:
+    return os.path.join(directory, f"part-{partition:05d}")
+
+def _split_task(args: Tuple[int, Split, str]) -> MapStats:
+    """Maps one split, then checkpoints it (with what we need to reduce it)"""
+    task_id, split, format = args
+    stats = map_inputs(task_id, read_records(split, format))
+    write_atomically(checkpoint_file(_directory, task_id), json.dumps(stats._asdict()))
+    return stats
+
+def _shard_task(args: Tuple[int, List[int], str]) -> str:
+    """Reduces one partition into its shard"""
+    partition, task_ids, output_dir = args
+    shard = shard_file(output_dir, partition)
+    with open(shard + ".tmp", "w") as f:
+        for key, value in reduce_partition(partition, task_ids):
+            f.write(json.dumps([key, value]) + "\n")
+    os.replace(shard + ".tmp", shard)
+    return shard
+
+class JobSummary(NamedTuple):
+    shards: List[str]
+    splits_mapped: int
+    splits_skipped: int    # because they'd been checkpointed
+
+def run_job(paths: List[str],
+            mapper: Mapper,
+            reducer: Reducer,
+            output_dir: str,
+            format: str = "text",
+            split_size: int = 64 * 2**20,
+            num_partitions: int = 4,
+            num_workers: int = None,
+            combiner: Reducer = None) -> JobSummary:
+    """
+    Runs MapReduce over the lines of the files at paths (each line a string,
+    or, for format "json", parsed as JSON), writing the outputs as JSON
+    [key, value] lines to num_partitions shards in output_dir. Reducer
+    outputs have to be JSON-serializable (and tuples come back as lists).
+
+    Progress is kept in output_dir, so if the job fails, running it again
+    picks up where it left off; once it succeeds, output_dir/_SUCCESS
+    exists and running it again does nothing. To run a different job
+    (or the same one over changed files), use a new output_dir.
+    """
+    splits = byte_range_splits(paths, split_size)
+    os.makedirs(output_dir, exist_ok=True)
+    shards = [shard_file(output_dir, p) for p in range(num_partitions)]
+
+    # Checkpoints only make sense for the same splits and partitions.
+    job = {"splits": [list(split) for split in splits],
+           "num_partitions": num_partitions, "format": format}
+    manifest = os.path.join(output_dir, "_job.json")
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            if json.load(f) != job:
+                raise ValueError(f"{output_dir} has output from a different job")
+    else:
+        write_atomically(manifest, json.dumps(job))
+
+    if os.path.exists(os.path.join(output_dir, "_SUCCESS")):
+        return JobSummary(shards, 0, len(splits))
+
+    work_dir = os.path.join(output_dir, "_work")
+    os.makedirs(work_dir, exist_ok=True)
+    done: Dict[int, MapStats] = {}
+    for task_id in range(len(splits)):
+        if os.path.exists(checkpoint_file(work_dir, task_id)):
+            with open(checkpoint_file(work_dir, task_id)) as f:
+                done[task_id] = MapStats(**json.load(f))
+    todo = [task_id for task_id in range(len(splits)) if task_id not in done]
+
+    num_workers = num_workers or mp.cpu_count()
+    pool = mp.Pool(num_workers, initializer=_init_worker,
+                   initargs=(mapper, reducer, combiner, num_partitions, work_dir))
+    try:
+        # Map, keeping at most 2 splits per worker in flight, so that a
+        # failed split stops the job before the rest get mapped.
+        pending: collections.deque = collections.deque()
+        for task_id in todo:
+            if len(pending) >= 2 * num_workers:
+                stats = pending.popleft().get()
+                done[stats.task_id] = stats
+            pending.append(pool.apply_async(_split_task,
+                                            ((task_id, splits[task_id], format),)))
+        while pending:
+            stats = pending.popleft().get()
+            done[stats.task_id] = stats
+
+        # Reduce the partitions whose shards aren't written yet, taking
+        # each partition's map outputs in split order.
+        pool.map(_shard_task,
+                 [(p, [task_id for task_id in sorted(done)
+                       if p in done[task_id].partitions], output_dir)
+                  for p in range(num_partitions)
+                  if not os.path.exists(shards[p])],
+                 chunksize=1)
+        pool.close()
+    except BaseException:
+        # Stop the tasks still in flight. The splits that already finished
+        # have their checkpoints (written atomically), so a rerun skips them.
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    write_atomically(os.path.join(output_dir, "_SUCCESS"), "")
+    shutil.rmtree(work_dir)
+    return JobSummary(shards, len(todo), len(splits) - len(todo))
+
+def read_shards(shards: List[str]) -> Iterator[KV]:
+    """The (key, value) outputs written by run_job"""
+    for shard in shards:
+        with open(shard) as f:
+            for line in f:
+                key, value = json.loads(line)
+                yield (key, value)
+
+def write_corpus(f, corpus_bytes: int, seed: int = 0) -> None:
+    """
+    Writes about corpus_bytes of random text to f, one 20-word document per
+    line, from a Zipf-ish vocabulary: a few very common words, lots of rare ones.
+    """
+    import random
+    rng = random.Random(seed)
+    vocabulary = [f"word{i}" for i in range(100000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    start = f.tell()
+    while f.tell() - start < corpus_bytes:
+        words = rng.choices(vocabulary, weights, k=100000)
+        f.write("\n".join(" ".join(words[i:i + 20])
+                          for i in range(0, len(words), 20)) + "\n")
+    f.flush()
+
+def read_lines(filename: str) -> Iterator[str]:
+    with open(filename) as f:
+        yield from f
+
+def benchmark_sparse_matrix_multiply(n: int = 300,
+                                     densities: List[float] = [0.001, 0.01, 0.05],
+                                     block_size: int = 50) -> None:
+    """
+    n x n times n x n at each density, with matrix_multiply_mapper and
+    matrix_multiply_reducer, and with sparse_matrix_multiply
+    """
+    import random
+    import time
+
+    def counting(mapper: Mapper, counter: List[int]) -> Mapper:
+        """mapper, but adding the number of pairs it emits to counter[0]"""
+        def counted(input) -> Iterator[KV]:
+            for kv in mapper(input):
+                counter[0] += 1
+                yield kv
+        return counted
+
+    print(f"{n} x {n} matrices, blocks of {block_size}")
+    rng = random.Random(0)
+    for density in densities:
+        entries = [Entry(name, i, j, rng.uniform(-1, 1))
+                   for name in "AB"
+                   for i in range(n)
+                   for j in range(n)
+                   if rng.random() < density]
+
+        broadcast = [0]
+        start = time.time()
+        expected = dict(map_reduce(entries,
+                                   counting(matrix_multiply_mapper(n, n), broadcast),
+                                   matrix_multiply_reducer))
+        broadcast_time = time.time() - start
+
+        blocked = [0]
+        start = time.time()
+        partial_sums = map_reduce(entries, counting(block_mapper(block_size), blocked),
+                                  block_multiply_reducer)
+        product = dict((key, value)
+                       for key, value in map_reduce(partial_sums,
+                                                    counting(identity_mapper, blocked),
+                                                    sum_reducer)
+                       if value != 0.0)
+        blocked_time = time.time() - start
+
+        assert product.keys() == expected.keys()
+        assert all(abs(product[key] - expected[key]) < 1e-9 for key in expected)
+        print(f"  density {density:5.3f}, {len(entries):6d} entries: "
+              f"broadcast {broadcast_time:6.2f}s, {broadcast[0]:8d} pairs; "
+              f"blocked {blocked_time:6.2f}s, {blocked[0]:8d} pairs")
+
+def benchmark_external_shuffle(num_updates: int = 100000,
+                               max_pairs: int = 100000) -> None:
+    """
+    Peak memory of main()'s words-per-user job over synthetic status
+    updates, with the in-memory shuffle and with the external one.
+    """
+    import random
+    import time
+    import tracemalloc
+
+    def words_per_user_mapper(status_update: dict):
+        user = status_update["username"]
+        for word in tokenize(status_update["text"]):
+            yield (user, (word, 1))
+
+    def most_popular_word_reducer(user: str, words_and_counts: Iterable[KV]):
+        word_counts = Counter()
+        for word, count in words_and_counts:
+            word_counts[word] += count
+
+        word, count = word_counts.most_common(1)[0]
+        yield (user, (word, count))
+
+    vocabulary = [f"word{i}" for i in range(10000)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1)
+                                            for rank in range(len(vocabulary))))
+
+    def status_updates() -> Iterator[dict]:
+        """Generated as needed, so that the inputs themselves take no memory"""
+        rng = random.Random(0)
+        for _ in range(num_updates):
+            yield {"username": f"user{rng.randrange(num_updates // 10)}",
+                   "text": " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=20))}
+
+    print(f"{num_updates} status updates, {20 * num_updates} intermediate pairs")
+    results = []
+    for description, limit in [("in memory", None), (f"max_pairs={max_pairs}", max_pairs)]:
+        tracemalloc.start()
+        start = time.time()
+        results.append(sorted(map_reduce(status_updates(), words_per_user_mapper,
+                                          most_popular_word_reducer, limit)))
+        elapsed = time.time() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  {description:>16}: {elapsed:6.2f}s (traced), peak {peak / 1e6:6.1f}MB")
+    assert results[0] == results[1]
+
+def benchmark_streaming_job(corpus_bytes: int = 20000000, split_size: int = 2000000) -> None:
+    """
+    word_count over a file with run_job, vs parallel_map_reduce reading
+    the lines in this process; then the same job failing on its last
+    split and being resumed.
+    """
+    import time
+
+    def crashing_wc_mapper(document: str) -> Iterator[Tuple[str, int]]:
+        if document == "CRASH":
+            raise RuntimeError("simulated failure")
+        return wc_mapper(document)
+
+    with tempfile.TemporaryDirectory(prefix="job-") as directory:
+        corpus = os.path.join(directory, "corpus.txt")
+        with open(corpus, "w") as f:
+            write_corpus(f, corpus_bytes)
+            f.write("CRASH\n")
+        num_splits = len(byte_range_splits([corpus], split_size))
+        print(f"word_count on {os.path.getsize(corpus) / 1e6:.0f}MB, "
+              f"{num_splits} splits, {mp.cpu_count()} CPUs")
+
+        start = time.time()
+        expected = sorted(parallel_map_reduce(read_lines(corpus), wc_mapper, wc_reducer,
+                                              chunk_size=10000))
+        print(f"  {'parallel_map_reduce':>22}: {time.time() - start:6.2f}s")
+
+        start = time.time()
+        summary = run_job([corpus], wc_mapper, wc_reducer, os.path.join(directory, "run1"),
+                          split_size=split_size)
+        print(f"  {'run_job':>22}: {time.time() - start:6.2f}s")
+        assert sorted(map(tuple, read_shards(summary.shards))) == expected
+
+        output_dir = os.path.join(directory, "run2")
+        start = time.time()
+        try:
+            run_job([corpus], crashing_wc_mapper, wc_reducer, output_dir,
+                    split_size=split_size, num_workers=1)
+        except RuntimeError:
+            print(f"  {'run_job (fails)':>22}: {time.time() - start:6.2f}s")
+        start = time.time()
+        summary = run_job([corpus], wc_mapper, wc_reducer, output_dir, split_size=split_size)
+        print(f"  {'run_job (resumed)':>22}: {time.time() - start:6.2f}s, "
+              f"{summary.splits_mapped} split(s) mapped, {summary.splits_skipped} skipped")
+        assert sorted(map(tuple, read_shards(summary.shards))) == expected
+
+def benchmark_word_count(corpus_bytes: int = 50000000, chunk_size: int = 2000) -> None:
+    """
+    word_count over a synthetic corpus (one document per line), with
+    1 to N workers. Speedups are relative to 1 worker, since map_reduce
+    (shown for reference) folds wc_reducer's values as they're emitted.
+    """
+    import time
+
+    with tempfile.NamedTemporaryFile("w+", suffix=".txt") as corpus:
+        start = time.time()
+        write_corpus(corpus, corpus_bytes)
+        print(f"{corpus.tell() / 1e6:.0f}MB corpus written in {time.time() - start:.1f}s; "
+              f"{mp.cpu_count()} CPUs")
+
+        start = time.time()
+        expected = map_reduce(read_lines(corpus.name), wc_mapper, wc_reducer)
+        print(f"{'map_reduce':>14} {time.time() - start:7.2f}s")
+
+        for num_workers in range(1, max(mp.cpu_count(), 2) + 1):
+            start = time.time()
+            counts = parallel_map_reduce(read_lines(corpus.name), wc_mapper, wc_reducer,
+                                         num_workers, chunk_size=chunk_size)
+            elapsed = time.time() - start
+            assert sorted(counts) == sorted(expected)
+            if num_workers == 1:
+                one_worker = elapsed
+            speedup = one_worker / elapsed
+            print(f"{num_workers:>6} workers {elapsed:7.2f}s  "
+                  f"speedup {speedup:4.2f}  efficiency {speedup / num_workers:4.0%}")
+
+def benchmark_combiners(corpus_bytes: int = 20000000, chunk_size: int = 50000) -> None:
+    """
+    word_count with and without combining: peak memory of map_reduce,
+    and how much parallel_map_reduce has to shuffle.
+    """
+    import time
+    import tracemalloc
+
+    def list_wc_reducer(word: str, counts: Iterable[int]) -> Iterator[KV]:
+        """wc_reducer, but without the fold, so counts get collected in lists"""
+        yield from wc_reducer(word, counts)
+
+    with tempfile.NamedTemporaryFile("w+", suffix=".txt") as corpus:
+        write_corpus(corpus, corpus_bytes)
+        print(f"word_count on {corpus.tell() / 1e6:.0f}MB")
+
+        results = []
+        for description, reducer in [("lists", list_wc_reducer), ("folded", wc_reducer)]:
+            tracemalloc.start()
+            start = time.time()
+            results.append(sorted(map_reduce(read_lines(corpus.name), wc_mapper, reducer)))
+            elapsed = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"  map_reduce, {description:>8}: {elapsed:6.2f}s (traced), "
+                  f"peak {peak / 1e6:7.1f}MB")
+
+        for description, reducer, combiner in [("none", list_wc_reducer, None),
+                                               ("combiner", list_wc_reducer, wc_reducer),
+                                               ("folded", wc_reducer, None)]:
+            stats: Dict[str, int] = {}
+            start = time.time()
+            results.append(sorted(parallel_map_reduce(read_lines(corpus.name), wc_mapper,
+                                                      reducer, chunk_size=chunk_size,
+                                                      combiner=combiner, stats=stats)))
+            elapsed = time.time() - start
+            print(f"  parallel, {description:>10}: {elapsed:6.2f}s, "
+                  f"{stats['pairs']} pairs -> {stats['shuffled_values']} values, "
+                  f"{stats['shuffled_bytes'] / 1e6:.1f}MB shuffled")
+
+        assert all(result == results[0] for result in results)
+
 def main():
     
     # Analyzing status updates
@@ -205,5 +1045,123 @@ def main():
     # So it should have two entries.
     assert (set(map_reduce(entries, mapper, reducer)) ==
             {((0, 1), -3), ((0, 0), 32)})
-    
-if __name__ == "__main__": main()
\ No newline at end of file
+    for block_size in [1, 2, 100]:
+        assert (set(sparse_matrix_multiply(entries, block_size)) ==
+                {((0, 1), -3), ((0, 0), 32)})
+
+    # The parallel version gets the same results, even with closures
+    # for mappers and reducers and more workers than chunks.
+    documents = ["data science", "big data", "science fiction"] * 100
+    assert (sorted(parallel_map_reduce(documents, wc_mapper, wc_reducer,
+                                       num_workers=3, chunk_size=7)) ==
+            sorted(map_reduce(documents, wc_mapper, wc_reducer)))
+    assert (set(parallel_map_reduce(entries, mapper, reducer, num_workers=2,
+                                    chunk_size=2)) ==
+            {((0, 1), -3), ((0, 0), 32)})
+    assert (parallel_map_reduce(status_updates, words_per_user_mapper,
+                                most_popular_word_reducer, num_workers=2) ==
+            user_words)
+    assert parallel_map_reduce([], wc_mapper, wc_reducer, num_workers=2) == []
+    assert (set(sparse_matrix_multiply(entries, 1, run=parallel_map_reduce)) ==
+            {((0, 1), -3), ((0, 0), 32)})
+
+    # Combining before the shuffle: both an explicit combiner and the fold
+    # of an associative reducer cut down what gets shuffled, not the answer.
+    stats = {}
+    assert (sorted(parallel_map_reduce(documents, wc_mapper, sum_reducer, num_workers=2,
+                                       chunk_size=100, stats=stats)) ==
+            [("big", 100), ("data", 200), ("fiction", 100), ("science", 200)])
+    assert stats["pairs"] == 600 and stats["shuffled_values"] == 3 * 4
+    assert (sorted(parallel_map_reduce(documents, wc_mapper,
+                                       lambda word, counts: (word, sum(counts)),
+                                       combiner=sum_reducer, stats=stats)) ==
+            sorted(map_reduce(documents, wc_mapper, wc_reducer)))
+    assert stats["shuffled_values"] < stats["pairs"]
+
+    # Sorting to disk instead of grouping in memory: the same results,
+    # with at most a few pairs (or folded keys) in memory at once.
+    assert (sorted(map_reduce(documents, wc_mapper, wc_reducer, max_pairs=3)) ==
+            sorted(map_reduce(documents, wc_mapper, wc_reducer)))
+    assert (map_reduce(status_updates, words_per_user_mapper,
+                       most_popular_word_reducer, max_pairs=2) == user_words)
+    assert (set(map_reduce(entries, mapper, reducer, max_pairs=2)) ==
+            {((0, 1), -3), ((0, 0), 32)})
+    assert map_reduce([], wc_mapper, wc_reducer, max_pairs=2) == []
+
+    # Jobs over files: every line lands in exactly one byte-range split,
+    # completed splits survive a failure, and the output goes to shards.
+    with tempfile.TemporaryDirectory(prefix="job-") as directory:
+        lines = ["data science", "", "big data", "science fiction é"] * 50 + ["CRASH"]
+        documents_file = os.path.join(directory, "documents.txt")
+        with open(documents_file, "w") as f:
+            f.write("\n".join(lines))          # (no newline at the end)
+        for split_size in [1, 7, 100, 10**6]:
+            assert [line
+                    for split in byte_range_splits([documents_file], split_size)
+                    for line in read_split(split)] == lines
+
+        def crashing_wc_mapper(document: str) -> Iterator[Tuple[str, int]]:
+            if document == "CRASH":
+                raise RuntimeError("simulated failure")
+            return wc_mapper(document)
+
+        output_dir = os.path.join(directory, "word_counts")
+        try:
+            run_job([documents_file], crashing_wc_mapper, wc_reducer, output_dir,
+                    split_size=200, num_workers=1)
+            assert False, "the last split should have failed"
+        except RuntimeError:
+            pass
+        num_splits = len(byte_range_splits([documents_file], 200))
+
+        # A failure in the first split stops the job without mapping the rest.
+        crash_first_file = os.path.join(directory, "crash_first.txt")
+        with open(crash_first_file, "w") as f:
+            f.write("\n".join(lines[-1:] + lines[:-1]))
+        failing_dir = os.path.join(directory, "fails_first")
+        try:
+            run_job([crash_first_file], crashing_wc_mapper, wc_reducer, failing_dir,
+                    split_size=200, num_workers=1)
+            assert False, "the first split should have failed"
+        except RuntimeError:
+            pass
+        checkpoints = [name for name in os.listdir(os.path.join(failing_dir, "_work"))
+                       if name.endswith(".done")]
+        assert len(checkpoints) <= 2 < num_splits - 1
+        summary = run_job([documents_file], wc_mapper, wc_reducer, output_dir,
+                          split_size=200, num_workers=2)
+        assert summary.splits_mapped == 1 and summary.splits_skipped == num_splits - 1
+        assert (sorted(map(tuple, read_shards(summary.shards))) ==
+                sorted(map_reduce(lines, wc_mapper, wc_reducer)))
+        assert run_job([documents_file], wc_mapper, wc_reducer, output_dir,
+                       split_size=200).splits_mapped == 0
+        try:
+            run_job([documents_file], wc_mapper, wc_reducer, output_dir, split_size=100)
+            assert False, "different splits, so a different job"
+        except ValueError:
+            pass
+
+        # Newline-delimited JSON.
+        updates = [{"username": f"user{i % 7}", "text": f"data science {i % 3} big data",
+                    "liked_by": [f"user{i % 5}"]} for i in range(100)]
+        updates_file = os.path.join(directory, "status_updates.ndjson")
+        with open(updates_file, "w") as f:
+            f.writelines(json.dumps(update) + "\n" for update in updates)
+        summary = run_job([updates_file], words_per_user_mapper, most_popular_word_reducer,
+                          os.path.join(directory, "user_words"), format="json",
+                          split_size=1000, num_workers=2)
+        assert (sorted((user, tuple(word_count))
+                       for user, word_count in read_shards(summary.shards)) ==
+                sorted(map_reduce(updates, words_per_user_mapper, most_popular_word_reducer)))
+
+def benchmark():
+    """Run with `python -m scratch.mapreduce --benchmark`"""
+    benchmark_streaming_job()
+    benchmark_sparse_matrix_multiply()
+    benchmark_external_shuffle()
+    benchmark_combiners()
+    benchmark_word_count()
+
+if __name__ == "__main__":
+    import sys
+    benchmark() if "--benchmark" in sys.argv[1:] else main()
\ No newline at end of file
@@ -98,25 +98,15 @@ closeness_centrality = {user.id: 1 / farness(user.id) for user in users}
 
 from scratch.linear_algebra import Matrix, make_matrix, shape
 
-def matrix_times_matrix(m1: Matrix, m2: Matrix) -> Matrix:
-    nr1, nc1 = shape(m1)
-    nr2, nc2 = shape(m2)
-    assert nc1 == nr2, "must have (# of columns in m1) == (# of rows in m2)"
-
-    def entry_fn(i: int, j: int) -> float:
-        """dot product of i-th row of m1 with j-th column of m2"""
-        return sum(m1[i][k] * m2[k][j] for k in range(nc1))
-
-    return make_matrix(nr1, nc2, entry_fn)
-
+# Multiplying matrices one entry at a time (a generator over
+# m1[i][k] * m2[k][j] for every i, j) is very slow, so we use the
+# tiled versions from linear_algebra, which transpose m2 once and
+# can spread the work over several processes.
 from scratch.linear_algebra import Vector, dot
+from scratch.linear_algebra import matrix_times_matrix, matrix_times_vector
 
-def matrix_times_vector(m: Matrix, v: Vector) -> Vector:
-    nr, nc = shape(m)
-    n = len(v)
-    assert nc == n, "must have (# of cols in m) == (# of elements in v)"
-
-    return [dot(row, v) for row in m]  # output has length nr
+assert matrix_times_matrix([[1, 2], [3, 4]], [[0, 1], [1, 0]]) == [[2, 1],
+                                                                  [4, 3]]
 
 from typing import Tuple
 import random
@@ -124,7 +114,8 @@ from scratch.linear_algebra import magnitude, distance
 
 def find_eigenvector(m: Matrix,
                      tolerance: float = 0.00001) -> Tuple[Vector, float]:
-    guess = [random.random() for _ in m]
+    """m can be a list of lists or a SparseMatrix"""
+    guess = [random.random() for _ in range(len(m))]
 
     while True:
         result = matrix_times_vector(m, guess)    # transform guess
@@ -149,6 +140,31 @@ def entry_fn(i: int, j: int):
 n = len(users)
 adjacency_matrix = make_matrix(n, n, entry_fn)
 
+# Almost every entry of an adjacency matrix is 0, so for big networks
+# it's much better to build a SparseMatrix directly from the pairs.
+from scratch.linear_algebra import SparseMatrix
+
+def sparse_adjacency_matrix(num_users: int,
+                            pairs: List[Tuple[int, int]]) -> SparseMatrix:
+    """Each friendship (i, j) is an entry at (i, j) and one at (j, i)"""
+    return SparseMatrix.from_entries(num_users, num_users,
+                                     [(i, j, 1) for i, j in pairs] +
+                                     [(j, i, 1) for i, j in pairs])
+
+sparse_adjacency = sparse_adjacency_matrix(n, friend_pairs)
+assert sparse_adjacency.todense() == adjacency_matrix
+
+# (Both start from the same random guess, but we put the random state
+# back afterward, so that importing this module doesn't change it.)
+random_state = random.getstate()
+random.seed(0)
+dense_eigenvector, dense_eigenvalue = find_eigenvector(adjacency_matrix)
+random.seed(0)
+sparse_eigenvector, sparse_eigenvalue = find_eigenvector(sparse_adjacency)
+random.setstate(random_state)
+assert dense_eigenvector == sparse_eigenvector
+assert dense_eigenvalue == sparse_eigenvalue
+
 endorsements = [(0, 1), (1, 0), (0, 2), (2, 0), (1, 2),
                 (2, 1), (1, 3), (2, 3), (3, 4), (5, 4),
                 (5, 6), (7, 5), (6, 8), (8, 7), (8, 9)]
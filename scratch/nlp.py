@@ -582,8 +582,8 @@ def main():
         epoch_loss = 0.0
         for input, target in zip(inputs, targets):
             predicted = model.forward(input)
-            epoch_loss += loss.loss(predicted, target)
-            gradient = loss.gradient(predicted, target)
+            example_loss, gradient = loss.loss_and_gradient(predicted, target)
+            epoch_loss += example_loss
             model.backward(gradient)
             optimizer.step(model)
         print(epoch, epoch_loss)            # Print the loss
@@ -708,8 +708,8 @@ def main():
                 input = vocab.one_hot_encode(prev)
                 target = vocab.one_hot_encode(next)
                 predicted = model.forward(input)
-                epoch_loss += loss.loss(predicted, target)
-                gradient = loss.gradient(predicted, target)
+                example_loss, gradient = loss.loss_and_gradient(predicted, target)
+                epoch_loss += example_loss
                 model.backward(gradient)
                 optimizer.step(model)
     
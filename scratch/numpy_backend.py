@@ -0,0 +1,330 @@
+import numpy as np
+
+from typing import Callable, Dict, List
+
+# Vectorized versions of the @backend_dispatch functions in
+# scratch.linear_algebra, scratch.statistics, and scratch.deep_learning.
+# Don't use these directly; turn them on with
+#
+#   from scratch.linear_algebra import set_backend
+#   set_backend("numpy")
+#
+# Vectors, matrices, and tensors come back as numpy arrays, and scalars
+# come back as Python floats. Results agree with the pure-Python backend
+# up to floating point rounding (NumPy sums in a different order).
+
+IMPLEMENTATIONS: Dict[str, Callable] = {}
+
+def implements(name: str) -> Callable[[Callable], Callable]:
+    """Register fn as the NumPy version of e.g. 'linear_algebra.dot'"""
+    def register(fn: Callable) -> Callable:
+        IMPLEMENTATIONS[name] = fn
+        return fn
+    return register
+
+import sys
+
+def as_array(x) -> np.ndarray:
+    """Converts lists, ArrayVectors, ArrayMatrixes, and ArrayTensors to arrays"""
+    # Imported here so that this module doesn't create an import cycle.
+    from scratch.linear_algebra import ArrayMatrix
+
+    if isinstance(x, ArrayMatrix):
+        return np.frombuffer(x.data).reshape(x.num_rows, x.num_cols)
+
+    # Only check for ArrayTensors if someone has imported deep_learning.
+    deep_learning = sys.modules.get("scratch.deep_learning")
+    if deep_learning and isinstance(x, deep_learning.ArrayTensor):
+        return np.frombuffer(x.data, count=x.size,
+                             offset=8 * x.offset).reshape(x.shape)
+
+    return np.asarray(x, dtype=float)
+
+#
+# linear_algebra
+#
+
+@implements("linear_algebra.add")
+def add(v, w) -> np.ndarray:
+    v, w = as_array(v), as_array(w)
+    assert v.shape == w.shape, "vectors must be the same length"
+    return v + w
+
+@implements("linear_algebra.subtract")
+def subtract(v, w) -> np.ndarray:
+    v, w = as_array(v), as_array(w)
+    assert v.shape == w.shape, "vectors must be the same length"
+    return v - w
+
+@implements("linear_algebra.vector_sum")
+def vector_sum(vectors) -> np.ndarray:
+    assert len(vectors) > 0, "no vectors provided!"
+    return as_array(vectors).sum(axis=0)
+
+@implements("linear_algebra.scalar_multiply")
+def scalar_multiply(c: float, v) -> np.ndarray:
+    return c * as_array(v)
+
+@implements("linear_algebra.vector_mean")
+def vector_mean(vectors) -> np.ndarray:
+    return as_array(vectors).mean(axis=0)
+
+@implements("linear_algebra.dot")
+def dot(v, w) -> float:
+    v, w = as_array(v), as_array(w)
+    assert v.shape == w.shape, "vectors must be same length"
+    return float(np.dot(v, w))
+
+@implements("linear_algebra.sum_of_squares")
+def sum_of_squares(v) -> float:
+    v = as_array(v)
+    return float(np.dot(v, v))
+
+@implements("linear_algebra.magnitude")
+def magnitude(v) -> float:
+    return float(np.linalg.norm(as_array(v)))
+
+@implements("linear_algebra.squared_distance")
+def squared_distance(v, w) -> float:
+    diff = subtract(v, w)
+    return float(np.dot(diff, diff))
+
+@implements("linear_algebra.distance")
+def distance(v, w) -> float:
+    return float(np.linalg.norm(subtract(v, w)))
+
+#
+# statistics
+#
+
+@implements("statistics.mean")
+def mean(xs) -> float:
+    return float(np.mean(as_array(xs)))
+
+@implements("statistics.median")
+def median(v) -> float:
+    return float(np.median(as_array(v)))
+
+@implements("statistics.quantile")
+def quantile(xs, p: float) -> float:
+    p_index = int(p * len(xs))
+    return float(np.sort(as_array(xs))[p_index])
+
+@implements("statistics.data_range")
+def data_range(xs) -> float:
+    return float(np.ptp(as_array(xs)))
+
+@implements("statistics.de_mean")
+def de_mean(xs) -> np.ndarray:
+    xs = as_array(xs)
+    return xs - xs.mean()
+
+@implements("statistics.variance")
+def variance(xs) -> float:
+    assert len(xs) >= 2, "variance requires at least two elements"
+    return float(np.var(as_array(xs), ddof=1))
+
+@implements("statistics.standard_deviation")
+def standard_deviation(xs) -> float:
+    assert len(xs) >= 2, "variance requires at least two elements"
+    return float(np.std(as_array(xs), ddof=1))
+
+@implements("statistics.interquartile_range")
+def interquartile_range(xs) -> float:
+    return quantile(xs, 0.75) - quantile(xs, 0.25)
+
+@implements("statistics.covariance")
+def covariance(xs, ys) -> float:
+    assert len(xs) == len(ys), "xs and ys must have same number of elements"
+    return float(np.dot(de_mean(xs), de_mean(ys)) / (len(xs) - 1))
+
+@implements("statistics.correlation")
+def correlation(xs, ys) -> float:
+    stdev_x = standard_deviation(xs)
+    stdev_y = standard_deviation(ys)
+    if stdev_x > 0 and stdev_y > 0:
+        return covariance(xs, ys) / stdev_x / stdev_y
+    else:
+        return 0    # if no variation, correlation is zero
+
+#
+# deep_learning
+#
+
+import math
+import operator
+
+# Python functions that have an equivalent NumPy ufunc. Anything else
+# gets applied elementwise with np.vectorize, which is correct but
+# not much faster than the pure-Python version.
+UFUNCS: Dict[Callable, Callable] = {
+    operator.add: np.add,
+    operator.sub: np.subtract,
+    operator.mul: np.multiply,
+    operator.truediv: np.true_divide,
+    math.exp: np.exp,
+    math.tanh: np.tanh,
+    math.sqrt: np.sqrt,
+    math.log: np.log,
+    abs: np.abs,
+}
+
+@implements("deep_learning.tensor_sum")
+def tensor_sum(tensor) -> float:
+    return float(np.sum(as_array(tensor)))
+
+@implements("deep_learning.tensor_apply")
+def tensor_apply(f: Callable[[float], float], tensor) -> np.ndarray:
+    ufunc = UFUNCS.get(f) or np.vectorize(f, otypes=[float])
+    return ufunc(as_array(tensor))
+
+@implements("deep_learning.zeros_like")
+def zeros_like(tensor) -> np.ndarray:
+    return np.zeros_like(as_array(tensor))
+
+@implements("deep_learning.tensor_combine")
+def tensor_combine(f: Callable[[float, float], float], t1, t2) -> np.ndarray:
+    ufunc = UFUNCS.get(f) or np.vectorize(f, otypes=[float])
+    return ufunc(as_array(t1), as_array(t2))
+
+# The optimizer kernels update their first argument in place. For an
+# ArrayTensor, as_array gives a (writable) view of its storage, so we
+# can update that directly; nested lists need the results copied back.
+
+def _store(tensor, values: np.ndarray) -> None:
+    from scratch.deep_learning import ArrayTensor, assign_values
+
+    if not isinstance(tensor, (ArrayTensor, np.ndarray)):
+        assign_values(tensor, values.ravel().tolist())
+
+@implements("deep_learning.add_scaled")
+def add_scaled(tensor, c: float, other) -> None:
+    values = as_array(tensor)
+    values += c * as_array(other)
+    _store(tensor, values)
+
+@implements("deep_learning.add_squares")
+def add_squares(tensor, other) -> None:
+    values = as_array(tensor)
+    values += np.square(as_array(other))
+    _store(tensor, values)
+
+@implements("deep_learning.decay_toward")
+def decay_toward(tensor, decay: float, other, square: bool = False) -> None:
+    other = as_array(other)
+    if square:
+        other = np.square(other)
+
+    values = as_array(tensor)
+    values *= decay
+    values += (1 - decay) * other
+    _store(tensor, values)
+
+@implements("deep_learning.subtract_scaled_ratio")
+def subtract_scaled_ratio(param, lr: float, numerator, square,
+                          epsilon: float) -> None:
+    values = as_array(param)
+    values -= lr * as_array(numerator) / (np.sqrt(as_array(square)) + epsilon)
+    _store(param, values)
+
+def main():
+    # Parity suite: run every dispatched function under both backends
+    # on the same random inputs and check that the results agree.
+    import random
+    from scratch.linear_algebra import using_backend
+    from scratch import linear_algebra, statistics, deep_learning
+
+    random.seed(0)
+
+    def random_vector(n: int) -> List[float]:
+        return [random.uniform(-10, 10) for _ in range(n)]
+
+    v, w = random_vector(100), random_vector(100)
+    vectors = [random_vector(100) for _ in range(20)]
+    tensor = [[random_vector(5) for _ in range(4)] for _ in range(3)]
+    tensor2 = [[random_vector(5) for _ in range(4)] for _ in range(3)]
+
+    cases = [
+        (linear_algebra.add, (v, w)),
+        (linear_algebra.subtract, (v, w)),
+        (linear_algebra.vector_sum, (vectors,)),
+        (linear_algebra.scalar_multiply, (3.5, v)),
+        (linear_algebra.vector_mean, (vectors,)),
+        (linear_algebra.dot, (v, w)),
+        (linear_algebra.sum_of_squares, (v,)),
+        (linear_algebra.magnitude, (v,)),
+        (linear_algebra.squared_distance, (v, w)),
+        (linear_algebra.distance, (v, w)),
+        (linear_algebra.dot, (linear_algebra.ArrayVector(v),
+                              linear_algebra.ArrayVector(w))),
+        (statistics.mean, (v,)),
+        (statistics.median, (v,)),
+        (statistics.median, (v[:-1],)),
+        (statistics.quantile, (v, 0.9)),
+        (statistics.data_range, (v,)),
+        (statistics.de_mean, (v,)),
+        (statistics.variance, (v,)),
+        (statistics.standard_deviation, (v,)),
+        (statistics.interquartile_range, (v,)),
+        (statistics.covariance, (v, w)),
+        (statistics.correlation, (v, w)),
+        (statistics.correlation, (v, [1.0] * len(v))),
+        (deep_learning.tensor_sum, (tensor,)),
+        (deep_learning.tensor_apply, (math.exp, tensor)),
+        (deep_learning.tensor_apply, (lambda x: max(x, 0), tensor)),
+        (deep_learning.zeros_like, (tensor,)),
+        (deep_learning.tensor_combine, (operator.mul, tensor, tensor2)),
+        (deep_learning.tensor_combine, (lambda x, y: x * (1 - y),
+                                        tensor, tensor2)),
+        (deep_learning.tensor_sum, (deep_learning.ArrayTensor(tensor)[1],)),
+        (deep_learning.tensor_apply, (math.exp,
+                                      deep_learning.ArrayTensor(tensor))),
+    ]
+
+    for fn, args in cases:
+        with using_backend("python"):
+            expected = fn(*args)
+        with using_backend("numpy"):
+            actual = fn(*args)
+
+        assert np.allclose(as_array(expected), actual, rtol=1e-9, atol=1e-9), \
+            f"{fn.__module__}.{fn.__name__} differs between backends"
+
+    print(f"{len(cases)} functions agree across backends")
+
+    # The optimizers update parameters in place, so check those by
+    # training the same network under each backend.
+    def train(optimizer: deep_learning.Optimizer) -> List[List[float]]:
+        random.seed(0)
+        net = deep_learning.Sequential([deep_learning.Linear(3, 4),
+                                        deep_learning.Tanh(),
+                                        deep_learning.Linear(4, 2)])
+        loss = deep_learning.SSE()
+        for _ in range(20):
+            x = random_vector(3)
+            y = random_vector(2)
+            predicted = net.forward(x)
+            net.backward(loss.gradient(predicted, y))
+            optimizer.step(net)
+        return [list(as_array(param).ravel()) for param in net.params()]
+
+    optimizers = [lambda: deep_learning.GradientDescent(0.01),
+                  lambda: deep_learning.Momentum(0.01),
+                  lambda: deep_learning.AdaGrad(),
+                  lambda: deep_learning.RMSProp(),
+                  lambda: deep_learning.Adam()]
+
+    for make_optimizer in optimizers:
+        with using_backend("python"):
+            expected = train(make_optimizer())
+        with using_backend("numpy"):
+            actual = train(make_optimizer())
+
+        for expected_param, actual_param in zip(expected, actual):
+            assert np.allclose(expected_param, actual_param,
+                               rtol=1e-9, atol=1e-9), \
+                f"{make_optimizer().__class__.__name__} differs between backends"
+
+    print(f"{len(optimizers)} optimizers agree across backends")
+
+if __name__ == "__main__": main()
@@ -0,0 +1,393 @@
+import bisect
+import multiprocessing as mp
+import pickle
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from scratch.databases import (Table, ColumnarTable, Row, WhereClause,
+                               Comparison, And, Or, Aggregate, HashAggregator,
+                               aggregate_type, MAX_GROUPS)
+
+# A PartitionedTable splits its rows among several smaller tables (its
+# partitions) by the value of one column: either by hash, so that each
+# partition gets about the same number of rows, or by ranges of values,
+# so that a query on a range of that column only needs a few partitions.
+#
+# A ParallelExecutor then runs operations on the partitions in a pool
+# of worker processes and merges the results:
+#
+#  * where: each worker filters its partitions (skipping any that can't
+#    have matching rows), and we concatenate the matches;
+#  * group_by: each worker aggregates its partitions into partial states
+#    (a count and a sum for Avg, say), and we merge those, group by group;
+#  * join: if both tables are partitioned the same way on a join column,
+#    matching rows are always in the same-numbered partitions, so each
+#    worker joins one pair of partitions.
+#
+# Everything we send to the workers gets pickled, so predicates have to
+# be structured (col("score") > 0.5) or module-level functions, not
+# lambdas; aggregates have to be the built-in Aggregates (Count(), ...).
+#
+# The workers get the tables once, when the pool starts (for free, if the
+# operating system forks them), so changes made after that aren't seen.
+
+class PartitionedTable:
+    def __init__(self,
+                 columns: List[str],
+                 types: List[type],
+                 partition_column: str,
+                 num_partitions: int = None,
+                 boundaries: List[Any] = None,
+                 table_class: type = ColumnarTable) -> None:
+        """
+        Give num_partitions to partition by hash, or (sorted) boundaries to
+        partition by range: values < boundaries[0] go in partition 0, then
+        values < boundaries[1] in partition 1, ..., and the rest in the last.
+        """
+        if (num_partitions is None) == (boundaries is None):
+            raise ValueError("give num_partitions (hash) or boundaries (range)")
+        if partition_column not in columns:
+            raise ValueError(f"invalid column: {partition_column}")
+
+        self.columns = columns
+        self.types = types
+        self.partition_column = partition_column
+        self.boundaries = boundaries
+        self.num_partitions = (num_partitions if boundaries is None
+                               else len(boundaries) + 1)
+        self.partitions = [table_class(columns, types)
+                           for _ in range(self.num_partitions)]
+        self._column_index = columns.index(partition_column)
+
+    def partition_of(self, value: Any) -> int:
+        if self.boundaries is None:
+            # (hash() of a str differs between runs of Python, but we
+            # only ever compute it in this process.)
+            return hash(value) % self.num_partitions
+        if value is None:
+            return 0
+        return bisect.bisect_right(self.boundaries, value)
+
+    def same_partitioning(self, other: 'PartitionedTable') -> bool:
+        return (self.partition_column == other.partition_column and
+                self.num_partitions == other.num_partitions and
+                self.boundaries == other.boundaries)
+
+    def insert(self, values: list) -> None:
+        partition = self.partition_of(values[self._column_index])
+        self.partitions[partition].insert(values)
+
+    def insert_many(self, batch: Iterable[list]) -> None:
+        batches: List[List[list]] = [[] for _ in range(self.num_partitions)]
+        i = self._column_index
+        for values in batch:
+            batches[self.partition_of(values[i])].append(values)
+        for partition, partition_batch in zip(self.partitions, batches):
+            partition.insert_many(partition_batch)
+
+    def __len__(self) -> int:
+        return sum(len(partition) for partition in self.partitions)
+
+    @property
+    def rows(self) -> List[Row]:
+        """All the rows, partition by partition"""
+        return [row for partition in self.partitions for row in partition]
+
+    def might_match(self, partition: int, predicate: WhereClause) -> bool:
+        """Could any row in partition satisfy predicate? (True if we can't tell.)"""
+        if isinstance(predicate, And):
+            return (self.might_match(partition, predicate.left) and
+                    self.might_match(partition, predicate.right))
+        if isinstance(predicate, Or):
+            return (self.might_match(partition, predicate.left) or
+                    self.might_match(partition, predicate.right))
+        if (not isinstance(predicate, Comparison) or predicate.value is None or
+                predicate.column != self.partition_column):
+            return True
+
+        value = predicate.value
+        if self.boundaries is None:
+            return predicate.op != "==" or partition == self.partition_of(value)
+
+        # The partition has values in [lo, hi), where None means unbounded.
+        lo = self.boundaries[partition - 1] if partition > 0 else None
+        hi = self.boundaries[partition] if partition < len(self.boundaries) else None
+        try:
+            return {"==": (lo is None or lo <= value) and (hi is None or value < hi),
+                    "<": lo is None or lo < value,
+                    "<=": lo is None or lo <= value,
+                    ">": hi is None or hi > value,
+                    ">=": hi is None or hi > value,
+                    "!=": True}[predicate.op]
+        except TypeError:
+            return True
+
+ranged = PartitionedTable(["x"], [int], "x", boundaries=[10, 20])
+ranged.insert_many([[5], [10], [15], [25], [None]])
+assert [len(partition) for partition in ranged.partitions] == [2, 2, 1]
+assert [ranged.might_match(i, Comparison("x", "<", 10)) for i in range(3)] == \
+       [True, False, False]
+assert [ranged.might_match(i, Comparison("x", "==", 20)) for i in range(3)] == \
+       [False, False, True]
+
+def check_picklable(thing: Any, what: str) -> None:
+    try:
+        pickle.dumps(thing)
+    except (pickle.PicklingError, AttributeError, TypeError):
+        raise TypeError(f"{what} {thing!r} can't be sent to worker processes; "
+                        "use col(...) predicates, built-in Aggregates, or "
+                        "module-level functions") from None
+
+# The worker side. Each worker process gets the tables once, from
+# _init_worker, and then runs one task per partition.
+
+_tables: Dict[str, PartitionedTable] = {}
+
+def _init_worker(tables: Dict[str, PartitionedTable]) -> None:
+    global _tables
+    _tables = tables
+
+def as_columnar(table: Table) -> ColumnarTable:
+    """table as a ColumnarTable (which pickles much faster than dicts)"""
+    if isinstance(table, ColumnarTable):
+        return table
+    columnar = ColumnarTable(table.columns, table.types)
+    columnar.bulk_load(table.rows)
+    return columnar
+
+def _where_task(args: Tuple[str, int, WhereClause]) -> ColumnarTable:
+    name, partition, predicate = args
+    return as_columnar(_tables[name].partitions[partition].where(predicate))
+
+def partial_aggregate(table: Table,
+                      group_by_columns: List[str],
+                      aggregates: List[Aggregate]) -> List[Tuple[tuple, List[Any]]]:
+    """(key, partial states) for each group of rows in table"""
+    aggregator = HashAggregator(aggregates, max_groups=len(table) + 1)
+    table = as_columnar(table)
+    nones = [None] * len(table)
+    keys = zip(*[table.data[column] for column in group_by_columns])
+    values = zip(*[table.data[agg.column] if agg.column else nones
+                   for agg in aggregates])
+    for key, row_values in zip(keys, values):
+        aggregator.add(key, row_values)
+    return list(aggregator.groups.items())
+
+def _group_by_task(args: Tuple[str, int, List[str], List[Aggregate]]) -> List[Tuple[tuple, List[Any]]]:
+    name, partition, group_by_columns, aggregates = args
+    return partial_aggregate(_tables[name].partitions[partition],
+                             group_by_columns, aggregates)
+
+def _join_task(args: Tuple[str, str, int, bool]) -> ColumnarTable:
+    left, right, partition, left_join = args
+    left_partition = _tables[left].partitions[partition]
+    right_partition = _tables[right].partitions[partition]
+    return as_columnar(left_partition.join(right_partition, left_join))
+
+def concatenate(tables: Sequence[ColumnarTable]) -> ColumnarTable:
+    result = ColumnarTable(tables[0].columns, tables[0].types)
+    for table in tables:
+        result.insert_many(zip(*[table.data[column] for column in table.columns])
+                           if table.columns else [[]] * len(table),
+                           validate=False)
+    return result
+
+class ParallelExecutor:
+    """
+    Runs where, group_by, and join on PartitionedTables across
+    num_workers processes (by default, one per CPU).
+    """
+    def __init__(self,
+                 tables: Dict[str, PartitionedTable],
+                 num_workers: int = None) -> None:
+        self.tables = tables
+        self.num_workers = num_workers or mp.cpu_count()
+        self.pool = mp.Pool(self.num_workers,
+                            initializer=_init_worker, initargs=(tables,))
+
+    def where(self, name: str, predicate: WhereClause) -> ColumnarTable:
+        """The rows of table `name` satisfying predicate, partition by partition"""
+        check_picklable(predicate, "predicate")
+        table = self.tables[name]
+        tasks = [(name, partition, predicate)
+                 for partition in range(table.num_partitions)
+                 if table.might_match(partition, predicate)]
+        if not tasks:
+            return ColumnarTable(table.columns, table.types)
+        return concatenate(self.pool.map(_where_task, tasks))
+
+    def group_by(self,
+                 name: str,
+                 group_by_columns: List[str],
+                 aggregates: Dict[str, Aggregate],
+                 max_groups: int = MAX_GROUPS) -> ColumnarTable:
+        """Like Table.group_by, but only with built-in Aggregates (and no having)"""
+        for aggregate in aggregates.values():
+            if not isinstance(aggregate, Aggregate):
+                raise TypeError(f"{aggregate!r} isn't an Aggregate")
+        table = self.tables[name]
+        aggs = list(aggregates.values())
+
+        partials = self.pool.map(_group_by_task,
+                                 [(name, partition, group_by_columns, aggs)
+                                  for partition in range(table.num_partitions)])
+
+        # Merge the partial states. (If we grouped by the partition column,
+        # every group is in just one partition, so this is only bookkeeping.)
+        merged = HashAggregator(aggs, max_groups)
+        for partial in partials:
+            for key, states in partial:
+                merged.add_partial(key, states)
+
+        column_types = dict(zip(table.columns, table.types))
+        result = ColumnarTable(group_by_columns + list(aggregates.keys()),
+                               [column_types[column] for column in group_by_columns] +
+                               [aggregate_type(agg, column_types) for agg in aggs])
+        result.insert_many(list(key) + results for key, results in merged.results())
+        return result
+
+    def join(self, left: str, right: str, left_join: bool = False) -> ColumnarTable:
+        """
+        Joins tables `left` and `right` (like Table.join), which have to be
+        partitioned the same way on one of the columns they're joined on.
+        """
+        left_table, right_table = self.tables[left], self.tables[right]
+        join_on_columns = [c for c in left_table.columns if c in right_table.columns]
+        if (not left_table.same_partitioning(right_table) or
+                left_table.partition_column not in join_on_columns):
+            raise ValueError("can only join tables partitioned the same way "
+                             "on a join column")
+        return concatenate(self.pool.map(_join_task,
+                                         [(left, right, partition, left_join)
+                                          for partition in range(left_table.num_partitions)]))
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self) -> 'ParallelExecutor':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+def high_score(row: Row) -> bool:
+    """A module-level function is picklable, so it works as a predicate"""
+    return row["score"] > 0.99
+
+def same_rows(table1: Table, table2: Table) -> bool:
+    """Same rows in any order (with floats compared to 9 places, since
+    adding up partial sums changes the rounding)"""
+    def normalized(table: Table) -> List[str]:
+        return sorted(repr({column: round(value, 9) if isinstance(value, float) else value
+                            for column, value in row.items()})
+                      for row in table)
+    return normalized(table1) == normalized(table2)
+
+def benchmark_parallel(num_rows: int = 2000000, num_partitions: int = 16) -> None:
+    """Time for each operation, with 1 to N workers (and with one plain table)"""
+    import random
+    import time
+    from scratch.databases import col, Count, Avg
+
+    random.seed(0)
+    cities = [f"city{i}" for i in range(100)]
+    events = PartitionedTable(["user_id", "city", "score"], [int, str, float],
+                              "user_id", num_partitions=num_partitions)
+    single = ColumnarTable(events.columns, events.types)
+    num_users = num_rows // 100
+    users = PartitionedTable(["user_id", "name"], [int, str],
+                             "user_id", num_partitions=num_partitions)
+    users.insert_many([user_id, f"user{user_id}"] for user_id in range(num_users))
+
+    start = time.time()
+    batch_size = 1000000
+    for batch_start in range(0, num_rows, batch_size):
+        batch = [[random.randrange(num_users), random.choice(cities), random.random()]
+                 for _ in range(batch_start, min(batch_start + batch_size, num_rows))]
+        events.insert_many(batch)
+        single.insert_many(batch)
+    print(f"{num_rows} rows in {num_partitions} partitions, "
+          f"built in {time.time() - start:.1f}s; {mp.cpu_count()} CPUs")
+
+    operations = [
+        ("where", lambda run: run.where("events", col("score") > 0.99),
+                  lambda: single.where(col("score") > 0.99)),
+        ("where (function)", lambda run: run.where("events", high_score),
+                             lambda: single.where(high_score)),
+        ("group_by", lambda run: run.group_by("events", ["city"],
+                                               {"n": Count(), "avg": Avg("score")}),
+                     lambda: single.group_by(["city"], {"n": Count(), "avg": Avg("score")})),
+        ("join", lambda run: run.join("events", "users"), None),
+    ]
+
+    tables = {"events": events, "users": users}
+    for description, parallel, serial in operations:
+        # Speedup is measured against the same code with 1 worker; the
+        # single table's time is only for reference, since (for group_by,
+        # say) it doesn't aggregate the same way the workers do.
+        if serial is not None:
+            start = time.time()
+            expected = serial()
+            print(f"{description:>17}: single table {time.time() - start:6.2f}s")
+        else:
+            print(f"{description:>17}: (partition-wise only)")
+
+        for num_workers in range(1, max(mp.cpu_count(), 2) + 1):
+            with ParallelExecutor(tables, num_workers) as executor:
+                start = time.time()
+                result = parallel(executor)
+                elapsed = time.time() - start
+            if serial is not None:
+                assert same_rows(result, expected)
+            if num_workers == 1:
+                one_worker = elapsed
+            speedup = one_worker / elapsed
+            print(f"{num_workers:>10} workers: {elapsed:6.2f}s  speedup {speedup:4.2f}  "
+                  f"efficiency {speedup / num_workers:4.0%}")
+
+def main():
+    from scratch.databases import col, Count, Sum, Max
+
+    users = PartitionedTable(["user_id", "name", "num_friends"], [int, str, int],
+                             "user_id", num_partitions=3)
+    users.insert_many([[0, "Hero", 0], [1, "Dunn", 2], [2, "Sue", 3], [3, "Chi", 3],
+                       [4, "Thor", 3], [5, "Clive", 2], [6, "Hicks", 3],
+                       [7, "Devin", 2], [8, "Kate", 2], [9, "Klein", 3],
+                       [10, "Jen", 1]])
+    interests = PartitionedTable(["user_id", "interest"], [int, str],
+                                 "user_id", num_partitions=3)
+    interests.insert_many([[0, "SQL"], [0, "NoSQL"], [2, "SQL"], [2, "MySQL"]])
+
+    # The same answers as one big table (up to the order of the rows).
+    single_users = ColumnarTable(users.columns, users.types)
+    single_users.insert_many([row[c] for c in users.columns] for row in users.rows)
+    single_interests = ColumnarTable(interests.columns, interests.types)
+    single_interests.insert_many([row[c] for c in interests.columns]
+                                 for row in interests.rows)
+
+    with ParallelExecutor({"users": users, "interests": interests}, 2) as executor:
+        friendly = col("num_friends") >= 3
+        assert same_rows(executor.where("users", friendly), single_users.where(friendly))
+        assert [row["name"] for row in executor.where("users", col("user_id") == 4)] == \
+               ["Thor"]
+
+        aggregates = {"n": Count(), "total": Sum("user_id"), "most": Max("name")}
+        assert same_rows(executor.group_by("users", ["num_friends"], aggregates),
+                         single_users.group_by(["num_friends"], aggregates))
+
+        assert same_rows(executor.join("users", "interests", left_join=True),
+                         single_users.join(single_interests, left_join=True))
+
+        try:
+            executor.where("users", lambda row: row["num_friends"] > 2)
+            assert False, "lambdas can't be pickled"
+        except TypeError:
+            pass
+
+    # Only the partitions that might have user_id == 4 get scanned.
+    assert [users.might_match(i, col("user_id") == 4) for i in range(3)] == \
+           [False, True, False]
+
+if __name__ == "__main__":
+    import sys
+    benchmark_parallel() if "--benchmark" in sys.argv[1:] else main()
@@ -69,6 +69,28 @@ assert 0.56 < user_similarities[0][9] < 0.58, "several shared interests"
 # Users 0 and 8 share only one interest: Big Data
 assert 0.18 < user_similarities[0][8] < 0.20, "only one shared interest"
 
+# With lots of users and lots of interests, almost every entry of these
+# vectors is 0, so it's better to store them as SparseVectors, which
+# cosine_similarity (via dot) handles directly.
+from scratch.linear_algebra import SparseVector
+
+interest_ids = {interest: i for i, interest in enumerate(unique_interests)}
+
+def make_sparse_user_interest_vector(user_interests: List[str]) -> SparseVector:
+    """Like make_user_interest_vector, but only stores the 1s"""
+    return SparseVector(len(unique_interests),
+                        {interest_ids[interest]: 1
+                         for interest in user_interests})
+
+sparse_user_interest_vectors = [make_sparse_user_interest_vector(user_interests)
+                                for user_interests in users_interests]
+
+assert all(sparse_vector.todense() == dense_vector
+           for sparse_vector, dense_vector in zip(sparse_user_interest_vectors,
+                                                  user_interest_vectors))
+assert cosine_similarity(sparse_user_interest_vectors[0],
+                         sparse_user_interest_vectors[9]) == user_similarities[0][9]
+
 def most_similar_users_to(user_id: int) -> List[Tuple[int, float]]:
     pairs = [(other_user_id, similarity)                      # Find other
              for other_user_id, similarity in                 # users with
@@ -0,0 +1,1196 @@
+import operator
+import re
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from scratch.databases import (Table, Row, Predicate, Comparison, COMPARISONS, And, Or,
+                               PlanNode, Scan, Filter, Project, Limit, Sort,
+                               GroupBy, Join, Count, Sum, Min, Max, Avg,
+                               CountDistinct, all_of, optimize, execute_plan)
+
+# A small SQL front end for scratch.databases. A statement like
+#
+#   SELECT name, COUNT(*) AS num_interests
+#   FROM users JOIN user_interests USING (user_id)
+#   WHERE num_friends > ?
+#   GROUP BY name
+#
+# gets tokenized, parsed into a tree of NamedTuples, and then compiled
+# into the same plan nodes that Table.query() builds, which the optimizer
+# then rewrites: comparisons like num_friends > ? become col(...)
+# predicates, so they get pushed down past joins and into the scans
+# (where they can use indexes), unused columns get pruned, and the join
+# picks its strategy from the sizes of its inputs.
+#
+# Parsing and optimizing only depend on the text of the statement, so a
+# Database keeps the compiled Statements for the texts it has seen. The
+# ? parameters (and any subqueries) are looked up each time the statement
+# runs, which is why it can be reused with different values.
+#
+# It's a subset of SQL: joins are always on *all* the columns the two
+# sides share (like Table.join), column names can be qualified (users.name)
+# but the qualifier is ignored, subqueries can't refer to the outer query,
+# and an aggregate over zero rows gives zero rows, like Table.group_by.
+
+class SQLError(ValueError):
+    pass
+
+class Token(NamedTuple):
+    kind: str       # "number", "string", "name", "keyword", "op", or "end"
+    value: Any
+
+KEYWORDS = {"SELECT", "FROM", "WHERE", "GROUP", "BY", "HAVING", "ORDER",
+            "LIMIT", "JOIN", "LEFT", "OUTER", "INNER", "ON", "USING", "AS",
+            "AND", "OR", "NOT", "IN", "IS", "NULL", "TRUE", "FALSE", "ASC",
+            "DESC", "DISTINCT", "BETWEEN"}
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<number>\d+\.\d*|\.\d+|\d+)
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*|"[^"]+")
+  | (?P<op><=|>=|<>|!=|[-+*/=<>(),.?])
+""", re.VERBOSE)
+
+def tokenize(text: str) -> List[Token]:
+    tokens = []
+    position = 0
+    while position < len(text):
+        match = TOKEN_PATTERN.match(text, position)
+        if match is None:
+            raise SQLError(f"unexpected {text[position]!r} at position {position}")
+        position = match.end()
+
+        kind, value = match.lastgroup, match.group()
+        if kind == "space":
+            continue
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "string":
+            value = value[1:-1].replace("''", "'")
+        elif kind == "name":
+            if value.startswith('"'):
+                value = value[1:-1]                 # "quoted" name
+            elif value.upper() in KEYWORDS:
+                kind, value = "keyword", value.upper()
+        tokens.append(Token(kind, value))
+
+    tokens.append(Token("end", None))
+    return tokens
+
+assert [token.value for token in tokenize("select x FROM t where y >= 'it''s'")] == \
+       ["SELECT", "x", "FROM", "t", "WHERE", "y", ">=", "it's", None]
+assert tokenize("1.5 ?")[:2] == [Token("number", 1.5), Token("op", "?")]
+
+# The parse tree. Expressions are made of these:
+
+class ColumnRef(NamedTuple):
+    name: str
+
+class Literal(NamedTuple):
+    value: Any
+
+class Param(NamedTuple):
+    index: int                  # the first ? is 0, and so on
+
+class UnaryOp(NamedTuple):
+    op: str                     # "NOT" or "-"
+    operand: Any
+
+class BinaryOp(NamedTuple):
+    op: str                     # "AND", "OR", "+", "==", "<", ...
+    left: Any
+    right: Any
+
+class FunctionCall(NamedTuple):
+    name: str                   # uppercase, e.g. "COUNT"
+    args: tuple                 # COUNT(*) has no args
+    distinct: bool
+
+class IsNull(NamedTuple):
+    operand: Any
+    negated: bool
+
+class InList(NamedTuple):
+    operand: Any
+    items: tuple
+    negated: bool
+
+class InSubquery(NamedTuple):
+    operand: Any
+    select: 'Select'
+    negated: bool
+
+class Subquery(NamedTuple):
+    select: 'Select'            # a subquery with one row and one column
+
+EXPRESSIONS = (ColumnRef, Literal, Param, UnaryOp, BinaryOp, FunctionCall,
+               IsNull, InList, InSubquery, Subquery)
+
+# and statements of these:
+
+class SelectItem(NamedTuple):
+    expr: Any                   # None for *
+    alias: Optional[str]
+
+class TableSource(NamedTuple):
+    name: str
+
+class SubquerySource(NamedTuple):
+    select: 'Select'
+
+class JoinClause(NamedTuple):
+    source: Any                 # a TableSource or SubquerySource
+    left_join: bool
+    columns: Optional[tuple]    # from USING or ON, if given
+
+class Select(NamedTuple):
+    items: tuple
+    source: Any
+    joins: tuple
+    where: Any
+    group_by: tuple
+    having: Any
+    order_by: tuple             # of (expr, descending)
+    limit: Optional[int]
+
+COMPARISON_OPS = {"=": "==", "<>": "!=", "!=": "!=",
+                  "<": "<", "<=": "<=", ">": ">", ">=": ">="}
+
+class Parser:
+    """A recursive descent parser: one method per kind of thing"""
+    def __init__(self, text: str) -> None:
+        self.tokens = tokenize(text)
+        self.position = 0
+        self.num_params = 0
+
+    def peek(self) -> Token:
+        return self.tokens[self.position]
+
+    def advance(self) -> Token:
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def at(self, *values: str) -> bool:
+        token = self.peek()
+        return token.kind in ("keyword", "op") and token.value in values
+
+    def accept(self, *values: str) -> bool:
+        if self.at(*values):
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, value: str) -> None:
+        if not self.accept(value):
+            raise SQLError(f"expected {value} but got {self.peek().value!r}")
+
+    def name(self) -> str:
+        token = self.advance()
+        if token.kind != "name":
+            raise SQLError(f"expected a name but got {token.value!r}")
+        return token.value
+
+    def column_name(self) -> str:
+        name = self.name()
+        if self.accept("."):            # users.name is just name
+            name = self.name()
+        return name
+
+    def parse(self) -> Select:
+        select = self.select()
+        if self.peek().kind != "end":
+            raise SQLError(f"unexpected {self.peek().value!r}")
+        return select
+
+    def select(self) -> Select:
+        self.expect("SELECT")
+        items = [self.select_item()]
+        while self.accept(","):
+            items.append(self.select_item())
+
+        self.expect("FROM")
+        source = self.source()
+        joins = []
+        while self.at("JOIN", "LEFT", "INNER"):
+            left_join = self.accept("LEFT")
+            if left_join:
+                self.accept("OUTER")
+            else:
+                self.accept("INNER")
+            self.expect("JOIN")
+            joins.append(self.join(left_join))
+
+        where = self.expression() if self.accept("WHERE") else None
+
+        group_by: List[Any] = []
+        if self.accept("GROUP"):
+            self.expect("BY")
+            group_by = self.expression_list()
+
+        having = self.expression() if self.accept("HAVING") else None
+
+        order_by = []
+        if self.accept("ORDER"):
+            self.expect("BY")
+            order_by.append(self.order_item())
+            while self.accept(","):
+                order_by.append(self.order_item())
+
+        limit = None
+        if self.accept("LIMIT"):
+            token = self.advance()
+            if not isinstance(token.value, int) or token.kind != "number":
+                raise SQLError(f"LIMIT needs a whole number, not {token.value!r}")
+            limit = token.value
+
+        return Select(tuple(items), source, tuple(joins), where,
+                      tuple(group_by), having, tuple(order_by), limit)
+
+    def select_item(self) -> SelectItem:
+        if self.accept("*"):
+            return SelectItem(None, None)
+        expr = self.expression()
+        if self.accept("AS") or self.peek().kind == "name":
+            return SelectItem(expr, self.name())
+        return SelectItem(expr, None)
+
+    def source(self) -> Any:
+        if self.accept("("):
+            source: Any = SubquerySource(self.select())
+            self.expect(")")
+        else:
+            source = TableSource(self.name())
+        # (We don't need aliases, since columns aren't qualified.)
+        if self.accept("AS") or self.peek().kind == "name":
+            self.name()
+        return source
+
+    def join(self, left_join: bool) -> JoinClause:
+        source = self.source()
+        columns = None
+        if self.accept("USING"):
+            self.expect("(")
+            columns = [self.name()]
+            while self.accept(","):
+                columns.append(self.name())
+            self.expect(")")
+        elif self.accept("ON"):
+            columns = []
+            while True:
+                left = self.column_name()
+                self.expect("=")
+                right = self.column_name()
+                if left != right:
+                    raise SQLError(f"can only join on columns with the same name, "
+                                   f"not {left} = {right}")
+                columns.append(left)
+                if not self.accept("AND"):
+                    break
+        return JoinClause(source, left_join,
+                          None if columns is None else tuple(columns))
+
+    def order_item(self) -> Tuple[Any, bool]:
+        expr = self.expression()
+        if self.accept("DESC"):
+            return (expr, True)
+        self.accept("ASC")
+        return (expr, False)
+
+    def expression_list(self) -> List[Any]:
+        exprs = [self.expression()]
+        while self.accept(","):
+            exprs.append(self.expression())
+        return exprs
+
+    # Expressions, from the loosest-binding operator to the tightest.
+
+    def expression(self) -> Any:
+        expr = self.conjunction()
+        while self.accept("OR"):
+            expr = BinaryOp("OR", expr, self.conjunction())
+        return expr
+
+    def conjunction(self) -> Any:
+        expr = self.negation()
+        while self.accept("AND"):
+            expr = BinaryOp("AND", expr, self.negation())
+        return expr
+
+    def negation(self) -> Any:
+        if self.accept("NOT"):
+            return UnaryOp("NOT", self.negation())
+        return self.comparison()
+
+    def comparison(self) -> Any:
+        left = self.additive()
+        if self.at(*COMPARISON_OPS):
+            op = COMPARISON_OPS[self.advance().value]
+            return BinaryOp(op, left, self.additive())
+
+        if self.accept("IS"):
+            negated = self.accept("NOT")
+            self.expect("NULL")
+            return IsNull(left, negated)
+
+        negated = self.accept("NOT")
+        if self.accept("IN"):
+            self.expect("(")
+            if self.at("SELECT"):
+                in_select = InSubquery(left, self.select(), negated)
+                self.expect(")")
+                return in_select
+            items = self.expression_list()
+            self.expect(")")
+            return InList(left, tuple(items), negated)
+        if self.accept("BETWEEN"):
+            low = self.additive()
+            self.expect("AND")
+            high = self.additive()
+            between = BinaryOp("AND", BinaryOp(">=", left, low),
+                                      BinaryOp("<=", left, high))
+            return UnaryOp("NOT", between) if negated else between
+        if negated:
+            raise SQLError("expected IN or BETWEEN after NOT")
+        return left
+
+    def additive(self) -> Any:
+        expr = self.multiplicative()
+        while self.at("+", "-"):
+            expr = BinaryOp(self.advance().value, expr, self.multiplicative())
+        return expr
+
+    def multiplicative(self) -> Any:
+        expr = self.unary()
+        while self.at("*", "/"):
+            expr = BinaryOp(self.advance().value, expr, self.unary())
+        return expr
+
+    def unary(self) -> Any:
+        if self.accept("-"):
+            return UnaryOp("-", self.unary())
+        return self.primary()
+
+    def primary(self) -> Any:
+        token = self.advance()
+        if token.kind in ("number", "string"):
+            return Literal(token.value)
+        if token.kind == "keyword" and token.value in ("NULL", "TRUE", "FALSE"):
+            return Literal({"NULL": None, "TRUE": True, "FALSE": False}[token.value])
+        if token == Token("op", "?"):
+            self.num_params += 1
+            return Param(self.num_params - 1)
+        if token == Token("op", "("):
+            if self.at("SELECT"):
+                expr: Any = Subquery(self.select())
+            else:
+                expr = self.expression()
+            self.expect(")")
+            return expr
+        if token.kind == "name":
+            if self.accept("("):
+                return self.function_call(token.value.upper())
+            name = token.value
+            if self.accept("."):
+                name = self.name()
+            return ColumnRef(name)
+        raise SQLError(f"unexpected {token.value!r}")
+
+    def function_call(self, name: str) -> FunctionCall:
+        if name == "COUNT" and self.accept("*"):
+            self.expect(")")
+            return FunctionCall(name, (), False)
+        distinct = self.accept("DISTINCT")
+        args = self.expression_list()
+        self.expect(")")
+        return FunctionCall(name, tuple(args), distinct)
+
+def parse(text: str) -> Tuple[Select, int]:
+    """The parse tree for a SELECT statement, and how many ? it has"""
+    parser = Parser(text)
+    return parser.parse(), parser.num_params
+
+assert parse("SELECT a FROM t WHERE NOT b = ? + 1")[0].where == \
+       UnaryOp("NOT", BinaryOp("==", ColumnRef("b"),
+                               BinaryOp("+", Param(0), Literal(1))))
+
+def to_sql(expr: Any) -> str:
+    """SQL text for an expression, which also names its result column"""
+    if isinstance(expr, ColumnRef):
+        return expr.name
+    elif isinstance(expr, Literal):
+        if expr.value is None or isinstance(expr.value, bool):
+            return {None: "NULL", True: "TRUE", False: "FALSE"}[expr.value]
+        if isinstance(expr.value, str):
+            return "'" + expr.value.replace("'", "''") + "'"
+        return repr(expr.value)
+    elif isinstance(expr, Param):
+        return f"?{expr.index + 1}"
+    elif isinstance(expr, UnaryOp):
+        return f"{expr.op} {to_sql(expr.operand)}" if expr.op == "NOT" \
+               else f"-{to_sql(expr.operand)}"
+    elif isinstance(expr, BinaryOp):
+        def operand(e: Any) -> str:
+            return f"({to_sql(e)})" if isinstance(e, BinaryOp) else to_sql(e)
+        op = {"==": "=", "!=": "<>"}.get(expr.op, expr.op)
+        return f"{operand(expr.left)} {op} {operand(expr.right)}"
+    elif isinstance(expr, FunctionCall):
+        args = ", ".join(to_sql(arg) for arg in expr.args) or "*"
+        return f"{expr.name}({'DISTINCT ' if expr.distinct else ''}{args})"
+    elif isinstance(expr, IsNull):
+        return f"{to_sql(expr.operand)} IS {'NOT ' if expr.negated else ''}NULL"
+    elif isinstance(expr, InList):
+        items = ", ".join(to_sql(item) for item in expr.items)
+        return f"{to_sql(expr.operand)} {'NOT ' if expr.negated else ''}IN ({items})"
+    elif isinstance(expr, InSubquery):
+        return f"{to_sql(expr.operand)} {'NOT ' if expr.negated else ''}IN (subquery)"
+    elif isinstance(expr, Subquery):
+        return "(subquery)"
+    raise SQLError(f"not an expression: {expr}")
+
+assert to_sql(parse("SELECT COUNT(DISTINCT x), -a * (b - 1) FROM t")[0].items[1].expr) == \
+       "-a * (b - 1)"
+
+def walk(expr: Any) -> Iterator[Any]:
+    """expr and all the expressions inside it (but not inside subqueries)"""
+    yield expr
+    for field in expr:
+        if isinstance(field, EXPRESSIONS):
+            yield from walk(field)
+        elif isinstance(field, tuple) and not isinstance(field, Select):
+            for item in field:
+                yield from walk(item)
+
+def substitute(expr: Any, replacements: Dict[str, str]) -> Any:
+    """
+    Replaces each part of expr whose SQL text is in replacements (like
+    "COUNT(*)") with a reference to the named column.
+    """
+    if to_sql(expr) in replacements:
+        return ColumnRef(replacements[to_sql(expr)])
+
+    fields = []
+    for field in expr:
+        if isinstance(field, EXPRESSIONS):
+            field = substitute(field, replacements)
+        elif isinstance(field, tuple) and not isinstance(field, Select):
+            field = tuple(substitute(item, replacements) for item in field)
+        fields.append(field)
+    return type(expr)(*fields)
+
+# Compiling. Parameters and subqueries get their values from a Bindings,
+# which the Statement fills in each time it runs.
+
+class Bindings:
+    def __init__(self, tables: Dict[str, Table]) -> None:
+        self.tables = tables                    # (for compiling subqueries)
+        self.params: List[Any] = []
+        self.results: Dict[int, Any] = {}       # id(SubqueryResult) -> value
+
+class Parameter:
+    def __init__(self, bindings: Bindings, index: int) -> None:
+        self.bindings = bindings
+        self.index = index
+
+    def get(self) -> Any:
+        return self.bindings.params[self.index]
+
+    def __repr__(self) -> str:
+        return f"?{self.index + 1}"
+
+class SubqueryResult:
+    """
+    The value of a subquery: its only value if scalar, otherwise the
+    set of its values. Computed (at most) once per run of the statement.
+    """
+    def __init__(self, plan: PlanNode, bindings: Bindings, scalar: bool) -> None:
+        if len(plan.columns) != 1:
+            raise SQLError(f"subquery must return one column, not {plan.columns}")
+        self.plan = plan
+        self.bindings = bindings
+        self.scalar = scalar
+
+    def get(self) -> Any:
+        results = self.bindings.results
+        if id(self) not in results:
+            column = self.plan.columns[0]
+            values = [row[column] for row in self.plan.rows()]
+            if not self.scalar:
+                results[id(self)] = set(values)
+            elif len(values) > 1:
+                raise SQLError("subquery returned more than one row")
+            else:
+                results[id(self)] = values[0] if values else None
+        return results[id(self)]
+
+    def __repr__(self) -> str:
+        return "(subquery)"
+
+class SQLComparison(Comparison):
+    """
+    A Comparison that follows SQL's rules for NULL (which is never equal,
+    unequal, less, or greater than anything), and whose value can be a
+    Parameter or SubqueryResult that's only known when the statement runs.
+    """
+    @property                                   # type: ignore
+    def value(self) -> Any:
+        value = self._value
+        return value.get() if isinstance(value, (Parameter, SubqueryResult)) else value
+
+    @value.setter
+    def value(self, value: Any) -> None:
+        self._value = value
+
+    def matches(self, row_value: Any) -> bool:
+        value = self.value
+        if row_value is None or value is None:
+            return False
+        return self.compare(row_value, value)
+
+    def __repr__(self) -> str:
+        return f"col({self.column!r}) {self.op} {self._value!r}"
+
+class ExpressionPredicate(Predicate):
+    """Any other condition, which has to be evaluated row by row"""
+    def __init__(self, expr: Any, bindings: Bindings) -> None:
+        self.expr = expr
+        self.evaluate = compile_expression(expr, bindings)
+        # (so the optimizer knows which columns it needs; see predicate_columns)
+        self.columns = {e.name for e in walk(expr) if isinstance(e, ColumnRef)}
+
+    def __call__(self, row: Row) -> bool:
+        return bool(self.evaluate(row))         # NULL counts as false
+
+    def __repr__(self) -> str:
+        return to_sql(self.expr)
+
+ARITHMETIC = {"+": operator.add, "-": operator.sub,
+              "*": operator.mul, "/": operator.truediv}
+
+OPERATORS = {**ARITHMETIC, **COMPARISONS}
+
+FLIPPED = {"==": "==", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+NEGATED = {"==": "!=", "!=": "==", "<": ">=", "<=": ">", ">": "<=", ">=": "<"}
+
+# name -> (function, result type, or None for "same as the argument")
+FUNCTIONS: Dict[str, Tuple[Callable, Optional[type]]] = {
+    "LENGTH": (len, int),
+    "UPPER": (str.upper, str),
+    "LOWER": (str.lower, str),
+    "ABS": (abs, None),
+    # SUBSTR(s, start, length), counting from 1
+    "SUBSTR": (lambda s, start, length=None:
+                   s[start - 1:] if length is None else s[start - 1:start - 1 + length],
+               str),
+}
+
+AGGREGATES = {"COUNT": Count, "SUM": Sum, "MIN": Min, "MAX": Max, "AVG": Avg}
+
+def compile_expression(expr: Any, bindings: Bindings) -> Callable[[Row], Any]:
+    """
+    A function that evaluates expr on a row. Like SQL, anything involving
+    NULL (None) is NULL, and AND / OR / NOT use three-valued logic.
+    """
+    if isinstance(expr, ColumnRef):
+        return operator.itemgetter(expr.name)
+
+    if isinstance(expr, Literal):
+        value = expr.value
+        return lambda row: value
+
+    if isinstance(expr, (Param, Subquery)):
+        source = dynamic_value(expr, bindings)
+        return lambda row: source.get()
+
+    if isinstance(expr, UnaryOp):
+        operand = compile_expression(expr.operand, bindings)
+        if expr.op == "NOT":
+            def evaluate_not(row: Row) -> Any:
+                value = operand(row)
+                return None if value is None else not value
+            return evaluate_not
+        def negate(row: Row) -> Any:
+            value = operand(row)
+            return None if value is None else -value
+        return negate
+
+    if isinstance(expr, BinaryOp):
+        left = compile_expression(expr.left, bindings)
+        right = compile_expression(expr.right, bindings)
+        if expr.op == "AND":
+            def evaluate_and(row: Row) -> Any:
+                a = left(row)
+                if a is not None and not a:
+                    return False
+                b = right(row)
+                if b is not None and not b:
+                    return False
+                return None if a is None or b is None else True
+            return evaluate_and
+        if expr.op == "OR":
+            def evaluate_or(row: Row) -> Any:
+                a = left(row)
+                if a:
+                    return True
+                b = right(row)
+                if b:
+                    return True
+                return None if a is None or b is None else False
+            return evaluate_or
+
+        op = OPERATORS[expr.op]
+        def evaluate_op(row: Row) -> Any:
+            a, b = left(row), right(row)
+            return None if a is None or b is None else op(a, b)
+        return evaluate_op
+
+    if isinstance(expr, FunctionCall):
+        if expr.name in AGGREGATES:
+            raise SQLError(f"{to_sql(expr)} isn't allowed here")
+        if expr.name not in FUNCTIONS:
+            raise SQLError(f"unknown function {expr.name}")
+        fn, _ = FUNCTIONS[expr.name]
+        args = [compile_expression(arg, bindings) for arg in expr.args]
+        def call(row: Row) -> Any:
+            values = [arg(row) for arg in args]
+            return None if None in values else fn(*values)
+        return call
+
+    if isinstance(expr, IsNull):
+        operand, negated = compile_expression(expr.operand, bindings), expr.negated
+        return lambda row: (operand(row) is None) != negated
+
+    if isinstance(expr, (InList, InSubquery)):
+        operand, negated = compile_expression(expr.operand, bindings), expr.negated
+        if isinstance(expr, InList):
+            items = [compile_expression(item, bindings) for item in expr.items]
+            values_of: Callable[[Row], Any] = lambda row: [item(row) for item in items]
+        else:
+            source = dynamic_value(expr, bindings)
+            values_of = lambda row: source.get()
+        def evaluate_in(row: Row) -> Any:
+            value, values = operand(row), values_of(row)
+            if value is None:
+                return None
+            if value in values:
+                return not negated
+            return None if None in values else negated
+        return evaluate_in
+
+    raise SQLError(f"not an expression: {expr}")
+
+def dynamic_value(expr: Any, bindings: Bindings) -> Any:
+    """The Parameter or SubqueryResult for a ?, (subquery), or IN (subquery)"""
+    if isinstance(expr, Param):
+        return Parameter(bindings, expr.index)
+    plan = optimize(compile_select(expr.select, bindings))
+    return SubqueryResult(plan, bindings, scalar=isinstance(expr, Subquery))
+
+def is_constant(expr: Any) -> bool:
+    return (isinstance(expr, (Param, Subquery)) or
+            (isinstance(expr, Literal) and expr.value is not None))
+
+def negation_of(expr: Any) -> Any:
+    """
+    NOT expr, pushed inside ANDs, ORs, and comparisons (which is the same
+    thing, even with NULLs), so that it's more likely to become col(...)s.
+    """
+    if isinstance(expr, BinaryOp) and expr.op in ("AND", "OR"):
+        return BinaryOp("OR" if expr.op == "AND" else "AND",
+                        negation_of(expr.left), negation_of(expr.right))
+    if isinstance(expr, BinaryOp) and expr.op in NEGATED:
+        return BinaryOp(NEGATED[expr.op], expr.left, expr.right)
+    if isinstance(expr, UnaryOp) and expr.op == "NOT":
+        return expr.operand
+    if isinstance(expr, (IsNull, InList, InSubquery)):
+        return expr._replace(negated=not expr.negated)
+    return UnaryOp("NOT", expr)
+
+def conjuncts(expr: Any) -> List[Any]:
+    if isinstance(expr, BinaryOp) and expr.op == "AND":
+        return conjuncts(expr.left) + conjuncts(expr.right)
+    return [expr]
+
+def to_predicate(expr: Any, bindings: Bindings) -> Predicate:
+    """
+    A Predicate for a WHERE or HAVING condition. As much of it as possible
+    becomes SQLComparisons (which can use indexes and move around in the
+    plan); the rest gets evaluated row by row.
+    """
+    if isinstance(expr, UnaryOp) and expr.op == "NOT":
+        expr = negation_of(expr.operand)
+
+    if isinstance(expr, BinaryOp) and expr.op == "AND":
+        # Cheapest first: comparisons before general expressions, which
+        # then only run on rows that pass the comparisons.
+        parts = [to_predicate(part, bindings) for part in conjuncts(expr)]
+        parts.sort(key=lambda part: isinstance(part, ExpressionPredicate))
+        return all_of(parts)
+
+    if isinstance(expr, BinaryOp) and expr.op == "OR":
+        left = to_predicate(expr.left, bindings)
+        right = to_predicate(expr.right, bindings)
+        if not isinstance(left, ExpressionPredicate) and \
+           not isinstance(right, ExpressionPredicate):
+            return Or(left, right)
+
+    if isinstance(expr, BinaryOp) and expr.op in FLIPPED:
+        left, right, op = expr.left, expr.right, expr.op
+        if isinstance(right, ColumnRef) and is_constant(left):
+            left, right, op = right, left, FLIPPED[op]      # 5 < x => x > 5
+        if isinstance(left, ColumnRef) and is_constant(right):
+            value = (right.value if isinstance(right, Literal)
+                     else dynamic_value(right, bindings))
+            return SQLComparison(left.name, op, value)
+
+    if isinstance(expr, IsNull) and isinstance(expr.operand, ColumnRef):
+        return Comparison(expr.operand.name, "!=" if expr.negated else "==", None)
+
+    if (isinstance(expr, InList) and isinstance(expr.operand, ColumnRef) and
+            all(is_constant(item) for item in expr.items)):
+        # x IN (1, 2) => x = 1 OR x = 2; x NOT IN (1, 2) => x <> 1 AND x <> 2
+        op = "!=" if expr.negated else "=="
+        parts = [to_predicate(BinaryOp(op, expr.operand, item), bindings)
+                 for item in expr.items]
+        predicate = parts[0]
+        for part in parts[1:]:
+            predicate = And(predicate, part) if expr.negated else Or(predicate, part)
+        return predicate
+
+    return ExpressionPredicate(expr, bindings)
+
+def expression_type(expr: Any, types: Dict[str, type]) -> type:
+    """The type of expr's values (object if we can't tell)"""
+    if isinstance(expr, ColumnRef):
+        return types.get(expr.name, object)
+    if isinstance(expr, Literal):
+        return object if expr.value is None else type(expr.value)
+    if isinstance(expr, UnaryOp):
+        return bool if expr.op == "NOT" else expression_type(expr.operand, types)
+    if isinstance(expr, BinaryOp):
+        if expr.op not in ARITHMETIC:
+            return bool
+        if expr.op == "/":
+            return float
+        operand_types = {expression_type(expr.left, types),
+                         expression_type(expr.right, types)}
+        if operand_types == {int}:
+            return int
+        if operand_types <= {int, float}:
+            return float
+        if operand_types == {str} and expr.op == "+":
+            return str
+        return object
+    if isinstance(expr, FunctionCall) and expr.name in FUNCTIONS:
+        _, typ3 = FUNCTIONS[expr.name]
+        return typ3 or expression_type(expr.args[0], types)
+    if isinstance(expr, (IsNull, InList, InSubquery)):
+        return bool
+    return object
+
+def calculation(expr: Any, types: Dict[str, type], bindings: Bindings) -> Callable:
+    """A Project calculation for expr, with a return type and a name"""
+    evaluate = compile_expression(expr, bindings)
+    def calculate(row: Row) -> Any:
+        return evaluate(row)
+    calculate.__annotations__ = {"return": expression_type(expr, types)}
+    calculate.__name__ = to_sql(expr)
+    return calculate
+
+def check_columns(expr: Any, columns: List[str], message: str = "unknown column") -> None:
+    for e in walk(expr):
+        if isinstance(e, ColumnRef) and e.name not in columns:
+            raise SQLError(f"{message}: {e.name}")
+
+class Descending:
+    """Wraps a sort key so that it sorts in the opposite order"""
+    def __init__(self, key: Any) -> None:
+        self.key = key
+
+    def __lt__(self, other: 'Descending') -> bool:
+        return other.key < self.key
+
+    def __eq__(self, other: Any) -> bool:
+        return self.key == other.key
+
+def sort_order(order_by: List[Tuple[Any, bool]], bindings: Bindings) -> Callable[[Row], Any]:
+    """A sort key for ORDER BY. NULLs sort last, or first if DESC."""
+    keys = [(compile_expression(expr, bindings), descending)
+            for expr, descending in order_by]
+    def order(row: Row) -> tuple:
+        result = []
+        for key, descending in keys:
+            value = key(row)
+            sort_key = (value is None, value)
+            result.append(Descending(sort_key) if descending else sort_key)
+        return tuple(result)
+    order.__name__ = ", ".join(to_sql(expr) + (" DESC" if descending else "")
+                               for expr, descending in order_by)
+    return order
+
+def compile_source(source: Any, bindings: Bindings) -> PlanNode:
+    if isinstance(source, SubquerySource):
+        return compile_select(source.select, bindings)
+    if source.name not in bindings.tables:
+        raise SQLError(f"no such table: {source.name}")
+    return Scan(bindings.tables[source.name])
+
+def is_column(expr: Any, name: str) -> bool:
+    # (Not expr == ColumnRef(name), since NamedTuples compare as tuples,
+    # so Literal("x") == ColumnRef("x").)
+    return isinstance(expr, ColumnRef) and expr.name == name
+
+def compile_select(select: Select, bindings: Bindings) -> PlanNode:
+    """The (unoptimized) plan for a SELECT"""
+    # FROM and JOIN
+    plan = compile_source(select.source, bindings)
+    for join in select.joins:
+        right = compile_source(join.source, bindings)
+        shared = [c for c in plan.columns if c in right.columns]
+        if join.columns is not None and sorted(join.columns) != sorted(shared):
+            raise SQLError(f"joins are on all the shared columns, {shared}, "
+                           f"not {list(join.columns)}")
+        plan = Join(plan, right, join.left_join)
+
+    # WHERE
+    if select.where is not None:
+        check_columns(select.where, plan.columns)
+        plan = Filter(plan, to_predicate(select.where, bindings))
+
+    # The select list, with * expanded, and the name of each result column.
+    items: List[Tuple[str, Any]] = []
+    for item in select.items:
+        if item.expr is None:
+            items.extend((column, ColumnRef(column)) for column in plan.columns)
+        else:
+            items.append((item.alias or to_sql(item.expr), item.expr))
+    names = [name for name, _ in items]
+    if len(set(names)) != len(names):
+        raise SQLError(f"duplicate result columns in {names}")
+    aliases = {name: expr for name, expr in items
+               if not is_column(expr, name) and name not in plan.columns}
+
+    # ORDER BY can use the select list's aliases, or positions (ORDER BY 2).
+    order_by = []
+    for expr, descending in select.order_by:
+        if isinstance(expr, Literal) and isinstance(expr.value, int):
+            if not 1 <= expr.value <= len(items):
+                raise SQLError(f"ORDER BY {expr.value} is out of range")
+            expr = items[expr.value - 1][1]
+        elif isinstance(expr, ColumnRef) and expr.name in aliases:
+            expr = aliases[expr.name]
+        order_by.append((expr, descending))
+
+    # GROUP BY and HAVING
+    aggregate_calls = [e for expr in ([expr for _, expr in items] +
+                                      [select.having] * (select.having is not None) +
+                                      [expr for expr, _ in order_by])
+                       for e in walk(expr)
+                       if isinstance(e, FunctionCall) and e.name in AGGREGATES]
+
+    if select.group_by or aggregate_calls:
+        # Everything after the GroupBy refers to its columns, so we replace
+        # each aggregate (and computed group key) with its column.
+        replacements: Dict[str, str] = {}
+        precomputed: Dict[str, Callable] = {}
+        types = dict(zip(plan.columns, plan.types))
+
+        def alias_of(expr: Any, default: str) -> str:
+            """The name the select list gives expr, if any"""
+            return next((name for name, item in items
+                         if type(item) is type(expr) and item == expr), default)
+
+        def column_for(expr: Any, name: str) -> str:
+            """The input column with expr's values, computing it if need be"""
+            check_columns(expr, plan.columns)
+            if isinstance(expr, ColumnRef):
+                return expr.name
+            precomputed[name] = calculation(expr, types, bindings)
+            return name
+
+        group_by_columns = []
+        for expr in select.group_by:
+            if isinstance(expr, ColumnRef) and expr.name in aliases:
+                expr = aliases[expr.name]           # GROUP BY an alias
+            column = column_for(expr, alias_of(expr, to_sql(expr)))
+            group_by_columns.append(column)
+            replacements[to_sql(expr)] = column
+
+        aggregates = {}
+        for call in aggregate_calls:
+            text = to_sql(call)
+            if text in replacements:
+                continue
+            if len(call.args) > 1 or (call.distinct and call.name != "COUNT"):
+                raise SQLError(f"unsupported aggregate {text}")
+            name = alias_of(call, text)
+            column = column_for(call.args[0], to_sql(call.args[0])) if call.args else None
+            aggregate = CountDistinct if call.distinct else AGGREGATES[call.name]
+            aggregates[name] = aggregate(column)
+            replacements[text] = name
+
+        if precomputed:
+            plan = Project(plan, plan.columns, precomputed)
+        group_columns = group_by_columns + list(aggregates)
+
+        having = None
+        if select.having is not None:
+            having_expr = substitute(select.having, replacements)
+            check_columns(having_expr, group_columns,
+                          "HAVING can only use grouped columns and aggregates")
+            having = to_predicate(having_expr, bindings)
+        plan = GroupBy(plan, group_by_columns, aggregates, having)
+
+        items = [(name, substitute(expr, replacements)) for name, expr in items]
+        order_by = [(substitute(expr, replacements), descending)
+                    for expr, descending in order_by]
+        message = "must be in GROUP BY or in an aggregate"
+    elif select.having is not None:
+        raise SQLError("HAVING without GROUP BY or aggregates")
+    else:
+        message = "unknown column"
+
+    # ORDER BY and LIMIT happen on the rows before the final projection,
+    # so the sort can use columns that aren't selected.
+    if order_by:
+        for expr, _ in order_by:
+            check_columns(expr, plan.columns, message)
+        plan = Sort(plan, sort_order(order_by, bindings))
+    if select.limit is not None:
+        plan = Limit(plan, select.limit)
+
+    # SELECT
+    types = dict(zip(plan.columns, plan.types))
+    keep_columns, additional_columns = [], {}
+    for name, expr in items:
+        check_columns(expr, plan.columns, message)
+        if is_column(expr, name):
+            keep_columns.append(name)
+        else:
+            additional_columns[name] = calculation(expr, types, bindings)
+
+    if keep_columns == plan.columns and not additional_columns:
+        return plan
+    plan = Project(plan, keep_columns, additional_columns)
+    if plan.columns != names:
+        plan = Project(plan, names, {})             # (put them in order)
+    return plan
+
+class Statement:
+    """A parsed and optimized SELECT. Run it with execute(*params)."""
+    def __init__(self, sql: str, tables: Dict[str, Table]) -> None:
+        select, self.num_params = parse(sql)
+        self.sql = sql
+        self.bindings = Bindings(tables)
+        self.plan = optimize(compile_select(select, self.bindings))
+        self.columns = self.plan.columns
+
+    def bind(self, params: Tuple[Any, ...]) -> None:
+        if len(params) != self.num_params:
+            raise SQLError(f"expected {self.num_params} parameters, got {len(params)}")
+        self.bindings.params = list(params)
+        self.bindings.results = {}
+
+    def execute(self, *params: Any) -> Table:
+        self.bind(params)
+        return execute_plan(self.plan)
+
+    def explain(self) -> None:
+        """Prints the plan (with any parameters shown as ?1, ?2, ...)"""
+        self.bind((None,) * self.num_params)
+        print(self.plan.explain())
+
+class Database:
+    """
+    Named tables that you can query with SQL. Statements get cached by
+    their text, so running the same one again (even with different
+    parameters) skips parsing and planning.
+    """
+    def __init__(self, tables: Dict[str, Table] = None, cache_size: int = 128) -> None:
+        self.tables: Dict[str, Table] = dict(tables or {})
+        self.cache_size = cache_size
+        self.statements: 'OrderedDict[str, Statement]' = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def register(self, name: str, table: Table) -> None:
+        self.tables[name] = table
+        self.statements.clear()         # their plans might use the old table
+
+    def prepare(self, sql: str) -> Statement:
+        statement = self.statements.get(sql)
+        if statement is not None:
+            self.cache_hits += 1
+            self.statements.move_to_end(sql)
+            return statement
+
+        self.cache_misses += 1
+        statement = Statement(sql, self.tables)
+        self.statements[sql] = statement
+        if len(self.statements) > self.cache_size:
+            self.statements.popitem(last=False)     # least recently used
+        return statement
+
+    def execute(self, sql: str, *params: Any) -> Table:
+        return self.prepare(sql).execute(*params)
+
+def benchmark_sql(num_users: int = 10000, num_queries: int = 2000) -> None:
+    import random
+    import time
+    from scratch.databases import col
+
+    random.seed(0)
+    users = Table(['user_id', 'name', 'num_friends'], [int, str, int])
+    users.insert_many([user_id, f"user{user_id}", random.randrange(100)]
+                      for user_id in range(num_users))
+    users.create_index("user_id")
+    interests = Table(['user_id', 'interest'], [int, str])
+    interests.insert_many([random.randrange(num_users), random.choice(["SQL", "NoSQL",
+                                                                       "Python", "R"])]
+                          for _ in range(5 * num_users))
+    db = Database({"users": users, "user_interests": interests})
+    user_ids = [random.randrange(num_users) for _ in range(num_queries)]
+
+    # A repeated point lookup, with a different user_id each time.
+    sql = "SELECT name, num_friends FROM users WHERE user_id = ?"
+    runs = [
+        ("Table methods", lambda user_id: users.where(col("user_id") == user_id)
+                                               .select(["name", "num_friends"])),
+        ("SQL, no cache", lambda user_id: Statement(sql, db.tables).execute(user_id)),
+        ("SQL, cached", lambda user_id: db.execute(sql, user_id)),
+    ]
+    print(f"{num_queries} lookups in {num_users} users")
+    results = []
+    for description, run in runs:
+        start = time.time()
+        results.append([run(user_id).rows for user_id in user_ids])
+        elapsed = time.time() - start
+        print(f"{description:>14}: {1000 * elapsed / num_queries:.3f} ms per query")
+    assert results[0] == results[1] == results[2]
+
+    # The join written the way it's read (join, then filter), versus the
+    # plan the SQL compiles to, which filters first.
+    start = time.time()
+    naive = (interests.join(users)
+             .where(lambda row: row["interest"] == "SQL" and row["num_friends"] > 90)
+             .select(["name"]))
+    naive_time = time.time() - start
+
+    sql = """SELECT name FROM user_interests JOIN users USING (user_id)
+             WHERE interest = 'SQL' AND num_friends > 90"""
+    start = time.time()
+    planned = db.execute(sql)
+    planned_time = time.time() - start
+    assert planned.rows == naive.rows
+    print(f"join then filter: {naive_time:.3f}s, compiled SQL: {planned_time:.3f}s")
+    db.prepare(sql).explain()
+
+def main():
+    users = Table(['user_id', 'name', 'num_friends'], [int, str, int])
+    users.insert_many([[0, "Hero", 0], [1, "Dunn", 2], [2, "Sue", 3], [3, "Chi", 3],
+                       [4, "Thor", 3], [5, "Clive", 2], [6, "Hicks", 3],
+                       [7, "Devin", 2], [8, "Kate", 2], [9, "Klein", 3],
+                       [10, "Jen", 1]])
+    user_interests = Table(['user_id', 'interest'], [int, str])
+    user_interests.insert_many([[0, "SQL"], [0, "NoSQL"], [2, "SQL"], [2, "MySQL"]])
+
+    db = Database({"users": users, "user_interests": user_interests})
+
+    # The queries from the databases chapter, in SQL.
+    assert len(db.execute("SELECT * FROM users")) == 11
+    assert len(db.execute("SELECT * FROM users LIMIT 2")) == 2
+    assert db.execute("SELECT user_id FROM users").columns == ["user_id"]
+    assert db.execute("SELECT user_id FROM users WHERE name = 'Dunn'").rows == \
+           [{"user_id": 1}]
+    assert db.execute("SELECT LENGTH(name) AS name_length FROM users")[0] == \
+           {"name_length": 4}
+
+    stats_by_length = db.execute("""
+        SELECT LENGTH(name) as name_length,
+               MIN(user_id) AS min_user_id,
+               COUNT(*) AS num_users
+        FROM users
+        GROUP BY LENGTH(name)""")
+    assert stats_by_length.columns == ["name_length", "min_user_id", "num_users"]
+    assert stats_by_length.types == [int, int, int]
+    assert sorted(row["num_users"] for row in stats_by_length) == [3, 4, 4]
+
+    avg_friends_by_letter = db.execute("""
+        SELECT SUBSTR(name, 1, 1) AS first_letter,
+               AVG(num_friends) AS avg_num_friends
+        FROM users
+        GROUP BY SUBSTR(name, 1, 1)
+        HAVING AVG(num_friends) > 1""")
+    assert {row["first_letter"] for row in avg_friends_by_letter} == \
+           {"H", "D", "S", "C", "T", "K"}
+
+    assert db.execute("""SELECT SUM(user_id) as user_id_sum
+                         FROM users WHERE user_id > 1""").rows == [{"user_id_sum": 54}]
+
+    friendliest_letters = db.execute("""
+        SELECT SUBSTR(name, 1, 1) AS first_letter,
+               AVG(num_friends) AS avg_num_friends
+        FROM users
+        GROUP BY first_letter
+        ORDER BY avg_num_friends DESC, first_letter
+        LIMIT 4""")
+    assert [row["first_letter"] for row in friendliest_letters] == ["S", "T", "C", "K"]
+
+    sql_users = db.execute("""
+        SELECT users.name
+        FROM users
+        JOIN user_interests
+        ON users.user_id = user_interests.user_id
+        WHERE user_interests.interest = 'SQL'""")
+    assert {row["name"] for row in sql_users} == {"Hero", "Sue"}
+
+    interest_counts = db.execute("""
+        SELECT users.user_id, COUNT(user_interests.interest) AS num_interests
+        FROM users
+        LEFT JOIN user_interests
+        ON users.user_id = user_interests.user_id
+        GROUP BY users.user_id""")
+    assert [row["num_interests"] for row in interest_counts][:4] == [2, 0, 2, 0]
+
+    # Subqueries, in WHERE and in FROM.
+    assert db.execute("""
+        SELECT name FROM users
+        WHERE user_id IN (SELECT user_id FROM user_interests WHERE interest = 'SQL')
+        """).rows == [{"name": "Hero"}, {"name": "Sue"}]
+    assert db.execute("""
+        SELECT MIN(user_id) AS min_user_id
+        FROM (SELECT user_id FROM user_interests WHERE interest = 'SQL') sql_users
+        """).rows == [{"min_user_id": 0}]
+    assert [row["name"] for row in db.execute("""
+        SELECT name FROM users
+        WHERE num_friends = (SELECT MAX(num_friends) FROM users) AND user_id < 4
+        """)] == ["Sue", "Chi"]
+
+    # NULLs follow SQL's rules.
+    user_interests.insert([11, None])
+    assert len(db.execute("SELECT * FROM user_interests WHERE interest <> 'SQL'")) == 2
+    assert len(db.execute("SELECT * FROM user_interests WHERE NOT interest = 'SQL'")) == 2
+    assert len(db.execute("SELECT * FROM user_interests WHERE interest IS NULL")) == 1
+    user_interests.delete(lambda row: row["user_id"] == 11)
+
+    # Parameters: the statement is parsed and planned once...
+    misses = db.cache_misses
+    lookup = "SELECT name FROM users WHERE user_id = ? OR num_friends < ?"
+    assert db.execute(lookup, 1, 1).rows == [{"name": "Hero"}, {"name": "Dunn"}]
+    assert db.execute(lookup, 2, 0).rows == [{"name": "Sue"}]
+    assert (db.cache_misses, db.cache_hits) == (misses + 1, 1)
+
+    # ...and its plan checks the user_id with an index, if there is one.
+    users.create_index("user_id")
+    db.prepare("SELECT name FROM users WHERE user_id = ?").explain()
+
+    try:
+        db.execute("SELECT name, COUNT(*) FROM users")
+        assert False, "name isn't grouped"
+    except SQLError:
+        pass
+
+if __name__ == "__main__":
+    import sys
+    benchmark_sql() if "--benchmark" in sys.argv[1:] else main()
@@ -38,7 +38,9 @@ assert second_largest_value == 49
 
 
 from typing import List
+from scratch.linear_algebra import backend_dispatch
 
+@backend_dispatch
 def mean(xs: List[float]) -> float:
     return sum(xs) / len(xs)
 
@@ -60,6 +62,7 @@ def _median_even(xs: List[float]) -> float:
     hi_midpoint = len(xs) // 2  # e.g. length 4 => hi_midpoint 2
     return (sorted_xs[hi_midpoint - 1] + sorted_xs[hi_midpoint]) / 2
 
+@backend_dispatch
 def median(v: List[float]) -> float:
     """Finds the 'middle-most' value of v"""
     return _median_even(v) if len(v) % 2 == 0 else _median_odd(v)
@@ -70,6 +73,7 @@ assert median([1, 9, 2, 10]) == (2 + 9) / 2
 
 assert median(num_friends) == 6
 
+@backend_dispatch
 def quantile(xs: List[float], p: float) -> float:
     """Returns the pth-percentile value in x"""
     p_index = int(p * len(xs))
@@ -90,6 +94,7 @@ def mode(x: List[float]) -> List[float]:
 assert set(mode(num_friends)) == {1, 6}
 
 # "range" already means something in Python, so we'll use a different name
+@backend_dispatch
 def data_range(xs: List[float]) -> float:
     return max(xs) - min(xs)
 
@@ -97,11 +102,13 @@ assert data_range(num_friends) == 99
 
 from scratch.linear_algebra import sum_of_squares
 
+@backend_dispatch
 def de_mean(xs: List[float]) -> List[float]:
     """Translate xs by subtracting its mean (so the result has mean 0)"""
     x_bar = mean(xs)
     return [x - x_bar for x in xs]
 
+@backend_dispatch
 def variance(xs: List[float]) -> float:
     """Almost the average squared deviation from the mean"""
     assert len(xs) >= 2, "variance requires at least two elements"
@@ -114,12 +121,14 @@ assert 81.54 < variance(num_friends) < 81.55
 
 import math
 
+@backend_dispatch
 def standard_deviation(xs: List[float]) -> float:
     """The standard deviation is the square root of the variance"""
     return math.sqrt(variance(xs))
 
 assert 9.02 < standard_deviation(num_friends) < 9.04
 
+@backend_dispatch
 def interquartile_range(xs: List[float]) -> float:
     """Returns the difference between the 75%-ile and the 25%-ile"""
     return quantile(xs, 0.75) - quantile(xs, 0.25)
@@ -133,6 +142,7 @@ daily_hours = [dm / 60 for dm in daily_minutes]
 
 from scratch.linear_algebra import dot
 
+@backend_dispatch
 def covariance(xs: List[float], ys: List[float]) -> float:
     assert len(xs) == len(ys), "xs and ys must have same number of elements"
 
@@ -141,6 +151,7 @@ def covariance(xs: List[float], ys: List[float]) -> float:
 assert 22.42 < covariance(num_friends, daily_minutes) < 22.43
 assert 22.42 / 60 < covariance(num_friends, daily_hours) < 22.43 / 60
 
+@backend_dispatch
 def correlation(xs: List[float], ys: List[float]) -> float:
     """Measures how much xs and ys vary in tandem about their means"""
     stdev_x = standard_deviation(xs)